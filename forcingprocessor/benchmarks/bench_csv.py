@@ -0,0 +1,46 @@
+"""
+Compare per catchment csv rendering with pandas against format_csv_block
+
+python benchmarks/bench_csv.py --ncatchments 2000 --ntimes 720
+"""
+import argparse, time
+import numpy as np
+import pandas as pd
+from forcingprocessor.utils import format_csv_block, ngen_variables
+
+def pandas_csv(data, t_ax):
+    out = []
+    for j in range(data.shape[2]):
+        df = pd.DataFrame(data[:,:,j],columns=ngen_variables)
+        df.insert(0,"time",t_ax)
+        out.append(df.to_csv(index=False).encode())
+    return out
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncatchments", type=int, default=2000)
+    parser.add_argument("--ntimes", type=int, default=720)
+    parser.add_argument("--block", type=int, default=200, help="catchments rendered per format_csv_block call")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = rng.gamma(2., 50., size=(args.ntimes, len(ngen_variables), args.ncatchments)).astype(np.float32)
+    data[:, :, ::97] = np.nan
+    t_ax = [str(x) for x in pd.date_range("2024-01-01", periods=args.ntimes, freq="h")]
+
+    t0 = time.perf_counter()
+    reference = pandas_csv(data, t_ax)
+    t_pandas = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    rendered = []
+    for jstart in range(0, args.ncatchments, args.block):
+        rendered.extend(format_csv_block(data[:,:,jstart:jstart + args.block], t_ax, ngen_variables))
+    t_block = time.perf_counter() - t0
+
+    assert rendered == reference, "format_csv_block output differs from pandas"
+    nbytes = sum([len(x) for x in reference])
+    print(f"{args.ncatchments} catchments x {args.ntimes} times, {nbytes / 1048576:.1f} MB of csv")
+    print(f"pandas           : {t_pandas:.2f}s {args.ncatchments / t_pandas:.0f} catchments/s")
+    print(f"format_csv_block : {t_block:.2f}s {args.ncatchments / t_block:.0f} catchments/s")
+    print(f"speedup          : {t_pandas / t_block:.2f}x, output identical")
@@ -0,0 +1,54 @@
+"""
+Compare the sparse and numba regrid engines on a synthetic weights matrix, in catchments per second per core
+
+python benchmarks/bench_regrid.py --ncatchments 100000 --cells 30 --nfiles 4 --threads 1 4
+"""
+import argparse, time
+import numpy as np
+from scipy import sparse
+from forcingprocessor.processor import catchment_values_sparse
+from forcingprocessor.kernels import catchment_values_numba, gather_kernel, set_kernel_threads
+
+def make_weights(ncatchments, ncells_catchment, dx, dy, rng):
+    # catchments tile the window, each covering cells near its own centre like real hydrofabric
+    ncells = rng.integers(1, 2 * ncells_catchment, size=ncatchments)
+    centres = np.linspace(0, dx * dy - 1, ncatchments).astype(np.int64)
+    rows = np.repeat(np.arange(ncatchments), ncells)
+    offsets = rng.integers(-2, 3, size=len(rows)) + dx * rng.integers(-2, 3, size=len(rows))
+    cols = np.clip(np.repeat(centres, ncells) + offsets, 0, dx * dy - 1)
+    weights = sparse.csr_matrix((rng.uniform(0.01, 1., size=len(rows)), (rows, cols)), shape=(ncatchments, dx * dy))
+    return sparse.diags(1. / np.asarray(weights.sum(axis=1)).ravel()) @ weights
+
+def bench(fn, nrepeat):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(nrepeat): fn()
+    return (time.perf_counter() - t0) / nrepeat
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncatchments", type=int, default=100000)
+    parser.add_argument("--cells", type=int, default=30, help="mean cells per catchment")
+    parser.add_argument("--nfiles", type=int, default=4, help="files reduced per call, as with batch_size")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--nrepeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    dx = dy = int(np.sqrt(args.ncatchments * args.cells))
+    weights_mat = make_weights(args.ncatchments, args.cells, dx, dy, rng).tocsr()
+    data = rng.normal(size=(args.nfiles * 9, dx * dy)).astype(np.float32)
+    gather_kernel()
+
+    print(f"{args.ncatchments} catchments, {weights_mat.nnz} weights, {args.nfiles} files x 9 variables over {dx} x {dy} cells")
+    np.testing.assert_allclose(catchment_values_numba(data, weights_mat), catchment_values_sparse(data, weights_mat), rtol=1e-4, atol=1e-5)
+    t_sparse = bench(lambda: catchment_values_sparse(data, weights_mat), args.nrepeat)
+    print(f"sparse           : {t_sparse:.3f}s {args.nfiles * args.ncatchments / t_sparse:.0f} catchments/s per core")
+    for nthreads in args.threads:
+        set_kernel_threads(nthreads)
+        t_numba = bench(lambda: catchment_values_numba(data, weights_mat), args.nrepeat)
+        print(f"numba {nthreads:2d} threads : {t_numba:.3f}s {args.nfiles * args.ncatchments / t_numba / nthreads:.0f} catchments/s per core")
+
+    # with masked cells the numba engine renormalizes while the sparse engine returns nan
+    data[:, ::50] = np.nan
+    print(f"nan catchments with 2% of cells masked: sparse {np.isnan(catchment_values_sparse(data, weights_mat)).mean():.1%}, numba {np.isnan(catchment_values_numba(data, weights_mat)).mean():.1%}")
@@ -0,0 +1,106 @@
+import gzip, time
+import concurrent.futures as cf
+from collections import deque
+
+B2MB = 1048576
+
+# File extension of the forcing archives of each codec
+archive_extensions = {"gzip" : "tar.gz", "zstd" : "tar.zst"}
+# Default compression level of each codec, gzip matches tarfile
+archive_levels = {"gzip" : 9, "zstd" : 3}
+
+def compress_block(block, codec, level):
+    """
+    Compress bytes into one self contained gzip member or zstd frame. Members and frames can be
+    concatenated, gzip and zstd decompress the result as a single stream.
+
+    block : bytes to compress
+    codec : "gzip" or "zstd"
+    level : compression level
+    """
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compress(block)
+    return gzip.compress(block, compresslevel=level, mtime=0)
+
+def end_of_archive(tar_size, codec, level):
+    """
+    Compressed end of archive blocks of a tar holding tar_size bytes of members, padded to the
+    record size as tarfile pads it
+    """
+    import tarfile
+    tar_size += 2 * tarfile.BLOCKSIZE
+    return compress_block(tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-tar_size % tarfile.RECORDSIZE)), codec, level)
+
+class ShardWriter:
+    """
+    Writes a compressed shard of a tar archive as a series of independently compressed blocks,
+    pigz style. With threads > 1, filled blocks are compressed by a thread pool while the caller
+    keeps producing, zlib and zstd release the GIL. Shards of one archive are concatenated
+    without recompressing.
+
+    path     : local path of the shard
+    codec    : "gzip" or "zstd"
+    level    : compression level
+    threads  : number of compression threads
+    block_MB : uncompressed size of each block
+    """
+    def __init__(self, path, codec="gzip", level=9, threads=1, block_MB=4):
+        self.file = open(path, 'wb')
+        self.codec = codec
+        self.level = level
+        self.block_size = int(block_MB * B2MB)
+        self.buffer = []
+        self.nbuffer = 0
+        self.pool = cf.ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.max_pending = 2 * threads
+        self.futures = deque()
+        self.nbytes = 0
+        self.ncompressed = 0
+        self.tcompress = 0
+
+    def _compress(self, block):
+        t0 = time.perf_counter()
+        compressed = compress_block(block, self.codec, self.level)
+        return compressed, time.perf_counter() - t0
+
+    def _collect(self, result):
+        compressed, secs = result
+        self.file.write(compressed)
+        self.ncompressed += len(compressed)
+        self.tcompress += secs
+
+    def _submit(self):
+        if self.nbuffer == 0: return
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.nbuffer = 0
+        if self.pool is None:
+            self._collect(self._compress(block))
+            return
+        # blocks are written in submission order, so at most max_pending are held
+        while len(self.futures) >= self.max_pending:
+            self._collect(self.futures.popleft().result())
+        self.futures.append(self.pool.submit(self._compress, block))
+
+    def write(self, data):
+        """
+        Append bytes to the shard
+        """
+        self.buffer.append(data)
+        self.nbuffer += len(data)
+        self.nbytes += len(data)
+        if self.nbuffer >= self.block_size: self._submit()
+
+    def close(self):
+        """
+        Compress the remaining bytes and close the shard
+
+        returns : uncompressed bytes, compressed bytes, seconds spent compressing summed over threads
+        """
+        self._submit()
+        while self.futures:
+            self._collect(self.futures.popleft().result())
+        if self.pool is not None: self.pool.shutdown()
+        self.file.close()
+        return self.nbytes, self.ncompressed, self.tcompress
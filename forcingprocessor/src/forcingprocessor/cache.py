@@ -0,0 +1,120 @@
+import hashlib, os, tempfile, time, threading
+import requests
+
+# Configured with configure_cache, or through the environment for standalone scripts
+cache_dir     = os.environ.get("FP_CACHE_DIR", None)
+cache_size_GB = float(os.environ.get("FP_CACHE_SIZE_GB", 20))
+cache_hits    = 0
+cache_misses  = 0
+# counters are shared by the I/O threads of a process
+stats_lock    = threading.Lock()
+
+# Entries used more recently than this are never evicted, another process may be reading them
+EVICT_GRACE_S = 300
+B2GB = 1073741824
+
+def configure_cache(path, size_GB=20):
+    """
+    Enable the local NWM file cache
+
+    path    : directory to hold cached files, None disables the cache
+    size_GB : size limit of the cache, least recently used files are evicted beyond it
+    """
+    global cache_dir, cache_size_GB
+    cache_dir = path
+    cache_size_GB = size_GB
+    if cache_dir is not None: os.makedirs(cache_dir, exist_ok=True)
+
+def cache_enabled():
+    return cache_dir is not None
+
+def cache_stats():
+    """
+    Returns the hits and misses of this process
+    """
+    return cache_hits, cache_misses
+
+def remote_version(url, fs=None, bucket_key=None):
+    """
+    ETag of a remote file, or its size if the store does not report one
+
+    url        : url of the file
+    fs         : an optional s3fs or gcsfs file system
+    bucket_key : key of the file on fs
+    """
+    if fs:
+        info = fs.info(bucket_key)
+        return str(info.get('ETag', info.get('etag', info.get('size'))))
+    response = requests.head(url, allow_redirects=True)
+    if response.status_code != 200:
+        raise Exception(f"{url} does not exist")
+    return str(response.headers.get('ETag', response.headers.get('Content-Length')))
+
+def cache_path(url, version):
+    key = hashlib.sha256(f"{url}|{version}".encode()).hexdigest()
+    return os.path.join(cache_dir, key)
+
+def fetch_cached(url, fs=None, bucket_key=None):
+    """
+    Returns a local path to the remote file and whether it was a hit, downloading it into the cache on a miss.
+    Writes go to a temporary file that is renamed into place, so concurrent processes
+    fetching the same file never see a partial entry.
+
+    url        : url of the file
+    fs         : an optional s3fs or gcsfs file system
+    bucket_key : key of the file on fs
+    """
+    global cache_hits, cache_misses
+    path = cache_path(url, remote_version(url, fs, bucket_key))
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+            with stats_lock: cache_hits += 1
+            return path, True
+        except FileNotFoundError:
+            pass
+
+    with stats_lock: cache_misses += 1
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            if fs:
+                with fs.open(bucket_key, mode='rb') as remote:
+                    while True:
+                        block = remote.read(8 * 1048576)
+                        if not block: break
+                        fp.write(block)
+            else:
+                with requests.get(url, stream=True) as response:
+                    if response.status_code != 200:
+                        raise Exception(f"{url} does not exist")
+                    for block in response.iter_content(chunk_size=1048576):
+                        fp.write(block)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    evict()
+    return path, False
+
+def evict():
+    """
+    Remove least recently used entries until the cache fits within cache_size_GB
+    """
+    entries = []
+    for jfile in os.listdir(cache_dir):
+        if jfile.endswith('.tmp'): continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, jfile))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, jfile))
+    total = sum([x[1] for x in entries])
+    now = time.time()
+    for mtime, size, jfile in sorted(entries):
+        if total <= cache_size_GB * B2GB: break
+        if now - mtime < EVICT_GRACE_S: break
+        try:
+            os.remove(os.path.join(cache_dir, jfile))
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,76 @@
+import numpy as np
+
+# Compiled kernels, built on first use so numba stays optional
+_kernels = {}
+
+def gather_kernel():
+    """
+    Compile the kernels of catchment_values_numba, requires `pip install forcingprocessor[numba]`
+
+    returns : transpose, gather
+    """
+    if "gather" not in _kernels:
+        import numba
+        # the worker pool forks, tbb can hang the exit of a process that forked after launching
+        # its threads and GNU OpenMP crashes forked children, so the fork safe workqueue layer is used.
+        # Each process still runs regrid_threads kernel threads, see set_kernel_threads
+        if numba.config.THREADING_LAYER == "default": numba.config.THREADING_LAYER = "workqueue"
+
+        @numba.njit(parallel=True, cache=True)
+        def transpose(data, out):
+            # blocks of cells, so each thread reads whole cache lines of every row
+            nrow, ncell = data.shape
+            for jblock in numba.prange((ncell + 255) // 256):
+                start = jblock * 256
+                end = min(start + 256, ncell)
+                for jrow in range(nrow):
+                    for jcell in range(start, end):
+                        out[jcell, jrow] = data[jrow, jcell]
+
+        @numba.njit(parallel=True, cache=True)
+        def gather(data_cells, indptr, indices, weights, out):
+            nrow = data_cells.shape[1]
+            for jcatch in numba.prange(len(indptr) - 1):
+                total = np.zeros(nrow)
+                coverage = np.zeros(nrow)
+                for k in range(indptr[jcatch], indptr[jcatch + 1]):
+                    weight = weights[k]
+                    cell = indices[k]
+                    for jrow in range(nrow):
+                        value = data_cells[cell, jrow]
+                        if not np.isnan(value):
+                            total[jrow] += weight * value
+                            coverage[jrow] += weight
+                for jrow in range(nrow):
+                    out[jrow, jcatch] = total[jrow] / coverage[jrow] if coverage[jrow] > 0 else np.nan
+
+        _kernels["gather"] = (transpose, gather)
+    return _kernels["gather"]
+
+def set_kernel_threads(nthreads):
+    """
+    Number of threads the compiled kernels run on in this process, capped at the numba thread pool size
+    """
+    import numba
+    numba.set_num_threads(max(1, min(nthreads, numba.config.NUMBA_NUM_THREADS)))
+
+def catchment_values_numba(data_allvars, weights_mat):
+    """
+    Reduce a windowed grid to catchment values with a compiled gather over the CSR weights, parallel over
+    catchments. Nan cells (masked fill values) are skipped and the coverage of the remaining cells is
+    renormalized, a catchment without a valid cell is nan. The grid is first copied cell major.
+
+    Parameters:
+        data_allvars (numpy.ndarray): 2D array (forcing_variable x window cell).
+        weights_mat (scipy.sparse.csr_matrix): weights from build_weights_matrix.
+
+    Returns:
+        data_array (numpy.ndarray): 2D array (forcing_variable x catchment).
+    """
+    transpose, gather = gather_kernel()
+    # cell major, so the values of every variable under a weight are read together
+    data_cells = np.empty((data_allvars.shape[1], data_allvars.shape[0]), dtype=np.float32)
+    transpose(data_allvars, data_cells)
+    data_array = np.empty((data_allvars.shape[0], weights_mat.shape[0]), dtype=np.float32)
+    gather(data_cells, weights_mat.indptr, weights_mat.indices, weights_mat.data, data_array)
+    return data_array
@@ -0,0 +1,333 @@
+import zlib, json, os, hashlib, tempfile, threading
+import numpy as np
+import fsspec
+import h5py
+import netCDF4 as nc
+
+# HDF5 filter identifiers
+H5Z_FILTER_DEFLATE    = 1
+H5Z_FILTER_SHUFFLE    = 2
+H5Z_FILTER_FLETCHER32 = 3
+
+# Block size used for the HDF5 metadata (superblock, object headers, chunk b-trees) reads
+METADATA_BLOCK_SIZE = 262144
+
+# netCDF4 and h5py share the HDF5 library, which is not thread safe. h5py serializes its own calls only,
+# so every HDF5 access of a process, through either, goes through this lock
+hdf5_lock = threading.Lock()
+
+def get_range_fs(nwm_file, fs=None):
+    """
+    Returns a file system and path that support byte-range reads of an NWM file
+
+    nwm_file : url, bucket key or local path of the NWM file
+    fs       : an optional s3fs or gcsfs file system, nwm_file is then a bucket key
+    """
+    if fs:
+        return fs, nwm_file
+    if nwm_file.startswith('https://') or nwm_file.startswith('http://'):
+        return fsspec.filesystem('https'), nwm_file
+    return fsspec.filesystem('file'), nwm_file
+
+def json_safe(value):
+    """
+    Convert an HDF5 attribute value to something json serializable
+    """
+    if isinstance(value, bytes): return value.decode()
+    if hasattr(value, 'tolist'): return value.tolist()
+    return value
+
+def chunk_index(dset):
+    """
+    Parse the chunk index of an HDF5 dataset
+
+    dset : h5py dataset
+
+    returns : dictionary describing the dataset layout, filters, decoding attributes and chunk locations
+    """
+    plist = dset.id.get_create_plist()
+    filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+    chunks = []
+    for i in range(dset.id.get_num_chunks()):
+        info = dset.id.get_chunk_info(i)
+        chunks.append([list(info.chunk_offset), int(info.byte_offset), int(info.size), int(info.filter_mask)])
+    attrs = {}
+    for jattr in ["_FillValue", "missing_value", "scale_factor", "add_offset"]:
+        if jattr in dset.attrs:
+            attrs[jattr] = float(np.asarray(dset.attrs[jattr]).ravel()[0])
+    return {
+        "shape"   : list(dset.shape),
+        "chunks"  : list(dset.chunks) if dset.chunks else list(dset.shape),
+        "dtype"   : dset.dtype.str,
+        "filters" : filters,
+        "attrs"   : attrs,
+        "index"   : chunks
+    }
+
+def decode_chunk(raw, var_index, filter_mask=0):
+    """
+    Undo the HDF5 filter pipeline on a raw chunk
+
+    raw         : compressed chunk bytes
+    var_index   : dictionary returned by chunk_index
+    filter_mask : bit j set means filter j was skipped for this chunk
+    """
+    dtype = np.dtype(var_index["dtype"])
+    buf = raw
+    for j in reversed(range(len(var_index["filters"]))):
+        if filter_mask & (1 << j): continue
+        jfilter = var_index["filters"][j]
+        if jfilter == H5Z_FILTER_DEFLATE:
+            buf = zlib.decompress(buf)
+        elif jfilter == H5Z_FILTER_SHUFFLE:
+            shuffled = np.frombuffer(buf, dtype=np.uint8)
+            buf = shuffled.reshape(dtype.itemsize, -1).T.tobytes()
+        elif jfilter == H5Z_FILTER_FLETCHER32:
+            buf = buf[:-4]
+        else:
+            raise NotImplementedError(f'HDF5 filter {jfilter} is not supported')
+    return np.frombuffer(buf, dtype=dtype).reshape(var_index["chunks"])
+
+def window_slices(var_index, window):
+    """
+    (y, x) slices of a window in file orientation, the NWM y axis runs south to north
+    """
+    x_min, x_max, y_min, y_max = window
+    ny = var_index["shape"][1]
+    return slice(ny - (y_max + 1), ny - y_min), slice(x_min, x_max + 1)
+
+def window_chunks(var_index, y_slice, x_slice):
+    """
+    Chunks of a (time, y, x) variable that intersect the window
+    """
+    _, cy, cx = var_index["chunks"]
+    return [jchunk for jchunk in var_index["index"]
+            if jchunk[0][1] < y_slice.stop and jchunk[0][1] + cy > y_slice.start
+            and jchunk[0][2] < x_slice.stop and jchunk[0][2] + cx > x_slice.start]
+
+def chunks_touched(shape, chunks, windows):
+    """
+    Number of chunks of a (..., y, x) variable that intersect any of the windows, without a chunk index
+
+    shape   : shape of the variable
+    chunks  : chunk shape of the variable
+    windows : list of (x_min, x_max, y_min, y_max)
+    """
+    ny = shape[-2]
+    cy, cx = chunks[-2:]
+    touched = set()
+    for x_min, x_max, y_min, y_max in windows:
+        y0, y1 = ny - (y_max + 1), ny - y_min
+        touched.update([(jy, jx) for jy in range(y0 // cy, (y1 - 1) // cy + 1) for jx in range(x_min // cx, x_max // cx + 1)])
+    return len(touched)
+
+class CellMask:
+    """
+    Grid cells referenced by the weights and, per chunk layout, the chunks they fall in. Chunks of a
+    window that hold no referenced cell are neither fetched nor decoded.
+
+    x, y : NWM grid (x, y) of each referenced cell, as in the weights cell ids
+    """
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype=np.int64)
+        self.y = np.asarray(y, dtype=np.int64)
+        self.layouts = {}
+
+    def chunks(self, ny, cy, cx):
+        """
+        Set of (y, x) chunk grid indices, in file orientation, holding a referenced cell
+        """
+        key = (ny, cy, cx)
+        if key not in self.layouts:
+            jchunks = np.unique(((ny - 1 - self.y) // cy) * (2**31) + self.x // cx)
+            self.layouts[key] = set(zip((jchunks // 2**31).tolist(), (jchunks % 2**31).tolist()))
+        return self.layouts[key]
+
+def decode_values(out, attrs):
+    """
+    Mask fill values to nan and apply scale_factor and add_offset in place, as xarray would
+
+    out   : float array of raw values
+    attrs : variable attributes
+    """
+    fill_value = attrs.get("_FillValue", attrs.get("missing_value"))
+    if fill_value is not None:
+        out[out == np.float32(fill_value)] = np.nan
+    if "scale_factor" in attrs: out *= attrs["scale_factor"]
+    if "add_offset" in attrs: out += attrs["add_offset"]
+
+def place_chunks(out, var_index, chunks, decoded, y_slice, x_slice):
+    """
+    Place the part of each decoded chunk that falls within the window into out, applying
+    the same masking and scaling xarray would.
+
+    out     : 2D array (y x) to fill, in file orientation
+    decoded : decoded (y x) array of each chunk
+    """
+    out[:] = np.nan
+    _, cy, cx = var_index["chunks"]
+    for jchunk, data in zip(chunks, decoded):
+        (_, y0, x0), _, _, _ = jchunk
+        ys = slice(max(y0, y_slice.start), min(y0 + cy, y_slice.stop))
+        xs = slice(max(x0, x_slice.start), min(x0 + cx, x_slice.stop))
+        out[ys.start - y_slice.start:ys.stop - y_slice.start, xs.start - x_slice.start:xs.stop - x_slice.start] = \
+            data[ys.start - y0:ys.stop - y0, xs.start - x0:xs.stop - x0]
+    decode_values(out, var_index["attrs"])
+
+def read_window_chunks(range_fs, path, var_indices, variables, windows, outs, mask=None):
+    """
+    Fetch and decode the chunks of each variable that intersect the windows. A chunk shared by
+    several windows is fetched and decoded once. With a mask, chunks without a referenced cell
+    are skipped and their part of the windows is left nan.
+
+    range_fs    : file system that supports cat_ranges
+    path        : path of the NWM file on range_fs
+    var_indices : dictionary of chunk_index per NWM variable
+    variables   : list of NWM variables, repeats are allowed
+    windows     : list of (x_min, x_max, y_min, y_max) as returned by get_windows
+    outs        : 3D array (forcing_variable x south_north x west_east) per window to fill, flipped north up
+    mask        : optional CellMask
+
+    returns : bytes transferred, bytes decoded
+    """
+    nbytes = 0
+    ndecoded = 0
+    for var_dx, jvar in enumerate(variables):
+        var_index = var_indices[jvar]
+        slices = [window_slices(var_index, jwindow) for jwindow in windows]
+        window_chunk_lists = [window_chunks(var_index, *jslices) for jslices in slices]
+        if mask is not None:
+            _, cy, cx = var_index["chunks"]
+            occupied = mask.chunks(var_index["shape"][1], cy, cx)
+            window_chunk_lists = [[x for x in jchunk_list if (x[0][1] // cy, x[0][2] // cx) in occupied] for jchunk_list in window_chunk_lists]
+        chunks = list({jchunk[1] : jchunk for jchunk_list in window_chunk_lists for jchunk in jchunk_list}.values())
+        if len(chunks) > 0:
+            raws = range_fs.cat_ranges([path] * len(chunks), [x[1] for x in chunks], [x[1] + x[2] for x in chunks])
+        else:
+            raws = []
+        nbytes += sum([x[2] for x in chunks])
+        decoded = {jchunk[1] : decode_chunk(raw, var_index, jchunk[3])[0] for jchunk, raw in zip(chunks, raws)}
+        ndecoded += sum([x.nbytes for x in decoded.values()])
+        for jout, jslices, jchunk_list in zip(outs, slices, window_chunk_lists):
+            place_chunks(jout[var_dx], var_index, jchunk_list, [decoded[x[1]] for x in jchunk_list], *jslices)
+            jout[var_dx] = np.flip(jout[var_dx], axis=0)
+    return nbytes, ndecoded
+
+def read_nc_window(file_obj, variables, windows, outs):
+    """
+    Read the windows of each variable from a whole NWM file with the netCDF library, decoding
+    only the hyperslab under each window. Also reads netCDF3 files, which have no chunk index.
+
+    file_obj  : local path, or a file-like object holding the whole file
+    variables : list of NWM variables
+    windows   : list of (x_min, x_max, y_min, y_max) as returned by get_windows
+    outs      : 3D array (forcing_variable x south_north x west_east) per window to fill, flipped north up
+
+    returns : global attributes, bytes of the chunks decoded
+    """
+    if not isinstance(file_obj, (str, os.PathLike)):
+        file_obj.seek(0)
+        file_obj = file_obj.read()
+    # files are read on the I/O threads of read_nwm_file
+    with hdf5_lock:
+        if isinstance(file_obj, (str, os.PathLike)):
+            ds = nc.Dataset(file_obj, 'r')
+        else:
+            ds = nc.Dataset('nwm', 'r', memory=file_obj)
+        with ds:
+            attrs = {k : ds.getncattr(k) for k in ds.ncattrs()}
+            ndecoded = 0
+            for var_dx, jvar in enumerate(variables):
+                var = ds[jvar]
+                var.set_auto_maskandscale(False)
+                var_attrs = {k : float(np.asarray(var.getncattr(k)).ravel()[0]) for k in ["_FillValue", "missing_value", "scale_factor", "add_offset"] if k in var.ncattrs()}
+                ny = var.shape[-2]
+                for jout, (x_min, x_max, y_min, y_max) in zip(outs, windows):
+                    raw = var[..., ny - (y_max + 1):ny - y_min, x_min:x_max + 1]
+                    jout[var_dx] = np.flip(raw.reshape(raw.shape[-2:]), axis=0)
+                    decode_values(jout[var_dx], var_attrs)
+                chunks = var.chunking()
+                if not isinstance(chunks, list): chunks = var.shape
+                ndecoded += chunks_touched(var.shape, chunks, windows) * int(np.prod(chunks)) * var.dtype.itemsize
+    return attrs, ndecoded
+
+def build_reference(nwm_file, fs, variables):
+    """
+    Build the reference of an NWM file, the chunk index of each variable along with the global attributes,
+    so that chunks can later be read without opening the file
+
+    nwm_file  : url, bucket key or local path of the NWM file
+    fs        : an optional s3fs or gcsfs file system
+    variables : list of NWM variables to index
+
+    returns : reference dictionary, bytes transferred
+    """
+    range_fs, path = get_range_fs(nwm_file, fs)
+    with range_fs.open(path, mode='rb', block_size=METADATA_BLOCK_SIZE, cache_type='blockcache') as fp:
+        file_size = fp.size
+        with hdf5_lock, h5py.File(fp, 'r') as h5:
+            attrs = {k : json_safe(v) for k, v in h5.attrs.items() if not k.startswith('_')}
+            var_indices = {jvar : chunk_index(h5[jvar]) for jvar in dict.fromkeys(variables)}
+        # local files are read directly and have no cache to account metadata reads
+        nbytes = getattr(getattr(fp, 'cache', None), 'total_requested_bytes', 0)
+    reference = {
+        "file"      : nwm_file,
+        "size"      : int(file_size),
+        "attrs"     : attrs,
+        "variables" : var_indices
+    }
+    return reference, nbytes
+
+def load_reference(nwm_file, fs, variables, reference_dir):
+    """
+    Load the reference of an NWM file from the local reference directory, building and caching it if needed.
+    NWM files are assumed to be immutable once published, so references are keyed by file name alone.
+
+    returns : reference dictionary
+    """
+    key = hashlib.sha256(nwm_file.encode()).hexdigest()
+    reference_file = os.path.join(reference_dir, f"{key}.json")
+    if os.path.exists(reference_file):
+        with open(reference_file, 'r') as fp:
+            reference = json.load(fp)
+        if all([jvar in reference["variables"] for jvar in variables]):
+            return reference
+    reference, _ = build_reference(nwm_file, fs, variables)
+    os.makedirs(reference_dir, exist_ok=True)
+    # write then rename so concurrent runs never read a partial reference
+    fd, tmp_file = tempfile.mkstemp(dir=reference_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(reference, fp)
+    os.replace(tmp_file, reference_file)
+    return reference
+
+def read_nwm_window(nwm_file, fs, variables, windows, outs, reference=None, mask=None):
+    """
+    Read windows of NWM forcing variables by fetching only the compressed chunks that intersect them
+
+    nwm_file  : url, bucket key or local path of the NWM file
+    fs        : an optional s3fs or gcsfs file system
+    variables : list of NWM variables, repeats are allowed
+    windows   : (x_min, x_max, y_min, y_max) as returned by get_window, or a list of windows from get_windows
+    outs      : 3D array (forcing_variable x south_north x west_east) to fill, flipped north up, one per window
+    reference : optional reference from load_reference, the file is then not opened
+    mask      : optional CellMask, only chunks holding a referenced cell are read
+
+    returns : attrs, file_size, nbytes, ndecoded
+    attrs     : global attributes of the NWM file
+    file_size : size of the NWM file in bytes
+    nbytes    : bytes transferred to read the windows
+    ndecoded  : bytes of decompressed chunks
+    """
+    if np.ndim(windows) == 1:
+        windows = [windows]
+        outs = [outs]
+    range_fs, path = get_range_fs(nwm_file, fs)
+    if reference is None:
+        reference, nbytes = build_reference(nwm_file, fs, variables)
+    else:
+        nbytes = 0
+    nchunk_bytes, ndecoded = read_window_chunks(range_fs, path, reference["variables"], variables, windows, outs, mask)
+    nbytes += nchunk_bytes
+
+    return reference["attrs"], reference["size"], nbytes, ndecoded
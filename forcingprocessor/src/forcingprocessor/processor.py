@@ -5,68 +5,305 @@ import s3fs
 import gcsfs
 from pathlib import Path
 import numpy as np
-import xarray as xr
 import time
 import boto3
-from io import BytesIO, TextIOWrapper
+from io import BytesIO
 import concurrent.futures as cf
+from collections import deque
+from itertools import islice
+from multiprocessing import shared_memory, resource_tracker
 from datetime import datetime
 import gzip
-import tarfile, tempfile
+import tarfile, tempfile, shutil
 from forcingprocessor.weights_hf2ds import multiprocess_hf2ds
 from forcingprocessor.plot_forcings import plot_ngen_forcings
-from forcingprocessor.utils import get_window, log_time, convert_url2key, report_usage, nwm_variables, ngen_variables
+import forcingprocessor.cache as cache
+from forcingprocessor.cache import configure_cache, cache_enabled, cache_stats, fetch_cached
+from forcingprocessor.uploader import get_uploader
+from forcingprocessor.kernels import catchment_values_numba, set_kernel_threads
+from forcingprocessor.archive import ShardWriter, end_of_archive, archive_extensions, archive_levels
+from forcingprocessor.nwm_reader import read_nwm_window, read_nc_window, load_reference, CellMask
+from forcingprocessor.utils import NWM_NX, NWM_NY, get_window, get_windows, weights_cells, window_cells, window_offsets, shard_weights, window_views, mosaic_windows, build_weights_matrix, calc_weights_key, write_compiled_weights, load_compiled_weights, map_weights_arrays, format_csv_block, catchment_stats, catchment_stat_names, log_time, log_duration, convert_url2key, report_usage, read_plan, variable_map, ngen_variables
 
 B2MB = 1048576
+B2GB = 1073741824
+# Memory bound on the rendering buffers of a block of csv files, see format_csv_block
+CSV_BLOCK_MB = 64
+
+# Module state every worker needs, copied into the persistent pool by init_worker
+WORKER_GLOBALS = [
+    "ii_verbose", "nprocs", "regrid_engine", "regrid_threads", "batch_size", "batch_memory_MB", "read_mode",
+    "prefetch_depth", "prefetch_memory_MB", "io_threads", "task_files", "task_catchments",
+    "ii_plot", "nts_plot", "ngen_vars_plot", "output_path", "output_file_type", "storage_type",
+    "forcing_path", "fs_type", "weights_df", "weights_mat", "windows",
+    "nwm_references", "netcdf_time", "netcdf_ids", "netcdf_chunks", "netcdf_zlib", "netcdf_complevel",
+    "netcdf_shuffle", "zarr_chunks", "parquet_row_group_catchments", "parquet_compression", "upload_kwargs",
+    "tar_compression", "tar_complevel", "tar_threads", "ii_collect_stats", "chunk_sparse",
+    "ngen_variables", "nwm_sources", "fan_out"
+]
+worker_pool = None
+# Forcing cubes this process created and has not unlinked, by shared memory name
+owned_cubes = {}
+# Cells referenced by the weights, built by each process on first use
+cell_mask = None
+
+def init_worker(state, weights_artifact=None, cache_conf=(None, 20)):
+    """
+    Initializer of the persistent worker pool, loads the config, window and weights once per worker
+
+    state            : dictionary of module globals, see WORKER_GLOBALS
+    weights_artifact : optional (array_dir, shape) of the compiled weights the primary process loaded,
+                       memory mapped instead of copied into each worker
+    cache_conf       : (cache_dir, cache_size_GB) of the NWM file cache
+    """
+    globals().update(state)
+    if weights_artifact is not None:
+        global weights_mat
+        weights_mat = map_weights_arrays(*weights_artifact)[0]
+    if cache_conf[0] is not None: configure_cache(*cache_conf)
+
+def worker_ready():
+    return os.getpid()
+
+def start_worker_pool(nprocs, weights_artifact=None):
+    """
+    Create the process pool shared by the extract, netcdf, write and tar stages and wait for every
+    worker to be initialized, so process launch and imports are paid once and outside of the stages.
+
+    returns : the pool
+    """
+    # workers must share the primary process's resource tracker, otherwise each starts its own
+    # when attaching to a forcing cube and unlinks the cube when the worker exits
+    resource_tracker.ensure_running()
+    state = {k : globals()[k] for k in WORKER_GLOBALS if k in globals()}
+    if weights_artifact is not None:
+        state.pop("weights_mat", None)
+        # a recompile by another run removes the arrays this run loaded
+        if not os.path.isdir(weights_artifact[0]):
+            raise FileNotFoundError(f'Compiled weights {weights_artifact[0]} were replaced by another run, rerun to load the new artifact')
+    pool = cf.ProcessPoolExecutor(
+        max_workers=nprocs,
+        initializer=init_worker,
+        initargs=(state, weights_artifact, (cache.cache_dir, cache.cache_size_GB))
+        )
+    futures = [pool.submit(worker_ready) for x in range(nprocs)]
+    try:
+        [x.result() for x in futures]
+    except cf.process.BrokenProcessPool as e:
+        pool.shutdown(wait=False, cancel_futures=True)
+        if weights_artifact is None: raise
+        raise RuntimeError(f'Workers could not map the compiled weights {weights_artifact[0]}, they may have been replaced by another run') from e
+    return pool
+
+def make_tasks(nitems, task_size=None):
+    """
+    Split items into contiguous tasks that idle processes pull from a shared queue
+
+    nitems    : number of items
+    task_size : items per task, defaults to roughly four tasks per process so that
+                processes slowed by stragglers (slow reads, retried files) simply take fewer tasks
+
+    returns : list of (start, end) item ranges
+    """
+    if not task_size:
+        task_size = int(np.ceil(nitems / (4 * nprocs)))
+    task_size = max(1, task_size)
+    return [(start, min(start + task_size, nitems)) for start in range(0, nitems, task_size)]
+
+def timed_task(fn, *args):
+    """
+    Run a task, returning its result, duration in seconds, the process that ran it and when it started
+    """
+    tstart = time.time()
+    t0 = time.perf_counter()
+    results = fn(*args)
+    return results, time.perf_counter() - t0, os.getpid(), tstart
+
+def schedule_tasks(fn, task_args, nprocs, label="tasks"):
+    """
+    Run fn over task_args on the persistent worker pool, or a pool for this call if none was started.
+    Processes take the next task as soon as they are idle, results are placed by task index so
+    completion order does not matter.
+
+    fn        : module level function to run
+    task_args : list of argument tuples, one per task
+    nprocs    : maximum number of processes
+
+    returns : results, durations, pids, startup
+    results   : list of fn outputs in task order
+    durations : list of task durations in seconds
+    pids      : list of the processes that ran each task
+    startup   : seconds from submission until the first task started
+    """
+    ntasks = len(task_args)
+    results   = [None] * ntasks
+    durations = [0.] * ntasks
+    pids      = [0] * ntasks
+    tstarts   = [0.] * ntasks
+    t0 = time.perf_counter()
+    tsubmit = time.time()
+    if worker_pool is None:
+        pool = cf.ProcessPoolExecutor(max_workers=max(1, min(nprocs, ntasks)))
+    else:
+        pool = worker_pool
+    try:
+        futures = {pool.submit(timed_task, fn, *args) : j for j, args in enumerate(task_args)}
+        for ncomplete, future in enumerate(cf.as_completed(futures)):
+            j = futures[future]
+            results[j], durations[j], pids[j], tstarts[j] = future.result()
+            if ii_verbose: 
+                print(f'{ncomplete + 1} of {ntasks} {label} complete, {time.perf_counter() - t0:.2f}s elapsed',flush=True)
+    finally:
+        if worker_pool is None: pool.shutdown()
+    startup = max(min(tstarts) - tsubmit, 0) if ntasks > 0 else 0
+    return results, durations, pids, startup
+
+def task_stats(durations, pids):
+    """
+    Summarize task durations and how evenly they were spread across processes
+
+    returns : mean task duration, max task duration, imbalance (busiest process time / mean process time)
+    """
+    if len(durations) == 0: return 0, 0, 0
+    busy = {}
+    for jpid, jduration in zip(pids, durations):
+        busy[jpid] = busy.get(jpid, 0) + jduration
+    busy = list(busy.values())
+    return np.average(durations), np.max(durations), np.max(busy) / np.average(busy)
+
+def create_cube(shape):
+    """
+    Allocate a float32 (time x forcing_variable x catchment) forcing cube in shared memory.
+    Processes attach to it by name with attach_cube, so no stage has to pickle forcing data.
+
+    Returns:
+        cube_shm (SharedMemory): The owning handle, close and unlink it once all stages are done.
+        cube (tuple): (shared memory name, shape), cheap to send to other processes.
+        data (numpy.ndarray): View of the cube.
+    """
+    cube_shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 4, 1))
+    owned_cubes[cube_shm.name] = cube_shm
+    data = np.ndarray(shape, dtype=np.float32, buffer=cube_shm.buf)
+    return cube_shm, (cube_shm.name, shape), data
 
-def distribute_work(items,nprocs):
+def attach_cube(cube):
     """
-    Distribute items evenly between processes, round robin
+    Attach to a forcing cube created by create_cube without copying it.
+
+    Returns:
+        cube_shm (SharedMemory): Close it once the view is no longer referenced.
+        data (numpy.ndarray): View of the cube.
     """
-    items_per_proc = [0 for x in range(nprocs)]
-    for j in range(len(items)):
-        k = j % nprocs
-        items_per_proc[k] = items_per_proc[k] + 1
-    return items_per_proc
+    cube_shm = shared_memory.SharedMemory(name=cube[0])
+    return cube_shm, np.ndarray(cube[1], dtype=np.float32, buffer=cube_shm.buf)
 
-def load_balance(items_per_proc,launch_delay,single_ex, exec_count):
+def release_cube(cube_shm, unlink=False):
     """
-    Python takes a couple seconds to launch a process so if this script is launched with 10's
-    of processes, it may not be optimal to distribute the work evenly.
-    This function minimizes projected processing time
+    Close a forcing cube handle, views of it must have been deleted
+    """
+    cube_shm.close()
+    if unlink:
+        cube_shm.unlink()
+        owned_cubes.pop(cube_shm.name, None)
 
-    items_per_proc : list of length number of processes with each element representing the number of items the process has been assigned
-    launch_delay   : time in seconds it takes python to launch the function
-    single_ex      : time in seconds it takes to process 1 item
-    exec_count     : number of items processed per execution
+def release_run_resources():
+    """
+    Shut down the worker pool and unlink every forcing cube this process still owns, after a run
+    that raised before its stages released them
+    """
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.shutdown(cancel_futures=True)
+        worker_pool = None
+    for jshm in list(owned_cubes.values()):
+        jshm.unlink()
+        owned_cubes.pop(jshm.name, None)
+        try:
+            jshm.close()
+        except BufferError:
+            # a view is still held by the traceback, the segment is freed once it is dropped
+            pass
+
+def estimate_memory_GB(nfiles, ncatchments, ncells, nweights):
+    """
+    Estimated peak memory of extracting and writing a set of catchments: the forcing cube plus, per worker,
+    the decoded window batch and prefetched files, a copy of the weights and the csv rendering buffers
 
+    nfiles      : number of NWM files
+    ncatchments : number of catchments
+    ncells      : cells of the windows read from each file, see window_offsets
+    nweights    : nonzero weights
     """
-    nprocs = len(items_per_proc)
-    nitems = np.sum(items_per_proc)
-    completion_time = [single_ex * x / exec_count + launch_delay*j for j, x in enumerate(items_per_proc)]
-    while True:        
-        if len(np.nonzero(items_per_proc)[0]) > 0: break
-        max_time = max(completion_time)
-        max_loc = completion_time.index(max_time)
-        min_time = min(completion_time)
-        min_loc = completion_time.index(min_time)
-        if max_time - min_time > single_ex:
-            items_per_proc[max_loc] -= 1
-            items_per_proc[min_loc] += 1
+    window = len(nwm_sources) * ncells * 4
+    nbatch = 1
+    if regrid_engine != "loop":
+        nbatch = max(1, min(batch_size, int(batch_memory_MB * B2MB // max(window, 1)), nfiles))
+    depth = 0
+    if prefetch_depth > 0 or io_threads > 0:
+        depth = max(1, min(max(prefetch_depth, io_threads), int(prefetch_memory_MB * B2MB // max(window, 1))))
+    # the numba engine holds a cell major copy of the batch
+    nwindows = nbatch * (2 if regrid_engine == "numba" else 1) + depth + 1
+    worker = nwindows * window + nweights * 12 + CSV_BLOCK_MB * B2MB
+    cube = nfiles * len(ngen_variables) * ncatchments * 4
+    return (cube + nprocs * worker) / B2GB
+
+def shard_windows(rows):
+    """
+    Weights and windows of the catchments at rows of weights_df
+
+    returns : weights_mat, windows, nonzero weights
+    """
+    if weights_mat is not None:
+        jweights_mat, jwindows = shard_weights(weights_mat, windows, rows)
+        return jweights_mat, jwindows, jweights_mat.nnz
+    jweights_df = weights_df.iloc[rows]
+    return None, [get_window(jweights_df)], sum([len(x) for x in jweights_df['cell_id']])
+
+def plan_shards(jcatchment_dict, nfiles, max_memory_GB):
+    """
+    Split the catchments into shards that are each extracted and written end to end within max_memory_GB.
+    Whole VPUs are grouped while they fit. A VPU over the budget is split by catchments when every output
+    is per catchment (csv, parquet, tar), otherwise it is processed whole.
+
+    jcatchment_dict : catchments of each VPU, in cube order
+    nfiles          : number of NWM files
+    max_memory_GB   : memory budget
+
+    returns : list of (catchments of each VPU, rows of the shard in weights_df, estimated GB)
+    """
+    def estimate(start, end):
+        _, jwindows, nweights = shard_windows(np.arange(start, end))
+        return estimate_memory_GB(nfiles, end - start, window_offsets(jwindows)[1], nweights)
+
+    ii_split = all([x in ["csv", "parquet", "tar"] for x in output_file_type])
+    # (vpu, start, end, start of the vpu) in cube order
+    pieces = []
+    i = 0
+    for jvpu, jcatchments in jcatchment_dict.items():
+        k = i + len(jcatchments)
+        bounds = [i, k]
+        while ii_split and len(bounds) - 1 < k - i and max([estimate(*x) for x in zip(bounds[:-1], bounds[1:])]) > max_memory_GB:
+            bounds = list(np.linspace(i, k, 2 * (len(bounds) - 1) + 1).astype(int))
+        if not ii_split and estimate(i, k) > max_memory_GB:
+            print(f'{jvpu} alone is estimated over max_memory_gb, its outputs are per VPU so it is processed whole')
+        pieces.extend([(jvpu, start, end, i) for start, end in zip(bounds[:-1], bounds[1:]) if end > start])
+        i = k
+
+    shards = []
+    for jpiece in pieces:
+        if shards and estimate(shards[-1][0][1], jpiece[2]) <= max_memory_GB:
+            shards[-1].append(jpiece)
         else:
-            break
-        completion_time = [single_ex * x / exec_count + launch_delay*j for j, x in enumerate(items_per_proc)]
-
-    completion_time = [single_ex * x / exec_count + j for j, x in enumerate(items_per_proc)]
-    global ntasked
-    ntasked = len(np.nonzero(items_per_proc)[0])
-    if nprocs > ntasked: 
-        if ii_verbose: print(f'Not enough work for {nprocs} requested processes, downsizing to {ntasked}')
-        nprocs = ntasked 
-        completion_time = completion_time[:ntasked]
-        items_per_proc = items_per_proc[:ntasked]
-    if ii_verbose: print(f'item distribution {items_per_proc}')
-    return items_per_proc
+            shards.append([jpiece])
+
+    plan = []
+    for jshard in shards:
+        jdict = {}
+        for jvpu, start, end, i in jshard:
+            jdict.setdefault(jvpu, []).extend(jcatchment_dict[jvpu][start - i:end - i])
+        start, end = jshard[0][1], jshard[-1][2]
+        plan.append((jdict, np.arange(start, end), estimate(start, end)))
+    return plan
 
 def multiprocess_data_extract(files : list, nprocs : int, weights_df : pd.DataFrame, fs):
     """
@@ -79,65 +316,69 @@ def multiprocess_data_extract(files : list, nprocs : int, weights_df : pd.DataFr
         fs (s3 filesystem): s3fs
 
     Returns:
-        data_array (numpy.ndarray): Concatenated array containing the extracted data.
+        cube_shm (SharedMemory): Shared memory holding the extracted data, see create_cube.
+        cube (tuple): (shared memory name, shape) of the extracted data.
+        data_array (numpy.ndarray): View of the extracted data (time x forcing_variable x catchment).
         t_ax_local (list): List of time axes corresponding to the extracted data.
+        nwm_data (numpy.ndarray): NWM data saved for plotting.
+        nwm_file_sizes_out (list): Size of each NWM file in MB.
+        nwm_transfer_out (list): MB transferred to read each NWM file.
+        nwm_decoded_out (list): MB of decompressed chunks of each NWM file.
+        cache_counts (tuple): NWM file cache hits and misses.
+        task_times (tuple): Per task durations in seconds, the process that ran each task and the pool startup time.
     """
-    launch_time     = 0.05
-    cycle_time      = 35
-    files_per_cycle = 1
-    files_per_proc  = distribute_work(files,nprocs)
-    files_per_proc  = load_balance(files_per_proc,launch_time,cycle_time,files_per_cycle)
-    nprocs          = len(files_per_proc)
-
-    start  = 0
     nfiles = len(files)
-    files_list = []
-    fs_list    = []
-    for i in range(nprocs):
-        end = min(start + files_per_proc[i],nfiles)
-        files_list.append(files[start:end])
-        fs_list.append(fs)
-        start = end
-
-    data_ax = []
-    t_ax_local = []
-    nwm_data = []
-    nwm_file_sizes = []
-    with cf.ProcessPoolExecutor(max_workers=nprocs) as pool:
-        for results in pool.map(
-        forcing_grid2catchment,
-        files_list,
-        fs_list
-        ):
-            data_ax.append(results[0])
-            t_ax_local.append(results[1])    
-            nwm_data.append(results[2])        
-            nwm_file_sizes.append(results[3])        
+    cube_shm, cube, data_array = create_cube((nfiles, len(ngen_variables), len(weights_df)))
+    tasks = make_tasks(nfiles, task_files)
+    task_args = [(files[start:end], fs, cube, start) for start, end in tasks]
+    if ii_verbose: print(f'Extracting {nfiles} files in {len(tasks)} tasks',flush=True)
+    try:
+        results, durations, pids, startup = schedule_tasks(forcing_grid2catchment, task_args, nprocs, "extract tasks")
+    except BaseException:
+        del data_array
+        release_cube(cube_shm, unlink=True)
+        raise
 
     print(f'Processes have returned')
     del weights_df
-    data_array = np.concatenate(data_ax)
-    t_ax_local = [item for sublist in t_ax_local for item in sublist]
-    nwm_file_sizes_out = [item for sublist in nwm_file_sizes for item in sublist]
-    nwm_data = np.concatenate(nwm_data)
+    t_ax_local = [item for jresults in results for item in jresults[1]]
+    nwm_data = [item for jresults in results for item in jresults[2]]
+    nwm_file_sizes_out = [item for jresults in results for item in jresults[3]]
+    nwm_transfer_out = [item for jresults in results for item in jresults[4]]
+    nwm_decoded_out = [item for jresults in results for item in jresults[6]]
+    cache_hits = sum([jresults[5][0] for jresults in results])
+    cache_misses = sum([jresults[5][1] for jresults in results])
+    nwm_data = np.array(nwm_data)
   
-    return data_array, t_ax_local, nwm_data, nwm_file_sizes_out
+    return cube_shm, cube, data_array, t_ax_local, nwm_data, nwm_file_sizes_out, nwm_transfer_out, nwm_decoded_out, (cache_hits, cache_misses), (durations, pids, startup)
 
-def forcing_grid2catchment(nwm_files: list, fs=None):
+def forcing_grid2catchment(nwm_files: list, fs=None, cube=None, file_offset=0):
     """
     Retrieve catchment level data from national water model files
 
     Inputs:
     nwm_files: list of filenames (urls for remote, local paths otherwise),
     fs: an optional file system for cloud storage reads
+    cube: optional (shared memory name, shape) of the forcing cube to write time slices into
+    file_offset: time index in the cube of the first file
 
-    Outputs: [data_list, t_list, nwm_data]
-    data_list : list of ngen forcings ordered in time. ngen_forcings : 2d darray (forcing_variable x catchment)
+    Outputs: [data_list, t_list, nwm_data, nwm_file_sizes_MB, nwm_transfer_MB, cache_counts, nwm_decoded_MB]
+    data_list : list of ngen forcings ordered in time, empty when writing into the cube. ngen_forcings : 2d darray (ngen_variable x catchment)
     t : model_output_valid_time for each
-    nwm_data : nwm data saved for plotting. nwm_data : 3d array (forcing_variable x west_east x south_north)
+    nwm_data : nwm data saved for plotting, for the first nts_plot files of the run. nwm_data : 3d array (forcing_variable x west_east x south_north)
+        of the bounding window, nan outside of the windows
+    nwm_decoded_MB : MB of decompressed chunks for each file
 
     Globals:
     weights_df : dataframe with catchment-ids as the index and columns indices and coverage
+    weights_mat : sparse (catchment x window cell) weights, used when regrid_engine is sparse or numba
+    windows : windows read from each file, their cells are concatenated along the window cell axis
+    nwm_sources, fan_out : NWM variables read once each and the source of each ngen variable, see read_plan
+    batch_size, batch_memory_MB : number of files reduced per matrix product and the memory bound on that batch
+    read_mode : download whole files or range read only the chunks within the window
+    nwm_references : chunk references per NWM file, used when read_mode is reference, files without one are downloaded
+    prefetch_depth, prefetch_memory_MB : number of files read ahead of the reductions and the memory bound on them
+    io_threads : number of threads per process reading files
     ngen_variables
     ngen_vars_plot
     ii_plot, nts_plot
@@ -149,25 +390,169 @@ def forcing_grid2catchment(nwm_files: list, fs=None):
     tdata = 0    
     t_list = []
     nwm_data_plot = []
-    jplot_vars = np.array([x for x in range(len(ngen_variables)) if ngen_variables[x] in ngen_vars_plot])
+    jplot_vars = fan_out[[x for x in range(len(ngen_variables)) if ngen_variables[x] in ngen_vars_plot]]
     nfiles = len(nwm_files)
-    nvar = len(nwm_variables)
+    nvar = len(nwm_sources)
 
-    dx = x_max - x_min + 1
-    dy = y_max - y_min + 1
+    _, ncells = window_offsets(windows)
+
+    # Stack several decoded windows and reduce them with one matrix product
+    nbatch = 1
+    if regrid_engine != "loop":
+        nbatch_mem = int(batch_memory_MB * B2MB // (nvar * ncells * 4))
+        nbatch = max(1, min(batch_size, nbatch_mem, nfiles))
+    batch_allvars = np.zeros(shape=(nbatch, nvar, ncells), dtype=np.float32)
+    jbatch = 0
 
+    if regrid_engine == "numba": set_kernel_threads(regrid_threads)
     if fs_type == 'google' : fs = gcsfs.GCSFileSystem() 
     id = os.getpid()
-    if ii_verbose: print(f'Process #{id} extracting data from {nfiles} files',end=None,flush=True)
+    if ii_verbose: print(f'Process #{id} extracting data from {nfiles} files in batches of {nbatch}',end=None,flush=True)
+
+    # Read files on I/O threads so network I/O and decompression overlap the reductions
+    ii_prefetch = prefetch_depth > 0 or io_threads > 0
+    if ii_prefetch:
+        depth_mem = int(prefetch_memory_MB * B2MB // (nvar * ncells * 4))
+        depth = max(1, min(max(prefetch_depth, io_threads), depth_mem))
+        nthreads = max(1, min(io_threads, depth))
+        if ii_verbose: print(f'Process #{id} prefetching {depth} files ahead on {nthreads} I/O threads',flush=True)
+        prefetched = prefetch_nwm_files(nwm_files, fs, depth, (nvar, ncells), nthreads)
+
     data_list = []
+    if cube is not None: cube_shm, cube_data = attach_cube(cube)
     nwm_file_sizes_MB = []
+    nwm_transfer_MB = []
+    nwm_decoded_MB = []
+    twait = 0
+    hits0, misses0 = cache_stats()
     for j, nwm_file in enumerate(nwm_files):
+        data_allvars = batch_allvars[jbatch]
+        if ii_prefetch:
+            t0 = time.perf_counter()
+            jdata, results = next(prefetched)
+            twait += time.perf_counter() - t0
+            data_allvars[:] = jdata
+            del jdata
+        else:
+            results = read_nwm_file(nwm_file, fs, data_allvars)
+        t, file_size_MB, transfer_MB, decoded_MB, (dt_open, dt_xrds, dt_fill) = results
+        topen += dt_open
+        txrds += dt_xrds
+        tfill += dt_fill
+        nwm_file_sizes_MB.append(file_size_MB)
+        nwm_transfer_MB.append(transfer_MB)
+        nwm_decoded_MB.append(decoded_MB)
+        t_list.append(t)       
+        if ii_plot and file_offset + j < nts_plot: nwm_data_plot.append(mosaic_windows(data_allvars[jplot_vars], windows))
+
+        t0 = time.perf_counter()
+        jbatch += 1
+        if jbatch == nbatch or j == nfiles - 1:
+            if regrid_engine == "sparse":
+                block = batch_allvars[:jbatch].reshape(jbatch * nvar, ncells)
+                data_array = catchment_values_sparse(block, weights_mat).reshape(jbatch, nvar, -1)
+            elif regrid_engine == "numba":
+                block = batch_allvars[:jbatch].reshape(jbatch * nvar, ncells)
+                data_array = catchment_values_numba(block, weights_mat).reshape(jbatch, nvar, -1)
+            else:
+                data_array = catchment_values_loop(batch_allvars[0], weights_df, windows[0], (NWM_NX, NWM_NY))[None,:,:]
+            data_array = data_array[:, fan_out]
+            if cube is not None:
+                cube_data[file_offset + j + 1 - jbatch:file_offset + j + 1] = data_array
+            else:
+                data_list.extend(data_array)
+            del data_array
+            jbatch = 0
+        del data_allvars
+        tdata += time.perf_counter() - t0
+        tread = topen + txrds + tfill
+        ttotal = tread + tdata
+        if ii_verbose: 
+            msg = f'\nAverage time for:\nfs open file: {topen/(j+1):.2f} s\nxarray open dataset: {txrds/(j+1):.2f} s\nfill array: {tfill/(j+1):.2f} s\nMB transferred: {nwm_transfer_MB[-1]:.2f} of {nwm_file_sizes_MB[-1]:.2f}\ncalculate catchment values: {tdata/(j+1):.2f} s\ntotal {ttotal/(j+1):.2f} s'
+            if ii_prefetch:
+                msg += f'\nwaiting on reads: {twait/(j+1):.2f} s\nread time hidden behind compute: {100*max(tread - twait, 0)/max(tread, 1e-9):.2f}%'
+            msg += f'\npercent complete {100*(j+1)/nfiles:.2f}'
+            print(msg, end=None,flush=True)
+        report_usage()
+
+    hits, misses = cache_stats()
+    if cube is not None:
+        del cube_data
+        release_cube(cube_shm)
+    if ii_verbose: print(f'Process #{id} completed data extraction, returning data to primary process',flush=True)
+    return [data_list, t_list, nwm_data_plot, nwm_file_sizes_MB, nwm_transfer_MB, (hits - hits0, misses - misses0), nwm_decoded_MB]
+
+def get_cell_mask():
+    """
+    CellMask of the grid cells the weights reference
+    """
+    global cell_mask
+    if cell_mask is None:
+        if weights_mat is not None:
+            x, y = window_cells(windows, np.unique(weights_mat.indices))
+        else:
+            cells = np.unique(weights_cells(weights_df)[0])
+            x, y = cells % NWM_NX, (cells // NWM_NX) % NWM_NY
+        cell_mask = CellMask(x, y)
+    return cell_mask
+
+def read_nwm_file(nwm_file, fs, data_allvars):
+    """
+    Read the windows of each NWM source variable from a single NWM file
+
+    Inputs:
+    nwm_file: filename (url for remote, local path otherwise)
+    fs: an optional file system for cloud storage reads
+    data_allvars: 2d array (source variable x window cell) to fill, see window_views
+
+    Outputs: t, file_size_MB, transfer_MB, decoded_MB, (topen, txrds, tfill)
+    t : model_output_valid_time
+    file_size_MB : size of the NWM file
+    transfer_MB : data transferred to read the windows
+    decoded_MB : decompressed chunks, counted from the chunk layout when the netCDF library reads the file
+    topen, txrds, tfill : time spent fetching, opening and filling
+    """
+    topen = 0
+    txrds = 0
+    tfill = 0
+    ii_range = False
+    ii_hit = False
+    views = window_views(data_allvars, windows)
+    if read_mode == "range" or (read_mode == "reference" and nwm_file in nwm_references):
+        t0 = time.perf_counter()
+        if fs and nwm_file.find('https://') >= 0: _, bucket_key = convert_url2key(nwm_file,fs_type)
+        else: bucket_key = nwm_file
+        try:
+            reference = nwm_references.get(nwm_file)
+            # plots show the whole window
+            mask = get_cell_mask() if chunk_sparse and not ii_plot else None
+            attrs, file_size, nbytes, ndecoded = read_nwm_window(bucket_key, fs, nwm_sources, windows, views, reference, mask)
+            ii_range = True
+        except (OSError, NotImplementedError) as e:
+            # not hdf5 based (e.g. netcdf3) or an unsupported filter
+            if ii_verbose: print(f'Range read of {nwm_file} failed ({e}), downloading whole file',flush=True)
+    if ii_range:
+        file_size_MB = file_size / B2MB
+        transfer_MB = nbytes / B2MB
+        decoded_MB = ndecoded / B2MB
+        if "retrospective-2-1" in nwm_file:
+            t = datetime.strftime(datetime.strptime(nwm_file.split('/')[-1].split('.')[0],'%Y%m%d%H'),'%Y-%m-%d %H:%M:%S')
+        else:
+            time_splt = attrs["model_output_valid_time"].split("_")
+            t = time_splt[0] + " " + time_splt[1]
+        tfill += time.perf_counter() - t0
+    else:
         t0 = time.perf_counter()        
-        if fs:
+        if cache_enabled() and (fs or 'https://' in nwm_file):
+            if fs and nwm_file.find('https://') >= 0: _, bucket_key = convert_url2key(nwm_file,fs_type)
+            else: bucket_key = nwm_file
+            file_obj, ii_hit = fetch_cached(nwm_file, fs, bucket_key)
+            file_size_MB = os.path.getsize(file_obj) / B2MB
+        elif fs:
             if nwm_file.find('https://') >= 0: _, bucket_key = convert_url2key(nwm_file,fs_type)
             else: bucket_key = nwm_file
             file_obj   = fs.open(bucket_key, mode='rb')
-            nwm_file_sizes_MB.append(file_obj.details['size'])
+            file_size_MB = file_obj.details['size'] / B2MB
         elif 'https://' in nwm_file:
             response = requests.get(nwm_file)
             
@@ -175,482 +560,855 @@ def forcing_grid2catchment(nwm_files: list, fs=None):
                 file_obj = BytesIO(response.content)
             else:
                 raise Exception(f"{nwm_file} does not exist")
-            nwm_file_sizes_MB.append(len(response.content) / B2MB)
+            file_size_MB = len(response.content) / B2MB
         else:
             file_obj = nwm_file
-            nwm_file_sizes_MB = os.path.getsize(nwm_file / B2MB) 
+            file_size_MB = os.path.getsize(nwm_file) / B2MB
+        transfer_MB = 0 if cache_enabled() and ii_hit else file_size_MB
 
         topen += time.perf_counter() - t0
         t0 = time.perf_counter()  
-        with xr.open_dataset(file_obj) as nwm_data:
-            txrds += time.perf_counter() - t0
-            t0 = time.perf_counter()                     
-            shp = nwm_data["U2D"].shape   
-            data_allvars = np.zeros(shape=(nvar, dy, dx), dtype=np.float32)       
-            for var_dx, jvar in enumerate(nwm_variables):  
-                if "retrospective-2-1" in nwm_file:
-                    data_allvars[var_dx, :, :] = np.flip(np.squeeze(nwm_data[jvar].isel(west_east=slice(x_min, x_max+1), south_north=slice(shp[1] - (y_max+1), shp[1] - y_min)).values),axis=0)
-                    t = datetime.strftime(datetime.strptime(nwm_file.split('/')[-1].split('.')[0],'%Y%m%d%H'),'%Y-%m-%d %H:%M:%S')
-                else:                            
-                    data_allvars[var_dx, :, :] = np.flip(np.squeeze(nwm_data[jvar].isel(x=slice(x_min, x_max+1), y=slice(shp[1] - (y_max+1), shp[1] - y_min)).values),axis=0)
-                    time_splt = nwm_data.attrs["model_output_valid_time"].split("_")
-                    t = time_splt[0] + " " + time_splt[1]
-            t_list.append(t)       
-            if ii_plot and j < nts_plot: nwm_data_plot.append(data_allvars[jplot_vars,:,:])
-        del nwm_data
+        attrs, ndecoded = read_nc_window(file_obj, nwm_sources, windows, views)
+        if hasattr(file_obj, 'close'): file_obj.close()
+        decoded_MB = ndecoded / B2MB
+        if "retrospective-2-1" in nwm_file:
+            t = datetime.strftime(datetime.strptime(nwm_file.split('/')[-1].split('.')[0],'%Y%m%d%H'),'%Y-%m-%d %H:%M:%S')
+        else:
+            time_splt = attrs["model_output_valid_time"].split("_")
+            t = time_splt[0] + " " + time_splt[1]
         tfill += time.perf_counter() - t0        
 
-        t0 = time.perf_counter()
-        data_allvars = data_allvars.reshape(nvar, dx*dy)
-        ncatch = len(weights_df)
-        data_array = np.zeros((nvar,ncatch), dtype=np.float32)
-        jcatch = 0
-        for row in weights_df.itertuples(): 
-            weights = row.cell_id
-            coverage = np.array(row.coverage)
-            coverage_mat = np.repeat(coverage[None,:],nvar,axis=0)
-
-            weights_dx, weights_dy = np.unravel_index(weights, (shp[2], shp[1]), order='F')
-            weights_dx_shifted = list(weights_dx - x_min)
-            weights_dy_shifted = list(weights_dy - y_min)
-            weights_window = np.ravel_multi_index(np.array([weights_dx_shifted,weights_dy_shifted]),(dx,dy),order='F')   
-            jcatch_data_mask = data_allvars[:,weights_window]     
-
-            weight_sum = np.sum(coverage)
-            data_array[:,jcatch] = np.sum(coverage_mat * jcatch_data_mask ,axis=1) / weight_sum  
-            jcatch += 1  
+    return t, file_size_MB, transfer_MB, decoded_MB, (topen, txrds, tfill)
 
-        del data_allvars
-        data_list.append(data_array)
-        tdata += time.perf_counter() - t0
-        ttotal = topen + txrds + tfill + tdata
-        if ii_verbose: print(f'\nAverage time for:\nfs open file: {topen/(j+1):.2f} s\nxarray open dataset: {txrds/(j+1):.2f} s\nfill array: {tfill/(j+1):.2f} s\ncalculate catchment values: {tdata/(j+1):.2f} s\ntotal {ttotal/(j+1):.2f} s\npercent complete {100*(j+1)/nfiles:.2f}', end=None,flush=True)
-        report_usage()
+def prefetch_nwm_files(nwm_files, fs, depth, shape, nthreads=1):
+    """
+    Generator that reads NWM files on a pool of I/O threads, keeping at most depth files ahead of the consumer.
+    Fetches, chunk decompression and netCDF reads release the GIL, so several threads keep the network busy
+    while the calling process does the reductions.
 
-    if ii_verbose: print(f'Process #{id} completed data extraction, returning data to primary process',flush=True)
-    return [data_list, t_list, nwm_data_plot, nwm_file_sizes_MB]
+    Inputs:
+    nwm_files: list of filenames (urls for remote, local paths otherwise)
+    fs: an optional file system for cloud storage reads
+    depth: maximum number of files read or being read ahead of the consumer
+    shape: shape of the window array filled for each file
+    nthreads: number of I/O threads
 
-def multiprocess_write(data,t_ax,catchments,nprocs,out_path):
+    Yields: data_allvars, read_nwm_file outputs, in file order
+    """
+    def read(jfile):
+        data_allvars = np.zeros(shape=shape, dtype=np.float32)
+        results = read_nwm_file(jfile, fs, data_allvars)
+        return data_allvars, results
+
+    files = iter(nwm_files)
+    with cf.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = deque([pool.submit(read, jfile) for jfile in islice(files, depth)])
+        while futures:
+            item = futures.popleft().result()
+            jfile = next(files, None)
+            if jfile is not None: futures.append(pool.submit(read, jfile))
+            yield item
+
+def catchment_values_loop(data_allvars, weights_df, window, grid_shape):
+    """
+    Reference reduction of a windowed grid to catchment values, one catchment at a time.
+
+    Parameters:
+        data_allvars (numpy.ndarray): 2D array (forcing_variable x window cell).
+        weights_df (pd.DataFrame): DataFrame containing catchment weights.
+        window (tuple): (x_min, x_max, y_min, y_max) of the window on the NWM grid.
+        grid_shape (tuple): (west_east, south_north) size of the NWM grid.
+
+    Returns:
+        data_array (numpy.ndarray): 2D array (forcing_variable x catchment).
+    """
+    x_min, x_max, y_min, y_max = window
+    dx = x_max - x_min + 1
+    dy = y_max - y_min + 1
+    nvar = data_allvars.shape[0]
+    ncatch = len(weights_df)
+    data_array = np.zeros((nvar,ncatch), dtype=np.float32)
+    jcatch = 0
+    for row in weights_df.itertuples(): 
+        weights = row.cell_id
+        coverage = np.array(row.coverage)
+        coverage_mat = np.repeat(coverage[None,:],nvar,axis=0)
+
+        weights_dx, weights_dy = np.unravel_index(weights, grid_shape, order='F')
+        weights_dx_shifted = list(weights_dx - x_min)
+        weights_dy_shifted = list(weights_dy - y_min)
+        weights_window = np.ravel_multi_index(np.array([weights_dx_shifted,weights_dy_shifted]),(dx,dy),order='F')   
+        jcatch_data_mask = data_allvars[:,weights_window]     
+
+        weight_sum = np.sum(coverage)
+        data_array[:,jcatch] = np.sum(coverage_mat * jcatch_data_mask ,axis=1) / weight_sum  
+        jcatch += 1  
+
+    return data_array
+
+def catchment_values_sparse(data_allvars, weights_mat):
+    """
+    Reduce a windowed grid to catchment values with a single sparse mat-vec per variable.
+
+    Parameters:
+        data_allvars (numpy.ndarray): 2D array (forcing_variable x window cell).
+        weights_mat (scipy.sparse.csr_matrix): normalized weights from build_weights_matrix.
+
+    Returns:
+        data_array (numpy.ndarray): 2D array (forcing_variable x catchment).
+    """
+    data_array = np.asarray(weights_mat @ data_allvars.T, dtype=np.float32).T
+    # match the loop, where a catchment without cells averages to nan
+    data_array[:, np.diff(weights_mat.indptr) == 0] = np.nan
+    return np.ascontiguousarray(data_array)
+
+def multiprocess_write(cube,t_ax,catchments,jcatchment_dict,nprocs,out_path,catch_offset=0):
     """
     Sets up the process pool for write_data.
 
     Parameters:
-        data (numpy.ndarray): 3D array containing the data to be written.
+        cube (tuple): (shared memory name, shape) of the forcing cube, see create_cube.
         t_ax (numpy.ndarray): Array representing the time axis of the data.
-        catchments (iterable): List of catchment identifiers.
+        catchments (list): Catchment identifiers of the cube, in cube order.
+        jcatchment_dict (dict): Dictionary containing catchment chunks, in cube order, groups the tar shards.
         nprocs (int): Number of processes to be used for writing data.
         out_path (str): Path where the output files will be saved.
+        catch_offset (int): Index of the first catchment of the cube in the run, names the tar shards.
 
     Returns:
         flat_ids (list): Flattened list of catchment identifiers.
-        flat_dfs (list): Flattened list of pandas DataFrames.
-        flat_filenames (list): Flattened list of filenames.
         flat_file_sizes (list): Flattened list of file sizes in MB.
         flat_file_sizes_zipped (list): Flattened list of file sizes after compression in MB.
+        stats (list): Per catchment statistics (forcing_variable x catchment) in the order of catchment_stat_names, None if not collected.
+        tar_shards (dict): Per VPU list of (shard path, uncompressed size) in catchment order, see write_data.
+        tar_stats (tuple): Uncompressed MB, compressed MB and compression seconds summed over the shards.
+        task_times (tuple): Per task durations in seconds, the process that ran each task and the pool startup time.
+        upload_stats (tuple): MB uploaded, requests, retries, MB/s and requests/s over the write stage.
     """
 
-    launch_time          = 0.05
-    cycle_time           = 1
-    catchments_per_cycle = 200
-    catchments_per_proc  = distribute_work(catchments,nprocs)
-    catchments_per_proc  = load_balance(catchments_per_proc,launch_time,cycle_time,catchments_per_cycle)
-
-    ntasked = len(np.nonzero(catchments_per_proc)[0])
-    if nprocs > ntasked: 
-        if ii_verbose: print(f'Not enough work for {nprocs} requested processes, downsizing to {ntasked}')
-    
-    ncatchments           = len(catchments)
-    out_path_list         = []
-    print_list            = []
-    worker_time_list      = []
-    worker_data_list      = []
-    worker_catchment_list = []
-    worker_catchments     = {}
-    
+    vpu_ranges = []
     i = 0
-    count = 0
-    start = 0
-    end   = 0
-    ii_print = False
-    for j, jcatch in enumerate(catchments):
-        worker_catchments[jcatch] = jcatch      
-        count +=1     
-        if count == catchments_per_proc[i] or j == ncatchments - 1:
-            if len(worker_catchment_list) == ntasked - 1 : ii_print = True
-
-            end = min(start + catchments_per_proc[i],ncatchments)
-            worker_data = data[:,:,start:end]
-            worker_data_list.append(worker_data)
-            start = end
-
-            worker_catchment_list.append(worker_catchments)
-            out_path_list.append(out_path)
-            print_list.append(ii_print)
-            worker_time_list.append(t_ax)
-
-            worker_catchments = {}
-            count = 0
-            
-            i += 1
-
-    ids = []
-    dfs = []
-    filenames = []
-    file_sizes_MB = []
-    file_sizes_zipped_MB = []
-    tar_list = []
-    with cf.ProcessPoolExecutor(max_workers=nprocs) as pool:
-         for results in pool.map(
-        write_data,
-        worker_data_list,
-        worker_time_list,
-        worker_catchment_list,
-        out_path_list,
-        print_list,      
-        ):
-            ids.append(results[0])
-            dfs.append(results[1])
-            filenames.append(results[2])
-            file_sizes_MB.append(results[3])
-            file_sizes_zipped_MB.append(results[4])
-            tar_list.append(results[5])
+    for jchunk in jcatchment_dict:
+        k = min(i + len(jcatchment_dict[jchunk]), len(catchments))
+        vpu_ranges.append((jchunk, i, k))
+        i = k
+    shard_dir = None
+    if "tar" in output_file_type:
+        shard_dir = tempfile.mkdtemp() if storage_type == 's3' else forcing_path
+
+    tasks = make_tasks(len(catchments), task_catchments)
+    task_args = []
+    for start, end in tasks:
+        # the pieces of each VPU this task holds, relative to the task
+        jvpus = [(jvpu, max(i, start) - start, min(k, end) - start) for jvpu, i, k in vpu_ranges if i < end and k > start]
+        task_args.append((cube, (start, end), t_ax, catchments[start:end], out_path, jvpus, shard_dir, catch_offset))
+    if ii_verbose: print(f'Writing {len(catchments)} catchments in {len(tasks)} tasks',flush=True)
+    t0 = time.perf_counter()
+    results, durations, pids, startup = schedule_tasks(write_data, task_args, nprocs, "write tasks")
+    twrite = time.perf_counter() - t0
 
     print(f'\n\nGathering data from write processes...')
 
     flat_ids = []
-    flat_dfs = []
-    flat_filenames = []
     flat_file_sizes = []
     flat_file_sizes_zipped = []
-    flat_tar = []
+    tar_shards = {jchunk : [] for jchunk in jcatchment_dict}
+    tar_stats = [0, 0, 0]
+
+    for jresults in results:
+        flat_ids.extend(jresults[0])
+        flat_file_sizes.extend(jresults[1])
+        flat_file_sizes_zipped.extend(jresults[2])
+        for jvpu, jpath, jsize, jcompressed, jsecs in jresults[4]:
+            tar_shards[jvpu].append((jpath, jsize))
+            tar_stats = [tar_stats[0] + jsize / B2MB, tar_stats[1] + jcompressed / B2MB, tar_stats[2] + jsecs]
+
+    stats = None
+    if ii_collect_stats:
+        stats = [np.concatenate([x[3][j] for x in results], axis=1) for j in range(len(catchment_stat_names))]
 
-    while ids:
-        flat_ids.extend(ids.pop(0))
-        flat_dfs.extend(dfs.pop(0))
-        flat_filenames.extend(filenames.pop(0))
-        flat_file_sizes.extend(file_sizes_MB.pop(0))
-        flat_file_sizes_zipped.extend(file_sizes_zipped_MB.pop(0))
-        flat_tar.extend(tar_list.pop(0))
+    upload_MB = sum([x[5][0] for x in results]) / B2MB
+    upload_requests = sum([x[5][1] for x in results])
+    upload_retries = sum([x[5][2] for x in results])
+    upload_stats = (upload_MB, upload_requests, upload_retries, upload_MB / twrite, upload_requests / twrite)
 
-    return flat_ids, flat_dfs, flat_filenames, flat_file_sizes, flat_file_sizes_zipped, flat_tar
+    return flat_ids, flat_file_sizes, flat_file_sizes_zipped, stats, tar_shards, tuple(tar_stats), (durations, pids, startup), upload_stats
 
 def write_data(
-        data,
+        cube,
+        catch_range,
         t_ax,
         catchments,
         out_path,
-        ii_print  
+        vpus=(),
+        shard_dir=None,
+        catch_offset=0
 ):
     """
-    Write catchment forcing data to csv or parquet if requested. Also responsible for 
-    creating/formatting data in memory for tar writing and metadata collection.
+    Write catchment forcing data to csv or parquet if requested. Also streams the csv files
+    into a compressed tar shard per VPU piece for write_tar and collects per catchment statistics
+    and file sizes from the data in memory.
 
     Args:
-        data: Input data to be written (numpy array)
+        cube: (shared memory name, shape) of the forcing cube, attached without copying
+        catch_range: (start, end) catchment indices of the cube to write
         t_ax: Time axis data (numpy array)
         catchments: List of catchment identifiers
         out_path: Output path for writing files
-        ii_print: Flag for printing progress information
+        vpus: (vpu, start, end) pieces of the VPUs in this task, relative to catch_range
+        shard_dir: Directory of the tar shards
+        catch_offset: Index of the first catchment of the cube in the run
 
     Returns:
         forcing_cat_ids: List of catchment identifiers
-        dfs: List of pandas DataFrames
-        filenames: List of filenames
-        file_size_MB: List containing the size of each file in MB
-        file_zipped_size_MB: List containing the size of each zipped file in MB
+        file_size_MB: List containing the csv size of each file in MB, only the first file if no csv is rendered
+        file_zipped_size_MB: List containing the gzipped csv size of the first file in MB, empty if there are no catchments
+        stats: Per catchment statistics of this task, see catchment_stats, None if not collected
+        tar_shards: List of (vpu, shard path, uncompressed size, compressed size, compression seconds), the tar members
+            of the piece without end of archive blocks
+        upload_stats: bytes, requests, retries and request seconds of the S3 uploads of this task
     """
-    s3_client = boto3.session.Session().client("s3")   
     nfiles = len(catchments)
     id = os.getpid()
     forcing_cat_ids = []
-    tar_list = []
-    dfs = []
-    filenames = []
+    tar_shards = []
+    shard = None
+    shard_starts = {start : jvpu for jvpu, start, end in vpus}
+    shard_ends = set([end for jvpu, start, end in vpus])
     filename  = ""
+    file_size_MB = []
+    file_zipped_size_MB = 0
     write_int = 400
     t_df      = 0
     bucket = None
     key_prefix = None
     if storage_type == 's3':
         bucket, key_prefix = convert_url2key(out_path, storage_type)
-
+        uploader = get_uploader(**upload_kwargs)
+        stats0 = uploader.stats()
+    cube_shm, cube_data = attach_cube(cube)
+    data = cube_data[:,:,catch_range[0]:catch_range[1]]
+    # about 72 bytes of rendering buffers per value
+    csv_block = max(1, int(CSV_BLOCK_MB * B2MB / (len(t_ax) * len(ngen_variables) * 72)))
+
+    df_type = "parquet" if "parquet" in output_file_type else "csv"
+    write_files = "parquet" in output_file_type or "csv" in output_file_type
+    render_csv = (write_files and df_type == "csv") or "tar" in output_file_type
+    if write_files and ii_verbose: print(f'{id} writing {nfiles} dataframes to {output_file_type}', end=None, flush =True)
     t00 = time.perf_counter()
     for j, jcatch in enumerate(catchments):
 
-        t0 = time.perf_counter()
-        df_data = data[:,:,j]
-        df     = pd.DataFrame(df_data,columns=ngen_variables)
-        df.insert(0,"time",t_ax)
-        t_df += time.perf_counter() - t0
-        
+        # the first file is always rendered for the size statistics
+        if j % csv_block == 0 and (render_csv or j == 0):
+            t0 = time.perf_counter()
+            csv_bytes = format_csv_block(data[:,:,j:j + (csv_block if render_csv else 1)], t_ax, ngen_variables)
+            t_df += time.perf_counter() - t0
+        if render_csv or j == 0: jcsv = csv_bytes[j % csv_block]
+
         cat_id = jcatch.split("-")[1]
         forcing_cat_ids.append(cat_id)
 
-        if "parquet" in output_file_type or "csv" in output_file_type :
-            if "netcdf" in output_file_type: output_file_type.pop(output_file_type.index("netcdf"))
-            filename = f"cat-{cat_id}.{output_file_type[0]}"
-            if j ==0: 
-                if ii_verbose: print(f'{id} writing {nfiles} dataframes to {output_file_type}', end=None, flush =True)
-            kwargs = {"s3": s3_client, "bucket": bucket, "key_prefix": key_prefix} if storage_type == "s3" else {"local_path": out_path}
+        filename = f"cat-{cat_id}.{df_type}" if write_files else f"./cat-{cat_id}.csv"
+        if df_type == "parquet":
+            df = pd.DataFrame(np.array(data[:,:,j]),columns=ngen_variables)
+            df.insert(0,"time",t_ax)
+            kwargs = {"uploader": uploader, "bucket": bucket, "key_prefix": key_prefix} if storage_type == "s3" else {"local_path": out_path}
             write_df(df, filename, storage_type, **kwargs)
-        else: 
-            filename = f"./cat-{cat_id}.csv"
-
-        dfs.append(df)     
-        filenames.append(str(Path(filename).name))          
+        elif write_files:
+            if storage_type == "s3": uploader.put(bucket, f"{key_prefix}/{filename}", jcsv)
+            else: Path(out_path, filename).write_bytes(jcsv)
 
         if "tar" in output_file_type:
-            buf = BytesIO()
-            df.to_csv(buf, index=False)
-            buf.seek(0)
-            tar_list.append(buf)
-
-        if j == 0:
-            if not os.path.exists(filename):
-                filename = f"./cat-{cat_id}.csv"
-                df.to_csv(filename, index=False)  
-                file_size_MB = os.path.getsize(filename) / B2MB
-                os.remove(filename)
-            else:
-                file_size_MB = os.path.getsize(filename) / B2MB
-
-            pattern = r'\.\w+$'
-            filename_zip = re.sub(pattern, '.zip', filename)
-            with gzip.GzipFile(filename_zip, mode='w') as zipped_file:
-                df.to_csv(TextIOWrapper(zipped_file, 'utf8'), index=False) 
-            file_zipped_size_MB = os.path.getsize(filename_zip) / B2MB   
-            os.remove(filename_zip)            
-
-        if ii_print and ii_verbose:
+            # catchments outside every VPU piece are in no archive
+            if j in shard_ends and shard is not None:
+                tar_shards[-1].extend(shard.close())
+                shard = None
+            if j in shard_starts:
+                shard_path = Path(shard_dir, f".{shard_starts[j]}_forcings.{archive_extensions[tar_compression]}.{catch_offset + catch_range[0] + j:09d}")
+                shard = ShardWriter(shard_path, tar_compression, tar_complevel, tar_threads)
+                tar_shards.append([shard_starts[j], str(shard_path)])
+            if shard is not None: shard.write(tar_member(Path(filename).name, jcsv))
+
+        if render_csv or j == 0: file_size_MB.append(len(jcsv) / B2MB)
+        if j == 0: file_zipped_size_MB = len(gzip.compress(jcsv)) / B2MB
+
+        if ii_verbose:
             if (j + 1) % write_int == 0 or j == nfiles - 1:
                 t_accum = time.perf_counter() - t00
-                rate = ((j+1)*ntasked/t_accum)
+                rate = ((j+1)/t_accum)
                 bytes2bits = 8
-                bandwidth_Mbps = rate * file_size_MB * ntasked * bytes2bits
-                estimate_total_time = nfiles * ntasked / rate
+                bandwidth_Mbps = rate * file_size_MB[0] * bytes2bits
                 report_usage()
-                msg = f"\n{(j+1)*ntasked} dataframes converted out of {nfiles*ntasked}\n"
+                msg = f"\n{id} converted {j+1} dataframes out of {nfiles}\n"
                 msg += f"rate             {rate:.2f} files/s\n"
                 msg += f"df conversion    {t_df:.2f}s\n"
-                msg += f"estimated total write time {estimate_total_time:.2f}s\n"
-                msg += f"progress                   {(j+1)/nfiles*100:.2f}%\n"
-                msg += f"Bandwidth (all processs)   {bandwidth_Mbps:.2f} Mbps"
+                msg += f"Bandwidth (this process)   {bandwidth_Mbps:.2f} Mbps"
                 print(msg,flush=True)
 
-    return forcing_cat_ids, dfs, filenames, [file_size_MB], [file_zipped_size_MB], tar_list
+    if shard is not None: tar_shards[-1].extend(shard.close())
+    stats = catchment_stats(data) if ii_collect_stats else None
+    del data, cube_data
+    release_cube(cube_shm)
+
+    upload_stats = (0, 0, 0, 0)
+    if storage_type == 's3':
+        uploader.flush()
+        upload_stats = tuple([x - y for x, y in zip(uploader.stats(), stats0)])
+
+    # an empty task has no first file to size
+    return forcing_cat_ids, file_size_MB, [file_zipped_size_MB] if nfiles > 0 else [], stats, [tuple(x) for x in tar_shards], upload_stats
 
-def write_tar(tar_buffs,jcatchunk,catchments,filenames):
+def tar_member(name, body):
     """
-    Write DataFrames to a tar archive and upload to S3 or save locally as a compressed tar file.
+    Bytes of a tar archive member, the header and the body padded to the block size, as
+    tarfile.TarFile.addfile writes it
+    """
+    info = tarfile.TarInfo(name=name)
+    info.size = len(body)
+    header = info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape")
+    return header + body + tarfile.NUL * (-len(body) % tarfile.BLOCKSIZE)
+
+def write_tar(jcatchunk, shards):
+    """
+    Concatenate the compressed tar shards of a VPU into its archive and upload to S3 or save locally.
+    Concatenated gzip members (zstd frames) are a valid gzip (zstd) file, so the shards are copied
+    without recompressing, followed by the end of archive blocks. The shards are removed.
 
     Args:
-        dfs: List of pandas DataFrames to be archived.
         jcatchunk: Identifier for the chunk of catchments.
-        catchments: List of catchments.
-        filenames: List of filenames corresponding to the DataFrames.
+        shards: List of (shard path, uncompressed size) in catchment order, see write_data.
 
     Returns:
         None
     """
     print(f'Writing {jcatchunk} tar')
+    tar_name = f'{jcatchunk}_forcings.{archive_extensions[tar_compression]}'
+    end = end_of_archive(sum([x[1] for x in shards]), tar_compression, tar_complevel)
     if storage_type == "s3":
-        tar_name = f'{jcatchunk}_forcings.tar.gz'
         buffer = BytesIO()
-        with tarfile.open(fileobj=buffer, mode='w:gz') as jtar:
-            for j, jcat in enumerate(catchments):
-                jbuff = tar_buffs[j]
-                jfilename = filenames[j]
-                info = tarfile.TarInfo(name=jfilename)
-                info.size = len(jbuff.getbuffer())
-                jtar.addfile(info, jbuff) 
-
+        for jpath, jsize in shards:
+            with open(jpath, 'rb') as f: buffer.write(f.read())
+        buffer.write(end)
         print(f'Uploading {jcatchunk} tar to s3')
-        buffer.seek(0)
         bucket, key = convert_url2key(forcing_path,storage_type)
-        s3 = boto3.client("s3")   
-        s3.put_object(Bucket = bucket, Key = key + "/" + tar_name, Body = buffer.getvalue())   
+        uploader = get_uploader(**upload_kwargs)
+        uploader.put(bucket, key + "/" + tar_name, buffer.getvalue())
+        uploader.flush()
     else:
-        tar_name = Path(forcing_path,f'{jcatchunk}_forcings.tar.gz')
-        with tarfile.open(tar_name, 'w:gz') as jtar:
-            for j, jcat in enumerate(catchments):
-                jbuff = tar_buffs[j]
-                jfilename = filenames[j]
-                info = tarfile.TarInfo(name=jfilename)
-                info.size = len(jbuff.getbuffer())
-                jtar.addfile(info, jbuff)     
+        with open(Path(forcing_path, tar_name), 'wb') as jtar:
+            for jpath, jsize in shards:
+                with open(jpath, 'rb') as f: shutil.copyfileobj(f, jtar)
+            jtar.write(end)
+    for jpath, jsize in shards: os.remove(jpath)
 
-def multiprocess_write_tars(dfs,catchments,filenames,tar_buffs):  
+def multiprocess_write_tars(tar_shards):
     """
-    Write DataFrames to tar archives using multiprocessing.
+    Assemble the tar archives of each VPU from the writer shards using multiprocessing.
 
     Args:
-        dfs: List of pandas DataFrames.
-        catchments: Dictionary containing catchment chunks.
-        filenames: List of filenames corresponding to the DataFrames.
+        tar_shards: Per VPU list of (shard path, uncompressed size), see multiprocess_write.
 
     Returns:
-        None
+        startup: seconds from submission until the first tar task started
     """
-    i=0
-    k=0
-    tar_buffs_list = []
-    jcatchunk_list = []
-    catchments_list = []
-    filenames_list = []
-    for j, jchunk in enumerate(catchments):  
-        ncatchments = len(catchments[jchunk])
-        k += ncatchments
-        tar_buffs_list.append(tar_buffs[i:k])
-        jcatchunk_list.append(jchunk)
-        catchments_list.append(catchments[jchunk])
-        filenames_list.append(filenames[i:k]) 
-        i=k      
+    task_args = [(jchunk, tar_shards[jchunk]) for jchunk in tar_shards]
+    _, _, _, startup = schedule_tasks(write_tar, task_args, nprocs, "tar tasks")
+    if storage_type == 's3':
+        shard_dirs = set([Path(jpath).parent for jchunk in tar_shards for jpath, jsize in tar_shards[jchunk]])
+        for jdir in shard_dirs: os.rmdir(jdir)
+    return startup
 
-    with cf.ProcessPoolExecutor(max_workers=min(len(catchments),nprocs)) as pool:
-        for results in pool.map(
-        write_tar,
-        tar_buffs_list,
-        jcatchunk_list,
-        catchments_list,
-        filenames_list      
-        ):
-            pass
+def netcdf_filename(vpu):
+    """
+    Name of the netcdf forcings file of a VPU
+    """
+    if FCST_CYCLE is None:
+        return f'{vpu}_forcings.nc'
+    return f'ngen.{FCST_CYCLE}z.{URLBASE}.forcing.{LEAD_START}_{LEAD_END}.{vpu}.nc'
 
-def write_netcdf(data, vpu, t_ax, catchments):
+def create_netcdf(nc_filename, catchments, ntime=None):
+    """
+    Create a netcdf forcings file with one (catchment-id x time) variable per ngen variable,
+    laid out according to the netcdf_* storage options
+
+    Parameters:
+        nc_filename (str): Local path of the netcdf file.
+        catchments (list): Catchment IDs.
+        ntime (int): Length of the time dimension, None for an unlimited dimension that can be appended to.
+
+    Returns:
+        ds (netCDF4.Dataset): The open dataset.
+    """
+    import netCDF4 as nc
+    ds = nc.Dataset(nc_filename, 'w', format='NETCDF4')
+    ds.createDimension('catchment-id', len(catchments))
+    ds.createDimension('time', ntime)
+
+    if netcdf_ids == "int":
+        ids_var = ds.createVariable('ids', 'i8', ('catchment-id',))
+        ids_var[:] = np.array([int(x.split("-")[-1]) for x in catchments],dtype=np.int64)
+    elif netcdf_ids == "fixed":
+        nchar = max([len(x) for x in catchments])
+        ds.createDimension('id_strlen', nchar)
+        ids_var = ds.createVariable('ids', 'S1', ('catchment-id', 'id_strlen'))
+        ids_var._Encoding = 'ascii'
+        ids_var[:] = np.array(catchments,dtype=f'S{nchar}')
+    else:
+        ids_var = ds.createVariable('ids', str, ('catchment-id',))
+        ids_var[:] = np.array(catchments,dtype='str')
+
+    kwargs = {"zlib" : netcdf_zlib, "complevel" : netcdf_complevel, "shuffle" : netcdf_shuffle}
+    if netcdf_chunks is not None:
+        chunk_time = netcdf_chunks[1] if ntime is None else min(netcdf_chunks[1], max(ntime, 1))
+        kwargs["chunksizes"] = (min(netcdf_chunks[0], max(len(catchments), 1)), chunk_time)
+    if netcdf_time == "1d":
+        ds.createVariable('Time', 'f8', ('time',))
+    else:
+        ds.createVariable('Time', 'f8', ('catchment-id', 'time'), **kwargs)
+    for jvar in ngen_variables:
+        ds.createVariable(jvar, 'f4', ('catchment-id', 'time'), **kwargs)
+    return ds
+
+def write_netcdf_time(ds, t_utc, start, end):
+    """
+    Write the time axis of time slices start to end
+    """
+    if netcdf_time == "1d":
+        ds['Time'][start:end] = t_utc
+    else:
+        ds['Time'][:, start:end] = np.tile(t_utc, (ds.dimensions['catchment-id'].size, 1))
+
+def write_netcdf(cube, catch_range, filename, t_ax, catchments):
     """
     Write 3D array data to a NetCDF file.
 
     Parameters:
-        data (numpy.ndarray): 3D array with dimensions (catchment-id, time, forcing variable).
-        vpu (str): Name or identifier of the Variable Processing Unit (VPU).
+        cube (tuple): (shared memory name, shape) of the forcing cube, attached without copying.
+        catch_range (tuple): (start, end) catchment indices of the cube to write.
+        filename (str): Name of the netcdf file, see netcdf_filename.
         t_ax (numpy.ndarray): Array representing time axis.
         catchments (dict.keys()): Keys containing catchment IDs.
 
     Returns:
-        None
+        netcdf_cat_file_size: Size of the file in MB
+        write_time: Seconds spent writing the file, excluding the upload
     """
-    if FCST_CYCLE is None:
-        filename = f'{vpu}_forcings.nc'
-    else:
-        filename = f'ngen.{FCST_CYCLE}z.{URLBASE}.forcing.{LEAD_START}_{LEAD_END}.{vpu}.nc'
+    t0 = time.perf_counter()
     if storage_type == 's3':
-        s3_client = boto3.session.Session().client("s3")
-        nc_filename = forcing_path + "/" + filename
+        s3_client = boto3.session.Session().client("s3", endpoint_url=upload_kwargs["endpoint_url"])
+        bucket, key = convert_url2key(forcing_path + "/" + filename,'s3')
+        tmpfile = tempfile.NamedTemporaryFile(suffix='.nc')
+        nc_filename = tmpfile.name
     else:
         nc_filename = Path(forcing_path,filename)
 
-    data = np.transpose(data,(2,1,0))
+    cube_shm, cube_data = attach_cube(cube)
+    data = cube_data[:,:,catch_range[0]:catch_range[1]]
 
     t_utc = np.array([datetime.timestamp(datetime.strptime(jt,'%Y-%m-%d %H:%M:%S')) for jt in t_ax],dtype=np.float64)
 
-    catchments = np.array(catchments,dtype='str')
-    import netCDF4 as nc
+    with create_netcdf(nc_filename, list(catchments), len(t_utc)) as ds:
+        write_netcdf_time(ds, t_utc, 0, len(t_utc))
+        for var_dx, jvar in enumerate(ngen_variables):
+            ds[jvar][:, :] = data[:, var_dx, :].T
+    netcdf_cat_file_size = os.path.getsize(nc_filename) / B2MB
+    write_time = time.perf_counter() - t0
 
     if storage_type == 's3':
-        bucket, key = convert_url2key(nc_filename,'s3')
-        with tempfile.NamedTemporaryFile(suffix='.nc') as tmpfile:
-            with nc.Dataset(tmpfile.name, 'w', format='NETCDF4') as ds:
-                ds.createDimension('catchment-id', len(catchments))
-                ds.createDimension('time', len(t_utc))
-                ids_var = ds.createVariable('ids', str, ('catchment-id',))
-                time_var = ds.createVariable('Time', 'f8', ('catchment-id', 'time'))
-                ugrd_var = ds.createVariable('UGRD_10maboveground', 'f4', ('catchment-id', 'time'))
-                vgrd_var = ds.createVariable('VGRD_10maboveground', 'f4', ('catchment-id', 'time'))
-                dlwrf_var = ds.createVariable('DLWRF_surface', 'f4', ('catchment-id', 'time'))
-                apcp_var = ds.createVariable('APCP_surface', 'f4', ('catchment-id', 'time'))
-                precip_var = ds.createVariable('precip_rate', 'f4', ('catchment-id', 'time'))
-                tmp_var = ds.createVariable('TMP_2maboveground', 'f4', ('catchment-id', 'time'))
-                spfh_var = ds.createVariable('SPFH_2maboveground', 'f4', ('catchment-id', 'time'))
-                pres_var = ds.createVariable('PRES_surface', 'f4', ('catchment-id', 'time'))
-                dswrf_var = ds.createVariable('DSWRF_surface', 'f4', ('catchment-id', 'time'))
-                ids_var[:] = catchments
-                time_var[:, :] = np.tile(t_utc, (len(catchments), 1))
-                ugrd_var[:, :] = data[:, 0, :]
-                vgrd_var[:, :] = data[:, 1, :]
-                dlwrf_var[:, :] = data[:, 2, :]
-                apcp_var[:, :] = data[:, 3, :]
-                precip_var[:, :] = data[:, 4, :]
-                tmp_var[:, :] = data[:, 5, :]
-                spfh_var[:, :] = data[:, 6, :]
-                pres_var[:, :] = data[:, 7, :]
-                dswrf_var[:, :] = data[:, 8, :]
-            netcdf_cat_file_size = os.path.getsize(tmpfile.name) / B2MB
-            tmpfile.flush()
-            tmpfile.seek(0)
-            print(f"Uploading netcdf forcings to S3: bucket={bucket}, key={key}")
-            s3_client.upload_file(tmpfile.name, bucket, key)
-
+        print(f"Uploading netcdf forcings to S3: bucket={bucket}, key={key}")
+        s3_client.upload_file(nc_filename, bucket, key)
+        tmpfile.close()
     else:
-        with nc.Dataset(nc_filename, 'w', format='NETCDF4') as ds:
-            ds.createDimension('catchment-id', len(catchments))
-            ds.createDimension('time', len(t_utc))
-            ids_var = ds.createVariable('ids', str, ('catchment-id',))
-            time_var = ds.createVariable('Time', 'f8', ('catchment-id', 'time'))
-            ugrd_var = ds.createVariable('UGRD_10maboveground', 'f4', ('catchment-id', 'time'))
-            vgrd_var = ds.createVariable('VGRD_10maboveground', 'f4', ('catchment-id', 'time'))
-            dlwrf_var = ds.createVariable('DLWRF_surface', 'f4', ('catchment-id', 'time'))
-            apcp_var = ds.createVariable('APCP_surface', 'f4', ('catchment-id', 'time'))
-            precip_var = ds.createVariable('precip_rate', 'f4', ('catchment-id', 'time'))
-            tmp_var = ds.createVariable('TMP_2maboveground', 'f4', ('catchment-id', 'time'))
-            spfh_var = ds.createVariable('SPFH_2maboveground', 'f4', ('catchment-id', 'time'))
-            pres_var = ds.createVariable('PRES_surface', 'f4', ('catchment-id', 'time'))
-            dswrf_var = ds.createVariable('DSWRF_surface', 'f4', ('catchment-id', 'time'))
-            ids_var[:] = catchments
-            time_var[:, :] = np.tile(t_utc, (len(catchments), 1))
-            ugrd_var[:, :] = data[:, 0, :]
-            vgrd_var[:, :] = data[:, 1, :]
-            dlwrf_var[:, :] = data[:, 2, :]
-            apcp_var[:, :] = data[:, 3, :]
-            precip_var[:, :] = data[:, 4, :]
-            tmp_var[:, :] = data[:, 5, :]
-            spfh_var[:, :] = data[:, 6, :]
-            pres_var[:, :] = data[:, 7, :]
-            dswrf_var[:, :] = data[:, 8, :]
         print(f'netcdf has been written to {nc_filename}')  
-        netcdf_cat_file_size = os.path.getsize(nc_filename) / B2MB
 
-    return netcdf_cat_file_size  
+    del data, cube_data
+    release_cube(cube_shm)
+
+    return netcdf_cat_file_size, write_time
+
+def zarr_filename(vpu):
+    """
+    Name of the zarr forcings store of a VPU
+    """
+    return netcdf_filename(vpu)[:-len('.nc')] + '.zarr'
+
+def zarr_storage_options():
+    """
+    Keyword arguments for zarr.open_group, s3 stores honor the configured endpoint_url
+    """
+    if storage_type == 's3' and upload_kwargs["endpoint_url"] is not None:
+        return {"storage_options" : {"client_kwargs" : {"endpoint_url" : upload_kwargs["endpoint_url"]}}}
+    return {}
+
+def create_zarr(store_path, catchments, t_ax):
+    """
+    Create a zarr store with a (catchment-id x time) array per ngen variable, chunked by zarr_chunks
+    so that readers of a subset of catchments or times fetch only the chunks they need.
+
+    Parameters:
+        store_path (str): Local path or s3 url of the store.
+        catchments (list): Catchment IDs.
+        t_ax (list): Time axis.
+    """
+    import zarr
+    ncatch = len(catchments)
+    ntime = len(t_ax)
+    chunks = (max(1, min(zarr_chunks[0], ncatch)), max(1, min(zarr_chunks[1] or ntime, ntime)))
+    root = zarr.open_group(str(store_path), mode='w', **zarr_storage_options())
+    ids = root.create_array('ids', shape=(ncatch,), dtype=str)
+    ids[:] = np.array(catchments, dtype='str')
+    t_utc = np.array([datetime.timestamp(datetime.strptime(jt,'%Y-%m-%d %H:%M:%S')) for jt in t_ax],dtype=np.float64)
+    time_arr = root.create_array('Time', shape=(ntime,), dtype='f8')
+    time_arr[:] = t_utc
+    for jvar in ngen_variables:
+        root.create_array(jvar, shape=(ncatch, ntime), chunks=chunks, dtype='f4', fill_value=np.nan)
+    return chunks
 
-def multiprocess_write_netcdf(data, jcatchment_dict, t_ax):  
+def write_zarr(cube, catch_range, store_path, store_start):
     """
-    Write DataFrames to tar archives using multiprocessing.
+    Write the catchments of a chunk aligned region of the cube into an existing zarr store
 
     Parameters:
-        data (numpy.ndarray): 3D array with dimensions (catchment-id, time, forcing variable).
+        cube (tuple): (shared memory name, shape) of the forcing cube, attached without copying.
+        catch_range (tuple): (start, end) catchment indices of the cube to write.
+        store_path (str): Local path or s3 url of the store, see create_zarr.
+        store_start (int): Catchment index in the store of the first catchment of catch_range.
+
+    Returns:
+        write_time: Seconds spent writing the region
+    """
+    import zarr
+    t0 = time.perf_counter()
+    cube_shm, cube_data = attach_cube(cube)
+    data = cube_data[:,:,catch_range[0]:catch_range[1]]
+    root = zarr.open_group(str(store_path), mode='r+', **zarr_storage_options())
+    store_end = store_start + catch_range[1] - catch_range[0]
+    for var_dx, jvar in enumerate(ngen_variables):
+        root[jvar][store_start:store_end, :] = data[:, var_dx, :].T
+    del data, cube_data
+    release_cube(cube_shm)
+    return time.perf_counter() - t0
+
+def store_size_MB(store_path):
+    """
+    Size of a local directory or s3 prefix in MB
+    """
+    if storage_type == 's3':
+        return s3fs.S3FileSystem(client_kwargs={"endpoint_url" : upload_kwargs["endpoint_url"]}).du(str(store_path)) / B2MB
+    return sum([os.path.getsize(os.path.join(jroot, x)) for jroot, _, jfiles in os.walk(store_path) for x in jfiles]) / B2MB
+
+def multiprocess_write_zarr(cube, jcatchment_dict, t_ax):
+    """
+    Write a zarr store per VPU. The stores are created by the primary process, then the writer workers
+    fill chunk aligned catchment regions in parallel, so no two workers write the same chunk.
+
+    Parameters:
+        cube (tuple): (shared memory name, shape) of the forcing cube, see create_cube.
         jcatchment_dict (dict): Dictionary containing catchment chunks.
         t_ax (numpy.ndarray): Array representing time axis.
 
     Returns:
-        None
+        zarr_file_sizes: List of zarr store sizes in MB
+        zarr_write_times: List of seconds spent writing each store, summed over workers
+        startup: seconds from submission until the first zarr task started
+    """
+    i = 0
+    task_args = []
+    task_vpu = []
+    store_paths = []
+    for jchunk in jcatchment_dict:
+        ncatchments = len(jcatchment_dict[jchunk])
+        if storage_type == 's3':
+            store_path = forcing_path + "/" + zarr_filename(jchunk)
+        else:
+            store_path = Path(forcing_path, zarr_filename(jchunk))
+        store_paths.append(store_path)
+        chunks = create_zarr(store_path, jcatchment_dict[jchunk], t_ax)
+        # whole chunks per task, about four tasks per process across all stores
+        ntask_chunks = max(1, int(np.ceil(ncatchments / chunks[0] / (4 * nprocs))))
+        step = ntask_chunks * chunks[0]
+        for jstart in range(0, ncatchments, step):
+            jend = min(jstart + step, ncatchments)
+            task_args.append((cube, (i + jstart, i + jend), store_path, jstart))
+            task_vpu.append(len(store_paths) - 1)
+        i += ncatchments
+
+    write_times, _, _, startup = schedule_tasks(write_zarr, task_args, nprocs, "zarr tasks")
+    zarr_write_times = [sum([x for x, jvpu in zip(write_times, task_vpu) if jvpu == j]) for j in range(len(store_paths))]
+    zarr_file_sizes = [store_size_MB(x) for x in store_paths]
+    for x in store_paths: print(f'zarr has been written to {x}')
+
+    return zarr_file_sizes, zarr_write_times, startup
+
+def consolidated_parquet_filename(vpu):
+    """
+    Name of the consolidated parquet forcings file of a VPU, the row group index is written next to it
+    """
+    return netcdf_filename(vpu)[:-len('.nc')] + '.parquet'
+
+def write_consolidated_parquet(cube, catch_range, filename, t_ax, catchments):
+    """
+    Write the catchments of a VPU to a single long format parquet file (catchment_id, time, ngen variables).
+    Rows are sorted by catchment and each row group holds whole catchments, so readers selecting catchments
+    with a filter on catchment_id skip the other row groups through their statistics. A row group index
+    (catchment_id, row_group) is written alongside as {filename}.index.parquet.
+
+    Parameters:
+        cube (tuple): (shared memory name, shape) of the forcing cube, attached without copying.
+        catch_range (tuple): (start, end) catchment indices of the cube to write.
+        filename (str): Name of the parquet file, see consolidated_parquet_filename.
+        t_ax (list): Time axis.
+        catchments (list): Catchment IDs.
+
+    Returns:
+        file_size: Size of the file in MB
+        write_time: Seconds spent writing the file and its index
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    t0 = time.perf_counter()
+    if storage_type == 's3':
+        fs_out = s3fs.S3FileSystem(client_kwargs={"endpoint_url" : upload_kwargs["endpoint_url"]})
+        out_file = forcing_path + "/" + filename
+        index_file = out_file[:-len('.parquet')] + '.index.parquet'
+    else:
+        fs_out = None
+        out_file = str(Path(forcing_path, filename))
+        index_file = out_file[:-len('.parquet')] + '.index.parquet'
+
+    cube_shm, cube_data = attach_cube(cube)
+    data = cube_data[:,:,catch_range[0]:catch_range[1]]
+    nt = data.shape[0]
+    catchments = np.array(list(catchments), dtype='str')
+    order = np.argsort(catchments, kind='stable')
+    t = np.array(pd.to_datetime(t_ax).values, dtype='datetime64[s]')
+    schema = pa.schema([("catchment_id", pa.string()), ("time", pa.timestamp('s'))] + [(x, pa.float32()) for x in ngen_variables])
+
+    index_ids = []
+    index_rgs = []
+    with pq.ParquetWriter(out_file, schema, filesystem=fs_out, compression=parquet_compression) as writer:
+        for jrg, jstart in enumerate(range(0, len(catchments), parquet_row_group_catchments)):
+            jorder = order[jstart:jstart + parquet_row_group_catchments]
+            columns = {
+                "catchment_id" : np.repeat(catchments[jorder], nt),
+                "time"         : np.tile(t, len(jorder))
+            }
+            for var_dx, jvar in enumerate(ngen_variables):
+                columns[jvar] = data[:, var_dx, jorder].T.reshape(-1)
+            writer.write_table(pa.table(columns, schema=schema), row_group_size=len(jorder) * nt)
+            index_ids.extend(catchments[jorder])
+            index_rgs.extend([jrg] * len(jorder))
+    index_df = pd.DataFrame({"catchment_id" : index_ids, "row_group" : np.array(index_rgs, dtype=np.int32)})
+    if storage_type == 's3':
+        with fs_out.open(index_file, 'wb') as fp:
+            index_df.to_parquet(fp, index=False)
+        file_size = fs_out.size(out_file) / B2MB
+    else:
+        index_df.to_parquet(index_file, index=False)
+        file_size = os.path.getsize(out_file) / B2MB
+    print(f'consolidated parquet has been written to {out_file}')
+
+    del data, cube_data
+    release_cube(cube_shm)
+    return file_size, time.perf_counter() - t0
+
+def multiprocess_write_consolidated_parquet(cube, jcatchment_dict, t_ax):
+    """
+    Write a consolidated parquet file per VPU using the worker pool.
+
+    Parameters:
+        cube (tuple): (shared memory name, shape) of the forcing cube, see create_cube.
+        jcatchment_dict (dict): Dictionary containing catchment chunks.
+        t_ax (numpy.ndarray): Array representing time axis.
+
+    Returns:
+        file_sizes: List of file sizes in MB
+        write_times: List of seconds spent writing each file
+        startup: seconds from submission until the first task started
+    """
+    i = 0
+    task_args = []
+    for jchunk in jcatchment_dict:
+        k = i + len(jcatchment_dict[jchunk])
+        task_args.append((cube, (i, k), consolidated_parquet_filename(jchunk), t_ax, jcatchment_dict[jchunk]))
+        i = k
+    results, _, _, startup = schedule_tasks(write_consolidated_parquet, task_args, nprocs, "consolidated parquet tasks")
+    return [x[0] for x in results], [x[1] for x in results], startup
+
+def multiprocess_write_netcdf(cube, jcatchment_dict, t_ax):  
+    """
+    Write a netcdf file per VPU using the worker pool.
+
+    Parameters:
+        cube (tuple): (shared memory name, shape) of the forcing cube, see create_cube.
+        jcatchment_dict (dict): Dictionary containing catchment chunks.
+        t_ax (numpy.ndarray): Array representing time axis.
+
+    Returns:
+        netcdf_cat_file_sizes: List of netcdf file sizes in MB
+        netcdf_write_times: List of seconds spent writing each netcdf file
+        startup: seconds from submission until the first netcdf task started
     """    
     i=0
     k=0
-    data_list = []
+    cube_list = []
+    range_list = []
     vpu_list = []
     t_ax_list = []
     catchments_list = []
     for j, jchunk in enumerate(jcatchment_dict):  
         ncatchments = len(jcatchment_dict[jchunk])
         k += ncatchments
-        data_list.append(data[:,:,i:k])
-        vpu_list.append(jchunk)
+        cube_list.append(cube)
+        range_list.append((i,k))
+        vpu_list.append(netcdf_filename(jchunk))
         t_ax_list.append(t_ax)
         catchments_list.append(jcatchment_dict[jchunk]) 
         i=k      
 
+    task_args = list(zip(cube_list, range_list, vpu_list, t_ax_list, catchments_list))
+    results, _, _, startup = schedule_tasks(write_netcdf, task_args, nprocs, "netcdf tasks")
+    netcdf_cat_file_sizes = [x[0] for x in results]
+    netcdf_write_times = [x[1] for x in results]
+
+    return netcdf_cat_file_sizes, netcdf_write_times, startup
+
+def multiprocess_stream_netcdf(files, fs, jcatchment_dict):
+    """
+    Extract catchment forcings and append each completed time slice to per VPU netcdf files. Files are
+    submitted to the worker pool so that at most stream_slices time slices are held in memory at once,
+    so peak memory is bounded by stream_slices rather than by the number of files.
+
+    Parameters:
+        files (list): List of NWM files.
+        fs: an optional file system for cloud storage reads
+        jcatchment_dict (dict): Dictionary containing catchment chunks.
+
+    Returns:
+        t_ax (list): Time axis, always ascending.
+        nwm_data (numpy.ndarray): NWM data saved for plotting.
+        nwm_file_sizes (list): Size of each NWM file in MB.
+        nwm_transfer (list): MB transferred to read each NWM file.
+        nwm_decoded (list): MB of decompressed chunks of each NWM file.
+        cache_counts (tuple): NWM file cache hits and misses.
+        task_times (tuple): Per task durations in seconds, the process that ran each task and the pool startup time.
+        netcdf_cat_file_sizes (list): Size of each netcdf file in MB.
+        netcdf_write_times (list): Seconds spent writing each netcdf file.
+        stats (list): Per catchment statistics (forcing_variable x catchment) in the order of catchment_stat_names,
+            the median is None as it needs every time slice at once.
+    """
+    global LEAD_START, LEAD_END
+    nfiles = len(files)
+    task_size = task_files if task_files else int(np.ceil(nfiles / (4 * nprocs)))
+    task_size = max(1, min(task_size, stream_slices // nprocs))
+    tasks = make_tasks(nfiles, task_size)
+    if ii_verbose: print(f'Streaming {nfiles} files in {len(tasks)} tasks, at most {stream_slices} time slices in flight',flush=True)
+
+    if storage_type == 's3':
+        tmp_dir = tempfile.mkdtemp()
+    else:
+        tmp_dir = forcing_path
+    datasets = {}
+    ranges = {}
+    write_times = {}
+    i = 0
+    for jchunk in jcatchment_dict:
+        k = i + len(jcatchment_dict[jchunk])
+        ranges[jchunk] = (i, k)
+        write_times[jchunk] = 0
+        datasets[jchunk] = create_netcdf(Path(tmp_dir, f'{jchunk}_forcings.stream.nc'), jcatchment_dict[jchunk])
+        i = k
+
+    t_ax = [None] * nfiles
+    nwm_data = []
+    nwm_file_sizes = [0.] * nfiles
+    nwm_transfer = [0.] * nfiles
+    nwm_decoded = [0.] * nfiles
+    cache_hits = 0
+    cache_misses = 0
+    durations = [0.] * len(tasks)
+    pids = [0] * len(tasks)
+    tstarts = []
+    data_sum = None
+    data_min = None
+    data_max = None
+    data_nan = None
+    pending = {}
+    nflight = 0
+    jtask = 0
+    tsubmit = time.time()
+    while jtask < len(tasks) or pending:
+        while jtask < len(tasks) and (nflight == 0 or nflight + tasks[jtask][1] - tasks[jtask][0] <= stream_slices):
+            start, end = tasks[jtask]
+            future = worker_pool.submit(timed_task, forcing_grid2catchment, files[start:end], fs, None, start)
+            pending[future] = jtask
+            nflight += end - start
+            jtask += 1
+        done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+        for future in done:
+            j = pending.pop(future)
+            start, end = tasks[j]
+            results, durations[j], pids[j], tstart = future.result()
+            tstarts.append(tstart)
+            data = np.array(results[0])
+            t_ax[start:end] = results[1]
+            nwm_data.extend(results[2])
+            nwm_file_sizes[start:end] = results[3]
+            nwm_transfer[start:end] = results[4]
+            nwm_decoded[start:end] = results[6]
+            cache_hits += results[5][0]
+            cache_misses += results[5][1]
+            # NaN time slices are skipped, as in catchment_stats
+            data_sum = np.nansum(data, axis=0) if data_sum is None else data_sum + np.nansum(data, axis=0)
+            data_min = np.fmin.reduce(data, axis=0) if data_min is None else np.fmin(data_min, np.fmin.reduce(data, axis=0))
+            data_max = np.fmax.reduce(data, axis=0) if data_max is None else np.fmax(data_max, np.fmax.reduce(data, axis=0))
+            data_nan = np.count_nonzero(np.isnan(data), axis=0) + (0 if data_nan is None else data_nan)
+            t_utc = np.array([datetime.timestamp(datetime.strptime(jt,'%Y-%m-%d %H:%M:%S')) for jt in results[1]],dtype=np.float64)
+            for jchunk, ds in datasets.items():
+                t0 = time.perf_counter()
+                i, k = ranges[jchunk]
+                write_netcdf_time(ds, t_utc, start, end)
+                for var_dx, jvar in enumerate(ngen_variables):
+                    ds[jvar][:, start:end] = data[:, var_dx, i:k].T
+                write_times[jchunk] += time.perf_counter() - t0
+            del data, results
+            nflight -= end - start
+            if ii_verbose: print(f'{end} of {nfiles} time slices written',flush=True)
+
+    if datetime.strptime(t_ax[0],'%Y-%m-%d %H:%M:%S') > datetime.strptime(t_ax[-1],'%Y-%m-%d %H:%M:%S'):
+        # Ensure data is always written out with time moving forward, one pair of time slices at a time
+        t_ax = list(reversed(t_ax))
+        for ds in datasets.values():
+            for jvar in ['Time'] + ngen_variables:
+                for jt in range(nfiles // 2):
+                    tmp_slice = ds[jvar][..., jt]
+                    ds[jvar][..., jt] = ds[jvar][..., nfiles - 1 - jt]
+                    ds[jvar][..., nfiles - 1 - jt] = tmp_slice
+        tmp = LEAD_START
+        LEAD_START = LEAD_END
+        LEAD_END = tmp
+
     netcdf_cat_file_sizes = []
-    with cf.ProcessPoolExecutor(max_workers=min(len(jcatchment_dict),nprocs)) as pool:
-        for results in pool.map(
-            write_netcdf,
-            data_list, 
-            vpu_list, 
-            t_ax_list,
-            catchments_list):
-            netcdf_cat_file_sizes.append(results)
+    for jchunk, ds in datasets.items():
+        ds.close()
+        tmp_filename = Path(tmp_dir, f'{jchunk}_forcings.stream.nc')
+        netcdf_cat_file_sizes.append(os.path.getsize(tmp_filename) / B2MB)
+        if storage_type == 's3':
+            bucket, key = convert_url2key(forcing_path + "/" + netcdf_filename(jchunk),'s3')
+            print(f"Uploading netcdf forcings to S3: bucket={bucket}, key={key}")
+            boto3.session.Session().client("s3", endpoint_url=upload_kwargs["endpoint_url"]).upload_file(str(tmp_filename), bucket, key)
+            os.remove(tmp_filename)
+        else:
+            os.replace(tmp_filename, Path(forcing_path, netcdf_filename(jchunk)))
+            print(f'netcdf has been written to {Path(forcing_path, netcdf_filename(jchunk))}')
+    if storage_type == 's3': os.rmdir(tmp_dir)
 
-    return netcdf_cat_file_sizes
+    startup = max(min(tstarts) - tsubmit, 0) if len(tstarts) > 0 else 0
+    with np.errstate(invalid='ignore'):
+        stats = [data_sum / (nfiles - data_nan), None, data_min, data_max, data_nan]
+    return t_ax, np.array(nwm_data), nwm_file_sizes, nwm_transfer, nwm_decoded, (cache_hits, cache_misses), (durations, pids, startup), netcdf_cat_file_sizes, list(write_times.values()), stats
 
-def write_df(df, filename, storage_type, s3=None, bucket=None, key_prefix=None, local_path=None):
+def write_df(df, filename, storage_type, s3=None, bucket=None, key_prefix=None, local_path=None, uploader=None):
     """
     Write a DataFrame to S3 or local storage as a CSV or Parquet file.
     The file type is inferred from the filename extension.
@@ -663,6 +1421,7 @@ def write_df(df, filename, storage_type, s3=None, bucket=None, key_prefix=None,
         bucket (str, optional): S3 bucket name.
         key_prefix (str, optional): S3 key prefix (folder path).
         local_path (str, optional): Local directory path.
+        uploader (S3Uploader, optional): Queue the object on this uploader instead of uploading it with s3.
     """
     ext = Path(filename).suffix.lower()
     if ext == ".csv":
@@ -670,7 +1429,8 @@ def write_df(df, filename, storage_type, s3=None, bucket=None, key_prefix=None,
             buf = BytesIO()
             df.to_csv(buf, index=False)
             key_name = f"{key_prefix}/{filename}"
-            s3.put_object(Bucket=bucket, Key=key_name, Body=buf.getvalue())
+            if uploader is not None: uploader.put(bucket, key_name, buf.getvalue())
+            else: s3.put_object(Bucket=bucket, Key=key_name, Body=buf.getvalue())
             buf.close()
         else:
             out_path = Path(local_path, filename)
@@ -680,7 +1440,8 @@ def write_df(df, filename, storage_type, s3=None, bucket=None, key_prefix=None,
             buf = BytesIO()
             df.to_parquet(buf, index=False)
             key_name = f"{key_prefix}/{filename}"
-            s3.put_object(Bucket=bucket, Key=key_name, Body=buf.getvalue())
+            if uploader is not None: uploader.put(bucket, key_name, buf.getvalue())
+            else: s3.put_object(Bucket=bucket, Key=key_name, Body=buf.getvalue())
             buf.close()
         else:
             out_path = Path(local_path, filename)
@@ -698,6 +1459,16 @@ def prep_ngen_data(conf):
 
     Docs: https://github.com/CIROH-UA/ngen-datastream/blob/main/forcingprocessor/README.md
     """
+    try:
+        return run_ngen_data(conf)
+    finally:
+        # a stage that raises would otherwise leak the worker pool and the shared memory of the forcing cube
+        release_run_resources()
+
+def run_ngen_data(conf):
+    """
+    The stages of prep_ngen_data, which releases the worker pool and forcing cube if any of them raises
+    """
 
     t_start = time.perf_counter()
 
@@ -717,16 +1488,98 @@ def prep_ngen_data(conf):
     output_path = conf["storage"].get("output_path","")
     output_file_type = conf["storage"].get("output_file_type","csv") 
 
-    global ii_verbose, nprocs
+    global netcdf_time, netcdf_ids, netcdf_chunks, netcdf_zlib, netcdf_complevel, netcdf_shuffle
+    netcdf_time = conf["storage"].get("netcdf_time","2d")
+    netcdf_times = ["2d","1d"]
+    assert netcdf_time in netcdf_times, f"{netcdf_time} for netcdf_time is not accepted! Accepted: {netcdf_times}"
+    netcdf_ids = conf["storage"].get("netcdf_ids","str")
+    netcdf_id_types = ["str","fixed","int"]
+    assert netcdf_ids in netcdf_id_types, f"{netcdf_ids} for netcdf_ids is not accepted! Accepted: {netcdf_id_types}"
+    netcdf_chunks = conf["storage"].get("netcdf_chunks",None)
+    netcdf_zlib = conf["storage"].get("netcdf_zlib",False)
+    netcdf_complevel = conf["storage"].get("netcdf_complevel",4)
+    netcdf_shuffle = conf["storage"].get("netcdf_shuffle",False)
+
+    global zarr_chunks
+    zarr_chunks = conf["storage"].get("zarr_chunks",[512,None])
+
+    global upload_kwargs
+    upload_kwargs = {
+        "max_workers"            : conf["storage"].get("upload_threads",16),
+        "max_pending"            : conf["storage"].get("upload_max_pending",64),
+        "retries"                : conf["storage"].get("upload_retries",5),
+        "multipart_threshold_MB" : conf["storage"].get("multipart_threshold_MB",8),
+        "endpoint_url"           : conf["storage"].get("endpoint_url",None)
+    }
+
+    global tar_compression, tar_complevel, tar_threads
+    tar_compression = conf["storage"].get("tar_compression","gzip")
+    assert tar_compression in archive_extensions, f"{tar_compression} for tar_compression is not accepted! Accepted: {list(archive_extensions)}"
+    tar_complevel = conf["storage"].get("tar_complevel",archive_levels[tar_compression])
+    tar_threads = conf["storage"].get("tar_threads",1)
+
+    global parquet_row_group_catchments, parquet_compression
+    parquet_row_group_catchments = conf["storage"].get("parquet_row_group_catchments",256)
+    parquet_compression = conf["storage"].get("parquet_compression","zstd")
+
+    global ii_verbose, nprocs, ii_collect_stats
     ii_verbose = conf["run"].get("verbose",False) 
     ii_collect_stats = conf["run"].get("collect_stats",True)
     nprocs = conf["run"].get("nprocs",int(os.cpu_count() * 0.5))
 
+    global regrid_engine
+    regrid_engine = conf["run"].get("regrid_engine","sparse")
+    regrid_engines = ["sparse","numba","loop"]
+    assert regrid_engine in regrid_engines, f"{regrid_engine} for regrid_engine is not accepted! Accepted: {regrid_engines}"
+    global regrid_threads
+    regrid_threads = conf["run"].get("regrid_threads",max(1, os.cpu_count() // nprocs))
+
+    global chunk_sparse
+    chunk_sparse = conf["run"].get("chunk_sparse",True)
+
+    max_memory_GB = conf["run"].get("max_memory_gb",None)
+
+    global window_mode
+    window_mode = conf["run"].get("window_mode","group")
+    window_modes = ["group","single"]
+    assert window_mode in window_modes, f"{window_mode} for window_mode is not accepted! Accepted: {window_modes}"
+
+    global batch_size, batch_memory_MB
+    batch_size = conf["run"].get("batch_size",1)
+    batch_memory_MB = conf["run"].get("batch_memory_MB",1024)
+    ii_compile_weights = conf["run"].get("compile_weights",True)
+
+    global read_mode
+    read_mode = conf["run"].get("read_mode","download")
+    read_modes = ["download","range","reference"]
+    assert read_mode in read_modes, f"{read_mode} for read_mode is not accepted! Accepted: {read_modes}"
+    reference_dir = conf["run"].get("reference_dir",os.path.join(Path.home(),".forcingprocessor","references"))
+
+    cache_dir = conf["run"].get("cache_dir",None)
+    if cache_dir is not None:
+        configure_cache(cache_dir, conf["run"].get("cache_size_GB",20))
+
+    global prefetch_depth, prefetch_memory_MB, io_threads
+    prefetch_depth = conf["run"].get("prefetch_depth",0)
+    prefetch_memory_MB = conf["run"].get("prefetch_memory_MB",1024)
+    io_threads = conf["run"].get("io_threads",0)
+
+    global task_files, task_catchments
+    task_files = conf["run"].get("task_files",None)
+    task_catchments = conf["run"].get("task_catchments",None)
+
+    global stream_slices
+    ii_stream = conf["run"].get("stream",False)
+    stream_slices = conf["run"].get("stream_slices",24)
+
+    global ngen_variables, nwm_sources, fan_out
+    ngen_variables, nwm_sources, fan_out = read_plan(conf["forcing"].get("ngen_variables",list(variable_map)))
+
     global ii_plot, nts_plot, ngen_vars_plot
     ii_plot = conf.get("plot",False)
     if ii_plot: 
         nts_plot = conf["plot"].get("nts_plot",10)
-        ngen_vars_plot = conf["plot"].get("ngen_vars",ngen_variables)
+        ngen_vars_plot = [x for x in ngen_variables if x in conf["plot"].get("ngen_vars",ngen_variables)]
     else:
         nts_plot = 0
         ngen_vars_plot = []
@@ -742,12 +1595,16 @@ def prep_ngen_data(conf):
     t_extract  = 0
     write_time = 0
 
-    file_types = ["csv", "parquet","tar","netcdf"]
+    file_types = ["csv", "parquet","tar","netcdf","zarr","consolidated_parquet"]
     for jtype in output_file_type:
         assert (
             jtype in file_types
         ), f"{jtype} for output_file_type is not accepted! Accepted: {file_types}"
         assert not ("parquet" in output_file_type and "csv" in output_file_type), "Both parquet and csv cannot be simultaneously specified in output_file_type, pick one."
+    if ii_stream:
+        stream_types = ["netcdf"]
+        assert all([x in stream_types for x in output_file_type]), f"{output_file_type} for output_file_type is not accepted in stream mode! Accepted: {stream_types}"
+        assert not ii_plot, "Plotting is not supported in stream mode"
     global storage_type
     if "s3://" in output_path:
         storage_type = "s3"
@@ -764,27 +1621,49 @@ def prep_ngen_data(conf):
 
     log_time("CONFIGURATION_END", log_file)
 
-    log_time("READWEIGHTS_START", log_file) 
+    global weights_df, windows, weights_mat
     tw = time.perf_counter()
-    if ii_verbose: print(f'Obtaining weights\n',flush=True) 
-    global weights_df
-    weights_df, jcatchment_dict = multiprocess_hf2ds(gpkg_files,nwm_forcing_files[0],nprocs)
-    log_time("READWEIGHTS_END", log_file)
-
-    # # conus hack
-    # x = {}
-    # x_list = []
-    # for jdict in jcatchment_dict:
-    #     [x_list.append(x) for x in jcatchment_dict[jdict]]
-    # x['conus'] = x_list
-    # jcatchment_dict = x
-
-    log_time("CALC_WINDOW_START", log_file)
-    ncatchments = len(weights_df)
-    global x_min, x_max, y_min, y_max
-    x_min, x_max, y_min, y_max = get_window(weights_df)
+    compiled_path = None
+    compiled = None
+    weights_arrays = None
+    if ii_compile_weights and storage_type == "local" and output_path != "" and regrid_engine != "loop":
+        compiled_path = Path(output_path,'metadata','forcings_metadata','compiled_weights')
+        weights_key = calc_weights_key(gpkg_files + [window_mode])
+        compiled = load_compiled_weights(compiled_path, weights_key)
+
+    if compiled is not None:
+        if ii_verbose: print(f'Reusing compiled weights {compiled_path}\n',flush=True)
+        weights_mat, windows, catchment_ids, jcatchment_dict, weights_arrays = compiled
+        weights_df = pd.DataFrame(index=catchment_ids)
+        ncatchments = len(weights_df)
+    else:
+        log_time("READWEIGHTS_START", log_file) 
+        if ii_verbose: print(f'Obtaining weights\n',flush=True) 
+        weights_df, jcatchment_dict = multiprocess_hf2ds(gpkg_files,nwm_forcing_files[0],nprocs)
+        log_time("READWEIGHTS_END", log_file)
+
+        # # conus hack
+        # x = {}
+        # x_list = []
+        # for jdict in jcatchment_dict:
+        #     [x_list.append(x) for x in jcatchment_dict[jdict]]
+        # x['conus'] = x_list
+        # jcatchment_dict = x
+
+        log_time("CALC_WINDOW_START", log_file)
+        ncatchments = len(weights_df)
+        # the loop engine indexes a single window
+        if window_mode == "group" and regrid_engine != "loop":
+            windows, catchment_window = get_windows(weights_df, jcatchment_dict)
+        else:
+            windows, catchment_window = [get_window(weights_df)], None
+        weights_mat = None
+        if regrid_engine != "loop":
+            weights_mat = build_weights_matrix(weights_df, windows, catchment_window)
+            if compiled_path is not None:
+                weights_arrays = write_compiled_weights(compiled_path, weights_key, weights_mat, windows, list(weights_df.index), jcatchment_dict)
+        log_time("CALC_WINDOW_END", log_file)
     weight_time = time.perf_counter() - tw
-    log_time("CALC_WINDOW_END", log_file)
 
     log_time("STORE_METADATA_START", log_file)            
     global forcing_path
@@ -804,7 +1683,7 @@ def prep_ngen_data(conf):
             json.dump(conf, f)
         cp_cmd = f'cp {nwm_file} {metaf_path}'
         os.system(cp_cmd)
-        weights_df.to_parquet(os.path.join(metaf_path,"weights.parquet"))
+        if compiled is None: weights_df.to_parquet(os.path.join(metaf_path,"weights.parquet"))
 
     elif storage_type == "s3":
         bucket_path  = output_path
@@ -814,7 +1693,7 @@ def prep_ngen_data(conf):
         bucket, key  = convert_url2key(metaf_path,storage_type)
         conf_path    = f"{key}/conf_fp.json"
         filenamelist_path = f"{key}/{os.path.basename(nwm_file)}"
-        s3 = boto3.client("s3")          
+        s3 = boto3.client("s3", endpoint_url=upload_kwargs["endpoint_url"])          
         s3.put_object(
                 Body=json.dumps(conf),
                 Bucket=bucket,
@@ -874,40 +1753,189 @@ def prep_ngen_data(conf):
         for jfile in nwm_forcing_files:
             print(f"{jfile}")
 
-    log_time("PROCESSING_START", log_file)
-    t0 = time.perf_counter()
-    if ii_verbose: print(f'Entering data extraction...\n',flush=True)   
-    # data_array, t_ax, nwm_data, nwm_file_sizes_MB = forcing_grid2catchment(nwm_forcing_files, fs)
-    # data_array=data_array[0][None,:]
-    # t_ax = t_ax
-    # nwm_data=nwm_data[0][None,:]
-    data_array, t_ax, nwm_data, nwm_file_sizes_MB = multiprocess_data_extract(nwm_forcing_files,nprocs,weights_df,fs)
-
-    if datetime.strptime(t_ax[0],'%Y-%m-%d %H:%M:%S') > datetime.strptime(t_ax[-1],'%Y-%m-%d %H:%M:%S'):
-        # Hack to ensure data is always written out with time moving forward.
-        t_ax=list(reversed(t_ax))
-        data_array = np.flip(data_array,axis=0)
-        tmp = LEAD_START
-        LEAD_START = LEAD_END
-        LEAD_END = tmp
-
-    t_extract = time.perf_counter() - t0
-    complexity = (nfiles * ncatchments) / 10000
-    score = complexity / t_extract
-    if ii_verbose: print(f'Data extract processs: {nprocs:.2f}\nExtract time: {t_extract:.2f}\nComplexity: {complexity:.2f}\nScore: {score:.2f}\n', end=None,flush=True)
-    log_time("PROCESSING_END", log_file)
-
-    log_time("FILEWRITING_START", log_file)
-    t0 = time.perf_counter()
-    if "netcdf" in output_file_type:
-        netcdf_cat_file_sizes_MB = multiprocess_write_netcdf(data_array, jcatchment_dict, t_ax)
-    if ii_verbose: print(f'Writing catchment forcings to {output_path}!', end=None,flush=True)  
-    forcing_cat_ids, dfs, filenames, individual_cat_file_sizes_MB, individual_cat_file_sizes_MB_zipped, tar_buffs = multiprocess_write(data_array,t_ax,list(weights_df.index),nprocs,forcing_path)
-
-    write_time += time.perf_counter() - t0    
-    write_rate = ncatchments / write_time
-    if ii_verbose: print(f'\n\nWrite processs: {nprocs}\nWrite time: {write_time:.2f}\nWrite rate {write_rate:.2f} files/second\n', end=None,flush=True)
-    log_time("FILEWRITING_END", log_file)
+    global nwm_references
+    nwm_references = {}
+    if read_mode == "reference":
+        log_time("REFERENCE_INDEX_START", log_file)
+        t0 = time.perf_counter()
+        if ii_verbose: print(f'Loading NWM chunk references from {reference_dir}',flush=True)
+        fs_ref = gcsfs.GCSFileSystem() if fs_type == 'google' else fs
+        bucket_keys = []
+        for jfile in nwm_forcing_files:
+            if fs_ref and jfile.find('https://') >= 0: _, bucket_key = convert_url2key(jfile,fs_type)
+            else: bucket_key = jfile
+            bucket_keys.append(bucket_key)
+        with cf.ThreadPoolExecutor(max_workers=min(len(bucket_keys),4*nprocs)) as pool:
+            futures = {pool.submit(load_reference, jkey, fs_ref, nwm_sources, reference_dir) : jfile for jfile, jkey in zip(nwm_forcing_files, bucket_keys)}
+            for future in cf.as_completed(futures):
+                jfile = futures[future]
+                try:
+                    nwm_references[jfile] = future.result()
+                except (OSError, NotImplementedError) as e:
+                    # not hdf5 based (e.g. netcdf3) or an unsupported filter, read_nwm_file downloads files without a reference
+                    print(f'No reference for {jfile} ({e}), downloading whole file',flush=True)
+        if ii_verbose: print(f'{len(nwm_references)} references loaded in {time.perf_counter() - t0:.2f}s',flush=True)
+        log_time("REFERENCE_INDEX_END", log_file)
+
+    # shards of catchments extracted and written end to end within max_memory_gb
+    memory_GB = estimate_memory_GB(nfiles, ncatchments, window_offsets(windows)[1], weights_mat.nnz if weights_mat is not None else shard_windows(np.arange(ncatchments))[2])
+    shards = [(jcatchment_dict, np.arange(ncatchments), memory_GB)]
+    # shards are cut along the groups, which must follow the weights rows
+    ii_groups = [x for jgroup in jcatchment_dict for x in jcatchment_dict[jgroup]] == list(weights_df.index)
+    if max_memory_GB is not None and not ii_stream and memory_GB > max_memory_GB and ii_groups:
+        shards = plan_shards(jcatchment_dict, nfiles, max_memory_GB)
+        if ii_verbose: print(f'Estimated {memory_GB:.2f} GB over max_memory_gb {max_memory_GB}, processing {len(shards)} shards of at most {max([x[2] for x in shards]):.2f} GB',flush=True)
+    elif max_memory_GB is not None and not ii_stream and memory_GB > max_memory_GB:
+        print(f'Estimated {memory_GB:.2f} GB over max_memory_gb {max_memory_GB}, but the catchment groups do not follow the order of the weights, so the run cannot be sharded and is processed whole',flush=True)
+    ii_shard = len(shards) > 1
+    tmp_cache = None
+    if ii_shard and read_mode == "download" and not cache_enabled() and (fs or 'https://' in nwm_forcing_files[0]):
+        # NWM files are downloaded once and read from the cache by later shards
+        tmp_cache = tempfile.mkdtemp()
+        configure_cache(tmp_cache, conf["run"].get("cache_size_GB",20))
+
+    global worker_pool
+    if not ii_shard:
+        log_time("WORKER_POOL_START", log_file)
+        t0 = time.perf_counter()
+        # workers map the arrays this process loaded, not whatever the artifact holds when they start
+        weights_artifact = (weights_arrays, weights_mat.shape) if weights_arrays is not None else None
+        worker_pool = start_worker_pool(nprocs, weights_artifact)
+        pool_time = time.perf_counter() - t0
+        if ii_verbose: print(f'{nprocs} workers started in {pool_time:.2f}s',flush=True)
+        log_duration("WORKER_POOL_STARTUP", pool_time, log_file)
+        log_time("WORKER_POOL_END", log_file)
+
+    if ii_stream:
+        log_time("PROCESSING_START", log_file)
+        t0 = time.perf_counter()
+        if ii_verbose: print(f'Entering streaming data extraction...\n',flush=True)
+        t_ax, nwm_data, nwm_file_sizes_MB, nwm_transfer_MB, nwm_decoded_MB, cache_counts, extract_task_times, netcdf_cat_file_sizes_MB, netcdf_write_times, catch_stats = multiprocess_stream_netcdf(nwm_forcing_files,fs,jcatchment_dict)
+        log_duration("EXTRACT_POOL_STARTUP", extract_task_times[2], log_file)
+        t_extract = time.perf_counter() - t0
+        log_time("PROCESSING_END", log_file)
+        forcing_cat_ids = [x.split("-")[1] for x in weights_df.index]
+        individual_cat_file_sizes_MB = []
+        individual_cat_file_sizes_MB_zipped = []
+        write_task_times = ([], [], 0)
+        upload_stats = (0, 0, 0, 0, 0)
+        tar_stats = (0, 0, 0)
+    else:
+        run_weights = (weights_df, weights_mat, windows)
+        t_extract = 0
+        nwm_file_sizes_MB, nwm_transfer_MB, nwm_decoded_MB = [], [], []
+        netcdf_cat_file_sizes_MB, netcdf_write_times = [], []
+        zarr_file_sizes_MB, zarr_write_times = [], []
+        cparquet_file_sizes_MB, cparquet_write_times = [], []
+        forcing_cat_ids, individual_cat_file_sizes_MB, individual_cat_file_sizes_MB_zipped = [], [], []
+        cache_counts = (0, 0)
+        extract_task_times = ([], [], 0)
+        write_task_times = ([], [], 0)
+        shard_stats = []
+        tar_shards = {jchunk : [] for jchunk in jcatchment_dict}
+        tar_stats = (0, 0, 0)
+        upload_totals = (0, 0, 0, 0)
+        for jshard, (jcatchment_shard, jrows, jmemory_GB) in enumerate(shards):
+            if ii_shard:
+                if ii_verbose: print(f'Shard {jshard + 1} of {len(shards)}: {len(jrows)} catchments of {list(jcatchment_shard)}, estimated {jmemory_GB:.2f} GB',flush=True)
+                # workers copy the shard weights and windows when the pool starts
+                weights_df, weights_mat, windows = run_weights
+                weights_mat, windows, _ = shard_windows(jrows)
+                weights_df = weights_df.iloc[jrows]
+                if worker_pool is not None: worker_pool.shutdown()
+                log_time("WORKER_POOL_START", log_file)
+                t0 = time.perf_counter()
+                worker_pool = start_worker_pool(nprocs)
+                log_duration("WORKER_POOL_STARTUP", time.perf_counter() - t0, log_file)
+                log_time("WORKER_POOL_END", log_file)
+
+            log_time("PROCESSING_START", log_file)
+            t0 = time.perf_counter()
+            if ii_verbose: print(f'Entering data extraction...\n',flush=True)   
+            # data_array, t_ax, nwm_data, nwm_file_sizes_MB = forcing_grid2catchment(nwm_forcing_files, fs)
+            # data_array=data_array[0][None,:]
+            # t_ax = t_ax
+            # nwm_data=nwm_data[0][None,:]
+            cube_shm, cube, data_array, t_ax, jnwm_data, jsizes, jtransfer, jdecoded, jcache_counts, jextract_times = multiprocess_data_extract(nwm_forcing_files,nprocs,weights_df,fs)
+            log_duration("EXTRACT_POOL_STARTUP", jextract_times[2], log_file)
+            if jshard == 0: nwm_data = jnwm_data
+            nwm_file_sizes_MB.extend(jsizes)
+            nwm_transfer_MB.extend(jtransfer)
+            nwm_decoded_MB.extend(jdecoded)
+            cache_counts = (cache_counts[0] + jcache_counts[0], cache_counts[1] + jcache_counts[1])
+            extract_task_times = (extract_task_times[0] + list(jextract_times[0]), extract_task_times[1] + list(jextract_times[1]), extract_task_times[2] + jextract_times[2])
+
+            if datetime.strptime(t_ax[0],'%Y-%m-%d %H:%M:%S') > datetime.strptime(t_ax[-1],'%Y-%m-%d %H:%M:%S'):
+                # Hack to ensure data is always written out with time moving forward.
+                t_ax=list(reversed(t_ax))
+                # swap time slices in place, writers attach to the cube by name so it cannot be replaced by a flipped copy
+                nt = data_array.shape[0]
+                for jt in range(nt // 2):
+                    tmp_slice = data_array[jt].copy()
+                    data_array[jt] = data_array[nt - 1 - jt]
+                    data_array[nt - 1 - jt] = tmp_slice
+                if jshard == 0:
+                    tmp = LEAD_START
+                    LEAD_START = LEAD_END
+                    LEAD_END = tmp
+
+            jt_extract = time.perf_counter() - t0
+            t_extract += jt_extract
+            complexity = (nfiles * len(jrows)) / 10000
+            score = complexity / jt_extract
+            if ii_verbose: print(f'Data extract processs: {nprocs:.2f}\nExtract time: {jt_extract:.2f}\nComplexity: {complexity:.2f}\nScore: {score:.2f}\n', end=None,flush=True)
+            log_time("PROCESSING_END", log_file)
+
+            log_time("FILEWRITING_START", log_file)
+            t0 = time.perf_counter()
+            if "netcdf" in output_file_type:
+                jsizes, jtimes, netcdf_startup = multiprocess_write_netcdf(cube, jcatchment_shard, t_ax)
+                netcdf_cat_file_sizes_MB.extend(jsizes)
+                netcdf_write_times.extend(jtimes)
+                log_duration("NETCDF_POOL_STARTUP", netcdf_startup, log_file)
+            if "zarr" in output_file_type:
+                jsizes, jtimes, zarr_startup = multiprocess_write_zarr(cube, jcatchment_shard, t_ax)
+                zarr_file_sizes_MB.extend(jsizes)
+                zarr_write_times.extend(jtimes)
+                log_duration("ZARR_POOL_STARTUP", zarr_startup, log_file)
+            if "consolidated_parquet" in output_file_type:
+                jsizes, jtimes, cparquet_startup = multiprocess_write_consolidated_parquet(cube, jcatchment_shard, t_ax)
+                cparquet_file_sizes_MB.extend(jsizes)
+                cparquet_write_times.extend(jtimes)
+                log_duration("CONSOLIDATED_PARQUET_POOL_STARTUP", cparquet_startup, log_file)
+            if ii_verbose: print(f'Writing catchment forcings to {output_path}!', end=None,flush=True)  
+            jids, jsizes, jzipped, jstats, jtar_shards, jtar_stats, jwrite_times, jupload_stats = multiprocess_write(cube,t_ax,list(weights_df.index),jcatchment_shard,nprocs,forcing_path,int(jrows[0]) if len(jrows) else 0)
+            log_duration("WRITE_POOL_STARTUP", jwrite_times[2], log_file)
+            forcing_cat_ids.extend(jids)
+            individual_cat_file_sizes_MB.extend(jsizes)
+            individual_cat_file_sizes_MB_zipped.extend(jzipped)
+            shard_stats.append(jstats)
+            for jchunk in jtar_shards: tar_shards[jchunk].extend(jtar_shards[jchunk])
+            tar_stats = tuple([x + y for x, y in zip(tar_stats, jtar_stats)])
+            write_task_times = (write_task_times[0] + list(jwrite_times[0]), write_task_times[1] + list(jwrite_times[1]), write_task_times[2] + jwrite_times[2])
+            # MB, requests, retries and seconds, the rates are recombined over the shards
+            jupload_secs = jupload_stats[1] / jupload_stats[4] if jupload_stats[4] > 0 else 0
+            upload_totals = tuple([x + y for x, y in zip(upload_totals, jupload_stats[:3] + (jupload_secs,))])
+
+            write_time += time.perf_counter() - t0    
+            write_rate = ncatchments / write_time
+            if ii_verbose: print(f'\n\nWrite processs: {nprocs}\nWrite time: {write_time:.2f}\nWrite rate {write_rate:.2f} files/second\n', end=None,flush=True)
+            log_time("FILEWRITING_END", log_file)
+
+            # statistics were collected by the writers, only the plotted variables of the first shard are kept
+            if ii_plot and jshard == 0:
+                plot_data = data_array[:,[x for x in range(len(ngen_variables)) if ngen_variables[x] in ngen_vars_plot],:]
+                plot_cat_ids = list(jids)
+            del data_array
+            release_cube(cube_shm, unlink=True)
+
+        weights_df, weights_mat, windows = run_weights
+        catch_stats = [None if shard_stats[0] is None or shard_stats[0][j] is None else np.concatenate([x[j] for x in shard_stats], axis=1) for j in range(len(catchment_stat_names))]
+        upload_MB, upload_requests, upload_retries, upload_secs = upload_totals
+        upload_stats = (upload_MB, upload_requests, upload_retries, upload_MB / upload_secs if upload_secs > 0 else 0, upload_requests / upload_secs if upload_secs > 0 else 0)
+        if tmp_cache is not None:
+            configure_cache(None)
+            shutil.rmtree(tmp_cache)
 
     runtime = time.perf_counter() - t_start
 
@@ -918,14 +1946,14 @@ def prep_ngen_data(conf):
 
             if len(gpkg_files) > 1: 
                 raise Warning(f'Plotting only the first geopackage {gpkg_files[0]}')
+            if ii_shard: print(f'Plotting only the catchments of the first shard')
 
-            cat_ids = ['cat-' + x for x in forcing_cat_ids]
-            jplot_vars = np.array([x for x in range(len(ngen_variables)) if ngen_variables[x] in ngen_vars_plot])
+            cat_ids = ['cat-' + x for x in plot_cat_ids]
             if storage_type == "s3":
                 gif_out = './GIFs'
             else:
                 gif_out = Path(meta_path,'GIFs')
-            plot_ngen_forcings(nwm_data, data_array[:,jplot_vars,:], gpkg_files[0], t_ax, cat_ids, ngen_vars_plot, gif_out)
+            plot_ngen_forcings(nwm_data, plot_data, gpkg_files[0], t_ax, cat_ids, ngen_vars_plot, gif_out)
             if storage_type == "s3":
                 sync_cmd = f'aws s3 sync ./GIFs {meta_path}/GIFs'
                 os.system(sync_cmd)
@@ -939,6 +1967,12 @@ def prep_ngen_data(conf):
         nwm_file_size_avg = np.average(nwm_file_sizes_MB)
         nwm_file_size_med = np.median(nwm_file_sizes_MB)
         nwm_file_size_std = np.std(nwm_file_sizes_MB)
+        nwm_transfer_avg = np.average(nwm_transfer_MB)
+        nwm_decoded_avg = np.average(nwm_decoded_MB)
+        extract_task_avg, extract_task_max, extract_imbalance = task_stats(*extract_task_times[:2])
+        write_task_avg, write_task_max, write_imbalance = task_stats(*write_task_times[:2])
+        tar_ratio = tar_stats[0] / tar_stats[1] if tar_stats[1] > 0 else 0
+        tar_compress_MBps = tar_stats[0] / tar_stats[2] if tar_stats[2] > 0 else 0
 
         individual_catch_file_size_avg = 0
         individual_catch_file_size_med = 0
@@ -956,20 +1990,44 @@ def prep_ngen_data(conf):
             individual_catch_file_zip_size_std = np.std(individual_cat_file_sizes_MB_zipped) 
 
         netcdf_catch_file_size_avg = 0
+        netcdf_write_time_avg = 0
+        zarr_file_size_avg = 0
+        zarr_write_time_avg = 0
+        if "zarr" in output_file_type and not ii_stream:
+            zarr_file_size_avg = np.average(zarr_file_sizes_MB)
+            zarr_write_time_avg = np.average(zarr_write_times)
+        cparquet_file_size_avg = 0
+        cparquet_write_time_avg = 0
+        if "consolidated_parquet" in output_file_type and not ii_stream:
+            cparquet_file_size_avg = np.average(cparquet_file_sizes_MB)
+            cparquet_write_time_avg = np.average(cparquet_write_times)
         netcdf_catch_file_size_med = 0
         netcdf_catch_file_size_std = 0
         if "netcdf" in output_file_type:
             netcdf_catch_file_size_avg = np.average(np.fromiter(netcdf_cat_file_sizes_MB, dtype=float))
             netcdf_catch_file_size_med = np.median(netcdf_cat_file_sizes_MB)
             netcdf_catch_file_size_std = np.std(netcdf_cat_file_sizes_MB)            
+            netcdf_write_time_avg = np.average(netcdf_write_times)
 
         metadata = {        
             "runtime_s"               : [round(runtime,2)],
-            "nvars_intput"            : [len(nwm_variables)],               
+            "nvars_intput"            : [len(nwm_sources)],               
             "nwmfiles_input"          : [len(nwm_forcing_files)],           
             "nwm_file_size_avg_MB"    : [nwm_file_size_avg],
             "nwm_file_size_med_MB"    : [nwm_file_size_med],
             "nwm_file_size_std_MB"    : [nwm_file_size_std],
+            "nwm_transfer_avg_MB"     : [nwm_transfer_avg],
+            "nwm_decoded_avg_MB"      : [nwm_decoded_avg],
+            "nwm_windows"             : [len(windows)],
+            "memory_est_GB"           : [max([x[2] for x in shards])],
+            "memory_shards"           : [len(shards)],
+            "nwm_window_cells"        : [window_offsets(windows)[1]],
+            "nwm_cache_hits"          : [cache_counts[0]],
+            "nwm_cache_misses"        : [cache_counts[1]],
+            "extract_tasks"           : [len(extract_task_times[0])],
+            "extract_task_time_avg_s" : [extract_task_avg],
+            "extract_task_time_max_s" : [extract_task_max],
+            "extract_imbalance"       : [extract_imbalance],
             "catch_files_output"      : [nfiles],
             "nvars_output"            : [len(ngen_variables)],
             "individual_catch_file_size_avg_MB"  : [individual_catch_file_size_avg],
@@ -980,27 +2038,44 @@ def prep_ngen_data(conf):
             "individual_catch_file_zip_size_std_MB" : [individual_catch_file_zip_size_std],   
             "netcdf_catch_file_size_avg_MB"  : [netcdf_catch_file_size_avg],
             "netcdf_catch_file_size_med_MB"  : [netcdf_catch_file_size_med],
-            "netcdf_catch_file_size_std_MB"  : [netcdf_catch_file_size_std]                                                      
+            "netcdf_catch_file_size_std_MB"  : [netcdf_catch_file_size_std],
+            "netcdf_write_time_avg_s" : [netcdf_write_time_avg],
+            "zarr_file_size_avg_MB"   : [zarr_file_size_avg],
+            "zarr_write_time_avg_s"   : [zarr_write_time_avg],
+            "consolidated_parquet_file_size_avg_MB" : [cparquet_file_size_avg],
+            "consolidated_parquet_write_time_avg_s" : [cparquet_write_time_avg],
+            "write_tasks"             : [len(write_task_times[0])],
+            "write_task_time_avg_s"   : [write_task_avg],
+            "write_task_time_max_s"   : [write_task_max],
+            "write_imbalance"         : [write_imbalance],
+            "tar_compression"         : [tar_compression],
+            "tar_MB"                  : [tar_stats[1]],
+            "tar_ratio"               : [tar_ratio],
+            "tar_compress_MBps"       : [tar_compress_MBps],
+            "upload_MB"               : [upload_stats[0]],
+            "upload_requests"         : [upload_stats[1]],
+            "upload_retries"          : [upload_stats[2]],
+            "upload_MBps"             : [upload_stats[3]],
+            "upload_requests_per_s"   : [upload_stats[4]]                                                      
         }
 
-        data_avg = np.average(data_array,axis=0)
-        avg_df = pd.DataFrame(data_avg.T,columns=ngen_variables)
-        avg_df.insert(0,"catchment id",forcing_cat_ids)
-
-        data_med = np.median(data_array,axis=0)
-        med_df = pd.DataFrame(data_med.T,columns=ngen_variables)
-        med_df.insert(0,"catchment id",forcing_cat_ids)     
-
-        del data_array   
+        stat_dfs = {}
+        for jname, jstat in zip(catchment_stat_names, catch_stats):
+            if jstat is None: continue
+            stat_dfs[jname] = pd.DataFrame(jstat.T,columns=ngen_variables)
+            stat_dfs[jname].insert(0,"catchment id",forcing_cat_ids)
 
         metadata_df = pd.DataFrame.from_dict(metadata)
         if storage_type == 's3':
-            bucket, key = convert_url2key(output_path,storage_type)
-            meta_path = f"{key}/metadata/forcings_metadata/"
+            bucket, key = convert_url2key(metaf_path,storage_type)
+            meta_kwargs = {"uploader" : get_uploader(**upload_kwargs), "bucket" : bucket, "key_prefix" : key}
+        else:
+            meta_kwargs = {"local_path" : metaf_path}
 
-        write_df(metadata_df, "metadata.csv", storage_type, local_path=metaf_path)
-        write_df(avg_df, "catchments_avg.csv", storage_type, local_path=metaf_path)
-        write_df(med_df, "catchments_median.csv", storage_type, local_path=metaf_path)
+        write_df(metadata_df, "metadata.csv", storage_type, **meta_kwargs)
+        for jname, jdf in stat_dfs.items():
+            write_df(jdf, f"catchments_{jname}.csv", storage_type, **meta_kwargs)
+        if storage_type == 's3': meta_kwargs["uploader"].flush()
 
         meta_time = time.perf_counter() - t000
         log_time("METADATA_END", log_file)
@@ -1009,10 +2084,14 @@ def prep_ngen_data(conf):
         log_time("TAR_START", log_file)
         if ii_verbose: print(f'\nWriting tarball...',flush=True)
         t0000 = time.perf_counter()
-        multiprocess_write_tars(dfs,jcatchment_dict,filenames,tar_buffs)    
+        tar_startup = multiprocess_write_tars(tar_shards)
+        log_duration("TAR_POOL_STARTUP", tar_startup, log_file)
         tar_time = time.perf_counter() - t0000
         log_time("TAR_END", log_file)
 
+    worker_pool.shutdown()
+    worker_pool = None
+
     if ii_verbose:
         print(f"\n\n--------SUMMARY-------")
         msg = f"\nData has been written to {output_path}"
@@ -0,0 +1,123 @@
+import os, time, threading
+import concurrent.futures as cf
+from io import BytesIO
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+B2MB = 1048576
+
+# One uploader per process, see get_uploader
+uploader = None
+uploader_pid = None
+
+class S3Uploader:
+    """
+    Uploads objects to S3 from a pool of threads sharing one session and connection pool.
+
+    Submitting blocks once max_pending uploads are queued, so a writer producing objects faster than
+    they can be uploaded is held back instead of buffering without bound. Objects larger than
+    multipart_threshold_MB are sent as multipart uploads. Failed requests are retried with
+    exponential backoff.
+
+    max_workers            : number of upload threads
+    max_pending            : maximum number of objects queued or in flight
+    retries                : attempts per object before the error is raised
+    multipart_threshold_MB : objects at least this large use multipart uploads
+    endpoint_url           : optional S3 compatible endpoint, e.g. a local stand-in
+    """
+    def __init__(self, max_workers=16, max_pending=64, retries=5, multipart_threshold_MB=8, endpoint_url=None):
+        self.retries = retries
+        self.multipart_threshold = int(multipart_threshold_MB * B2MB)
+        self.transfer_config = TransferConfig(multipart_threshold=self.multipart_threshold, max_concurrency=1, use_threads=False)
+        session = boto3.session.Session()
+        self.client = session.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=max_workers, retries={"max_attempts": 1})
+            )
+        self.pool = cf.ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.nbytes = 0
+        self.nrequests = 0
+        self.nretries = 0
+        self.tupload = 0
+
+    def put(self, bucket, key, body):
+        """
+        Queue an object for upload, blocking while max_pending uploads are outstanding
+
+        bucket : bucket name
+        key    : object key
+        body   : bytes of the object
+        """
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(self._upload, bucket, key, body)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda x: self.slots.release())
+        with self.lock:
+            self.futures.append(future)
+
+    def _upload(self, bucket, key, body):
+        for jattempt in range(self.retries):
+            t0 = time.perf_counter()
+            try:
+                if len(body) >= self.multipart_threshold:
+                    self.client.upload_fileobj(BytesIO(body), bucket, key, Config=self.transfer_config)
+                else:
+                    self.client.put_object(Bucket=bucket, Key=key, Body=body)
+                break
+            except (BotoCoreError, ClientError):
+                if jattempt == self.retries - 1: raise
+                with self.lock: self.nretries += 1
+                time.sleep(min(0.1 * 2 ** jattempt, 5))
+        with self.lock:
+            self.nbytes += len(body)
+            self.nrequests += 1
+            self.tupload += time.perf_counter() - t0
+
+    def flush(self):
+        """
+        Wait for every queued upload, raising the first error
+        """
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        for future in futures:
+            future.result()
+
+    def stats(self):
+        """
+        Returns bytes uploaded, objects uploaded, retries and seconds spent in successful requests
+        """
+        with self.lock:
+            return self.nbytes, self.nrequests, self.nretries, self.tupload
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def get_uploader(**kwargs):
+    """
+    Returns the uploader of this process, creating it on first use. Threads do not survive a fork,
+    so a process never reuses an uploader inherited from its parent.
+
+    kwargs : S3Uploader arguments, only used when the uploader is created
+    """
+    global uploader, uploader_pid
+    if uploader is None or uploader_pid != os.getpid():
+        uploader = S3Uploader(**kwargs)
+        uploader_pid = os.getpid()
+    return uploader
@@ -1,7 +1,12 @@
 from datetime import datetime
+import hashlib, json, os, shutil, tempfile, warnings
 import numpy as np
 from datetime import timezone
 import psutil
+from scipy import sparse
+
+NWM_NX = 4608
+NWM_NY = 3840
 
 nwm_variables = [
         "U2D",
@@ -27,44 +32,391 @@ ngen_variables = [
         "DSWRF_surface",
     ] 
 
+# NWM source variable of each ngen forcing
+variable_map = dict(zip(ngen_variables, nwm_variables))
+
+def read_plan(ngen_vars):
+    """
+    Plan the NWM reads for a set of ngen forcings so that each source variable is read once and
+    fanned out to every forcing it feeds (e.g. RAINRATE to APCP_surface and precip_rate)
+
+    ngen_vars : requested ngen forcings, any subset of ngen_variables
+
+    returns : outputs, sources, fan_out
+    outputs : the requested forcings in ngen_variables order
+    sources : NWM variables to read, each once
+    fan_out : index in sources of each output
+    """
+    unknown = [x for x in ngen_vars if x not in variable_map]
+    assert len(unknown) == 0, f"{unknown} for ngen_variables is not accepted! Accepted: {list(variable_map)}"
+    outputs = [x for x in variable_map if x in ngen_vars]
+    sources = list(dict.fromkeys([variable_map[x] for x in outputs]))
+    fan_out = np.array([sources.index(variable_map[x]) for x in outputs], dtype=np.int64)
+    return outputs, sources, fan_out
+
+def weights_cells(weights_df):
+    """
+    Flatten the cell ids of a weights df
+
+    returns : cells, ncells
+    cells  : concatenated cell ids of every catchment
+    ncells : number of cells of each catchment
+    """
+    ncatch = len(weights_df)
+    ncells = np.fromiter((len(x) for x in weights_df['cell_id']), dtype=np.int64, count=ncatch)
+    cells = np.concatenate([np.asarray(x, dtype=np.int64) for x in weights_df['cell_id']]) if ncatch else np.zeros(0, dtype=np.int64)
+    return cells, ncells
+
 def get_window(weights_df):
     """
-    Providing window on weights for which number of catchments is over 50,000
+    Bounding window on the NWM grid of every cell in the weights
 
     weights_df : datastream weights df where the indicies are catchment ids and the columns are cell-id and coverage
     """
-    nx = 4608
-    ny = 3840
-    if len(weights_df) < 50000:
-        x_min_list = []
-        x_max_list = []
-        y_min_list = []
-        y_max_list = []
-        idx_2d = []
-        for row in weights_df.itertuples(): 
-            indices = row.cell_id
-            idx_2d=np.unravel_index(indices, (1, nx, ny), order='F')
-            x_min_list.append(np.min(idx_2d[1]))
-            x_max_list.append(np.max(idx_2d[1]))
-            y_min_list.append(np.min(idx_2d[2]))
-            y_max_list.append(np.max(idx_2d[2]))   
-        x_min=np.min(x_min_list)   
-        x_max=np.max(x_max_list)   
-        y_min=np.min(y_min_list)   
-        y_max=np.max(y_max_list) 
-    else:
-        x_min = 0
-        x_max = nx - 1
-        y_min = 0
-        y_max = ny - 1
-
-    return x_min, x_max, y_min, y_max
+    cells, _ = weights_cells(weights_df)
+    # cell ids are fortran ordered on the (x, y) NWM grid
+    x = cells % NWM_NX
+    y = (cells // NWM_NX) % NWM_NY
+    return int(x.min()), int(x.max()), int(y.min()), int(y.max())
+
+def window_area(window):
+    x_min, x_max, y_min, y_max = window
+    return (x_max - x_min + 1) * (y_max - y_min + 1)
+
+def get_windows(weights_df, jcatchment_dict):
+    """
+    One tight window per catchment group (e.g. VPU). Windows are merged while their union covers
+    no more cells than the windows apart, so overlapping groups are read once.
+
+    weights_df      : datastream weights df where the indicies are catchment ids and the columns are cell-id and coverage
+    jcatchment_dict : dictionary where keys are the geopackage name and the values are a list of catchment id's,
+                      in the row order of weights_df
+
+    returns : windows, catchment_window
+    windows          : list of (x_min, x_max, y_min, y_max)
+    catchment_window : index into windows of each catchment of weights_df
+    """
+    if [x for jgroup in jcatchment_dict for x in jcatchment_dict[jgroup]] != list(weights_df.index):
+        # groups that do not follow the weights rows cannot be windowed, every catchment is read through one window
+        print(f'Catchment groups do not match the weights, reading every catchment through a single window',flush=True)
+        return [get_window(weights_df)], np.zeros(len(weights_df), dtype=np.int64)
+    cells, ncells = weights_cells(weights_df)
+    x = cells % NWM_NX
+    y = (cells // NWM_NX) % NWM_NY
+    ngroups = np.fromiter((len(jcatchment_dict[x]) for x in jcatchment_dict), dtype=np.int64, count=len(jcatchment_dict))
+    group_cells = np.add.reduceat(ncells, np.concatenate([[0], np.cumsum(ngroups)[:-1]])) if len(ngroups) else ngroups
+    starts = np.concatenate([[0], np.cumsum(group_cells)[:-1]]).astype(np.int64)
+    windows = []
+    for jstart, jcells in zip(starts, group_cells):
+        if jcells == 0:
+            windows.append(None)
+            continue
+        jx = x[jstart:jstart + jcells]
+        jy = y[jstart:jstart + jcells]
+        windows.append((int(jx.min()), int(jx.max()), int(jy.min()), int(jy.max())))
+    group_window = list(range(len(windows)))
+
+    merged = True
+    while merged:
+        merged = False
+        live = sorted(set([group_window[j] for j in range(len(windows)) if windows[group_window[j]] is not None]))
+        for i in live:
+            for k in live:
+                if k <= i: continue
+                a, b = windows[i], windows[k]
+                union = (min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]))
+                if window_area(union) <= window_area(a) + window_area(b):
+                    windows[i] = union
+                    group_window = [i if w == k else w for w in group_window]
+                    merged = True
+                    break
+            if merged: break
+
+    # renumber the windows left after merging, groups without cells take the first window
+    live = sorted(set([group_window[j] for j in range(len(windows)) if windows[group_window[j]] is not None]))
+    renumber = {w : j for j, w in enumerate(live)}
+    catchment_window = np.repeat([renumber.get(w, 0) for w in group_window], ngroups).astype(np.int64)
+    return [windows[w] for w in live], catchment_window
+
+def window_offsets(windows):
+    """
+    Offsets of each window in the flat cell axis the windows are concatenated along,
+    each window (y x) C ordered
+
+    returns : offsets, total number of cells
+    """
+    areas = [window_area(x) for x in windows]
+    offsets = np.concatenate([[0], np.cumsum(areas)]).astype(np.int64)
+    return offsets[:-1], int(offsets[-1])
+
+def window_views(data_allvars, windows):
+    """
+    Views of each window of a flat (forcing_variable x cell) array as (forcing_variable x y x x)
+    """
+    offsets, _ = window_offsets(windows)
+    views = []
+    for joffset, (x_min, x_max, y_min, y_max) in zip(offsets, windows):
+        dx = x_max - x_min + 1
+        dy = y_max - y_min + 1
+        views.append(data_allvars[:, joffset:joffset + dx * dy].reshape(data_allvars.shape[0], dy, dx))
+    return views
+
+def window_cells(windows, cols):
+    """
+    NWM grid (x, y) of cells on the flat window cell axis, see window_offsets
+
+    returns : x, y
+    """
+    offsets, _ = window_offsets(windows)
+    cols = np.asarray(cols, dtype=np.int64)
+    win = np.searchsorted(offsets, cols, side='right') - 1
+    bounds = np.array(windows, dtype=np.int64).reshape(-1, 4)[win]
+    dx = bounds[:, 1] - bounds[:, 0] + 1
+    local = cols - offsets[win]
+    return bounds[:, 0] + local % dx, bounds[:, 2] + local // dx
+
+def shard_weights(weights_mat, windows, rows):
+    """
+    Weights of a subset of catchments, over windows shrunk to the cells those catchments use
+
+    weights_mat : weights from build_weights_matrix
+    windows     : windows of weights_mat
+    rows        : index in weights_mat of each catchment of the shard
+
+    returns : weights_mat, windows of the shard
+    """
+    sub = weights_mat[rows]
+    offsets, _ = window_offsets(windows)
+    win = np.searchsorted(offsets, sub.indices, side='right') - 1
+    x, y = window_cells(windows, sub.indices)
+    used, jwin = np.unique(win, return_inverse=True)
+    bounds = np.zeros((len(used), 4), dtype=np.int64)
+    bounds[:, 0] = NWM_NX
+    bounds[:, 2] = NWM_NY
+    np.minimum.at(bounds[:, 0], jwin, x)
+    np.maximum.at(bounds[:, 1], jwin, x)
+    np.minimum.at(bounds[:, 2], jwin, y)
+    np.maximum.at(bounds[:, 3], jwin, y)
+    shard_windows = [tuple(int(v) for v in jbounds) for jbounds in bounds]
+    shard_offsets, ncells = window_offsets(shard_windows)
+    dx = bounds[:, 1] - bounds[:, 0] + 1
+    cols = shard_offsets[jwin] + (x - bounds[jwin, 0]) + (y - bounds[jwin, 2]) * dx[jwin]
+    return sparse.csr_matrix((sub.data, cols, sub.indptr), shape=(len(rows), ncells)), shard_windows
+
+def mosaic_windows(data_allvars, windows):
+    """
+    Paste the windows of a flat (forcing_variable x cell) array into their bounding window, nan elsewhere
+
+    returns : 3D array (forcing_variable x y x x) of the bounding window
+    """
+    x_min = min([x[0] for x in windows])
+    x_max = max([x[1] for x in windows])
+    y_min = min([x[2] for x in windows])
+    y_max = max([x[3] for x in windows])
+    out = np.full((data_allvars.shape[0], y_max - y_min + 1, x_max - x_min + 1), np.nan, dtype=data_allvars.dtype)
+    for jview, jwindow in zip(window_views(data_allvars, windows), windows):
+        out[:, jwindow[2] - y_min:jwindow[3] - y_min + 1, jwindow[0] - x_min:jwindow[1] - x_min + 1] = jview
+    return out
+
+def build_weights_matrix(weights_df, windows, catchment_window=None):
+    """
+    Build a sparse (catchment x window cell) weights matrix with coverage normalized per catchment.
+    Reducing a windowed grid (nvar x ncells, C ordered) to catchment values is then a single mat-vec.
+
+    weights_df       : datastream weights df where the indicies are catchment ids and the columns are cell-id and coverage
+    windows          : (x_min, x_max, y_min, y_max) as returned by get_window, or a list of windows from get_windows
+                       whose cells are concatenated, see window_offsets
+    catchment_window : index into windows of each catchment, as returned by get_windows
+    """
+    if np.ndim(windows) == 1: windows = [windows]
+    offsets, ncells_window = window_offsets(windows)
+    ncatch = len(weights_df)
+    if catchment_window is None: catchment_window = np.zeros(ncatch, dtype=np.int64)
+    cells, ncells = weights_cells(weights_df)
+    coverage = np.concatenate([np.asarray(x, dtype=np.float64) for x in weights_df['coverage']]) if ncatch else np.zeros(0)
+    rows = np.repeat(np.arange(ncatch), ncells)
+
+    # cell ids are fortran ordered on the (x, y) NWM grid
+    win = np.array(windows, dtype=np.int64).reshape(-1, 4)[np.repeat(catchment_window, ncells)]
+    dx = win[:, 1] - win[:, 0] + 1
+    cols = offsets[np.repeat(catchment_window, ncells)] + (cells % NWM_NX - win[:, 0]) + ((cells // NWM_NX) % NWM_NY - win[:, 2]) * dx
+    weight_sum = np.bincount(rows, weights=coverage, minlength=ncatch)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coverage = coverage / weight_sum[rows]
+
+    return sparse.csr_matrix((coverage, (rows, cols)), shape=(ncatch, ncells_window))
+
+def calc_weights_key(weights_sources, grid_shape=(NWM_NX, NWM_NY)):
+    """
+    Hash identifying a set of weights sources on a grid. Local files contribute their size and
+    modification time so an edited geopackage invalidates any compiled weights.
+
+    weights_sources : list of geopackages, parquets or jsons the weights are read from
+    grid_shape      : (west_east, south_north) size of the NWM grid
+    """
+    h = hashlib.sha256()
+    for jsrc in weights_sources:
+        h.update(str(jsrc).encode())
+        if os.path.exists(jsrc):
+            stat = os.stat(jsrc)
+            h.update(f"{stat.st_size}_{stat.st_mtime_ns}".encode())
+    h.update(str(tuple(grid_shape)).encode())
+    return h.hexdigest()
+
+def write_compiled_weights(path, key, weights_mat, windows, catchment_ids, jcatchment_dict):
+    """
+    Write the compiled weights artifact, a directory of .npy arrays that can be memory-mapped by later runs.
+
+    path            : directory to write the artifact to
+    key             : hash from calc_weights_key
+    weights_mat     : sparse weights matrix from build_weights_matrix
+    windows         : list of (x_min, x_max, y_min, y_max) the columns of weights_mat index into
+    catchment_ids   : catchment ids in the row order of weights_mat
+    jcatchment_dict : dictionary where keys are the geopackage name and the values are a list of catchment id's
+
+    returns : the arrays directory, which workers map with map_weights_arrays
+    """
+    os.makedirs(path, exist_ok=True)
+    # the arrays go to a fresh directory named by the meta, which replaces the old meta in one rename,
+    # so a recompile or a concurrent run never pairs one artifact's meta with another's arrays
+    array_dir = tempfile.mkdtemp(dir=path, prefix="arrays-")
+    np.save(os.path.join(array_dir, "indptr.npy"), weights_mat.indptr.astype(np.int64))
+    np.save(os.path.join(array_dir, "indices.npy"), weights_mat.indices.astype(np.int32))
+    np.save(os.path.join(array_dir, "coverage.npy"), weights_mat.data)
+    np.save(os.path.join(array_dir, "catchment_ids.npy"), np.array(catchment_ids, dtype=str))
+    meta = {
+        "key"        : key,
+        "arrays"     : os.path.basename(array_dir),
+        "windows"    : [[int(x) for x in jwindow] for jwindow in windows],
+        "grid_shape" : [NWM_NX, NWM_NY],
+        "shape"      : [int(x) for x in weights_mat.shape],
+        "groups"     : [[jname, len(jcatchment_dict[jname])] for jname in jcatchment_dict]
+    }
+    meta_file = os.path.join(path, "meta.json")
+    old_arrays = None
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as fp:
+            old_arrays = json.load(fp).get("arrays")
+    fd, tmp_file = tempfile.mkstemp(dir=path, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(meta, fp)
+    os.replace(tmp_file, meta_file)
+    # runs that already mapped the old arrays keep reading them after they are removed
+    if old_arrays is not None: shutil.rmtree(os.path.join(path, old_arrays), ignore_errors=True)
+    return array_dir
+
+def load_compiled_weights(path, key):
+    """
+    Memory-map a compiled weights artifact. Returns None if it does not exist or was compiled from other weights.
+
+    path : directory the artifact was written to
+    key  : hash from calc_weights_key
+
+    returns : weights_mat, windows, catchment_ids, jcatchment_dict, array_dir
+    """
+    meta_file = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as fp:
+        meta = json.load(fp)
+    # artifacts written before windows were per group hold a single window and are recompiled
+    if meta["key"] != key or "windows" not in meta:
+        return None
+    array_dir = os.path.join(path, meta.get("arrays", ""))
+    try:
+        weights_mat, catchment_ids = map_weights_arrays(array_dir, meta["shape"])
+    except FileNotFoundError:
+        # replaced by a recompile since the meta was read
+        return None
+    jcatchment_dict = {}
+    i = 0
+    for jname, ncatch in meta["groups"]:
+        jcatchment_dict[jname] = list(catchment_ids[i:i+ncatch])
+        i += ncatch
+    return weights_mat, [tuple(x) for x in meta["windows"]], list(catchment_ids), jcatchment_dict, array_dir
+
+def map_weights_arrays(array_dir, shape):
+    """
+    Memory-map the arrays of a compiled weights artifact
+
+    array_dir : arrays directory of the artifact, from load_compiled_weights or write_compiled_weights
+    shape     : shape of the weights matrix
+
+    returns : weights_mat, catchment_ids
+    """
+    indptr = np.load(os.path.join(array_dir, "indptr.npy"), mmap_mode='r')
+    indices = np.load(os.path.join(array_dir, "indices.npy"), mmap_mode='r')
+    coverage = np.load(os.path.join(array_dir, "coverage.npy"), mmap_mode='r')
+    catchment_ids = np.load(os.path.join(array_dir, "catchment_ids.npy"), mmap_mode='r')
+    weights_mat = sparse.csr_matrix((coverage, indices, indptr), shape=tuple(shape), copy=False)
+    return weights_mat, catchment_ids
+
+def format_csv_block(data, t_ax, columns):
+    """
+    Render the csv of each catchment of a block at once, byte for byte what
+    pd.DataFrame(data[:,:,j],columns=columns).insert(0,"time",t_ax).to_csv(index=False) writes
+
+    data    : 3D float32 array (time x forcing_variable x catchment)
+    t_ax    : time strings, rendered once and shared by every catchment
+    columns : forcing variable names
+
+    returns : list of csv bytes, one per catchment
+    """
+    nt, nvar, ncatch = data.shape
+    header = (",".join(["time"] + list(columns)) + "\n").encode()
+    # float to string conversion is the only per value step, the rows are assembled as fixed width
+    # bytes padded with NUL, which are stripped once per catchment
+    data = np.ascontiguousarray(np.transpose(data, (2, 0, 1)))
+    values = data.astype(bytes)
+    values[np.isnan(data)] = b''
+    times = np.asarray(t_ax, dtype=bytes)
+    wval, wtime = values.dtype.itemsize, times.dtype.itemsize
+    rows = np.zeros((ncatch, nt, wtime + nvar * (wval + 1) + 1), dtype=np.uint8)
+    rows[:, :, :wtime] = times.view(np.uint8).reshape(nt, wtime)
+    values = values.view(np.uint8).reshape(ncatch, nt, nvar, wval)
+    for jvar in range(nvar):
+        j = wtime + jvar * (wval + 1)
+        rows[:, :, j] = ord(',')
+        rows[:, :, j + 1:j + 1 + wval] = values[:, :, jvar, :]
+    rows[:, :, -1] = ord('\n')
+    return [header + rows[j].tobytes().translate(None, b'\x00') for j in range(ncatch)]
+
+# Per catchment statistics of catchment_stats, each written to metadata as catchments_<name>.csv
+catchment_stat_names = ["avg", "median", "min", "max", "nan_count"]
+
+def catchment_stats(data):
+    """
+    Statistics over time of each catchment and forcing variable of a block of the cube. Blocks
+    along the catchment axis are merged by concatenating the arrays. NaN time slices are skipped,
+    a series that is NaN throughout has NaN statistics, the NaN count reports both.
+
+    data : 3D float32 array (time x forcing_variable x catchment)
+
+    returns : list of 2D arrays (forcing_variable x catchment) in the order of catchment_stat_names
+    """
+    if data.shape[2] == 0:
+        # np.nanmedian rejects an empty axis
+        return [np.zeros(data.shape[1:], dtype=data.dtype)] * 4 + [np.zeros(data.shape[1:], dtype=np.int64)]
+    with warnings.catch_warnings():
+        # all NaN series
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return [
+            np.nanmean(data, axis=0),
+            np.nanmedian(data, axis=0),
+            np.fmin.reduce(data, axis=0),
+            np.fmax.reduce(data, axis=0),
+            np.count_nonzero(np.isnan(data), axis=0)
+        ]
 
 def log_time(label, log_file):
     timestamp = datetime.now(timezone.utc).astimezone().strftime('%Y%m%d%H%M%S')
     with open(log_file, 'a') as f:
         f.write(f"{label}: {timestamp}\n")
 
+def log_duration(label, seconds, log_file):
+    with open(log_file, 'a') as f:
+        f.write(f"{label}: {seconds:.3f}s\n")
+
 def report_usage():
     usage_ram   = psutil.virtual_memory()[3]/1000000000
     percent_ram = psutil.virtual_memory()[2]
@@ -5,6 +5,7 @@ import concurrent.futures as cf
 import pandas as pd
 import xarray as xr
 import numpy as np
+from forcingprocessor.cache import cache_enabled, fetch_cached
 gpd.options.io_engine = "pyogrio" 
 
 def rastersourceNexactextract(raster_data,geo_data):
@@ -44,10 +45,13 @@ def rastersourceNexactextract(raster_data,geo_data):
 def get_projection(raster_file):
     if 'https://' in raster_file:
         print(f"Downloading file...")
-        response = requests.get(raster_file)
-        
-        if response.status_code == 200:
-            raster_file = BytesIO(response.content)
+        if cache_enabled():
+            raster_file, _ = fetch_cached(raster_file)
+        else:
+            response = requests.get(raster_file)
+            
+            if response.status_code == 200:
+                raster_file = BytesIO(response.content)
 
     print(f"Opening raster",flush=True)
     try:
@@ -116,6 +120,11 @@ def multiprocess_hf2ds(files : list,raster_template : str, max_procs : int):
         i=k
         k = nper + i
         
+    # unnamed geopackages are numbered across workers, not within each one
+    counts = [0]
+    for jfiles in files_list[:-1]:
+        counts.append(counts[-1] + len([x for x in jfiles if vpu_name(x) is None]))
+
     weight_dfs = []
     jcatchment_dicts = []
     with cf.ProcessPoolExecutor(max_workers=nprocs) as pool:
@@ -123,7 +132,8 @@ def multiprocess_hf2ds(files : list,raster_template : str, max_procs : int):
         hf2ds,
         files_list,
         [raster_template for x in range(len(files_list))],
-        [nf for x in range(len(files_list))]
+        [nf for x in range(len(files_list))],
+        counts
         ):
             weight_dfs.append(results[0])
             jcatchment_dicts.append(results[1])  
@@ -132,17 +142,41 @@ def multiprocess_hf2ds(files : list,raster_template : str, max_procs : int):
 
     print(f'Processes have returned',flush=True)
     jcatchment_dict = {}
-    [jcatchment_dict.update(x) for x in jcatchment_dicts]
+    for jdict in jcatchment_dicts:
+        for jname in jdict: add_group(jcatchment_dict, jname, jdict[jname])
   
     return weights_df, jcatchment_dict  
 
 
-def hf2ds(files : list, raster : str, nf):
+def vpu_name(file : str):
+    """
+    VPU group name of a geopackage or weights file, None if the file name holds no VPU
+    """
+    pattern = r"(?i)vpu[-_](\d+)"
+    match = re.search(pattern, file)
+    if match: return "VPU_" + match.group(1)
+    return None
+
+def add_group(jcatchment_dict : dict, jname : str, catchments : list):
+    """
+    Adds a catchment group, a repeated name (e.g. a VPU listed twice) gets a numbered suffix so no group is overwritten
+    and the groups keep the order of the weights rows. The suffixed group is written to its own outputs.
+    """
+    name = jname
+    n = 1
+    while name in jcatchment_dict:
+        n += 1
+        name = f"{jname}_{n}"
+    if name != jname: print(f'{jname} is in more than one file, the catchments of the later file are grouped as {name}')
+    jcatchment_dict[name] = catchments
+
+def hf2ds(files : list, raster : str, nf, count=0):
     """
     Extracts the weights from a list of files
 
     input : files
     gpkg_files : list of geopackage or parquet files
+    count : number of geopackages without a VPU in the files before these, names the groups of those files
 
     returns : weights_df, jcatchment_dict
     weights_df : a dataframe where index is catchment ids and the columns are the corresponding cell and coverage
@@ -150,17 +184,17 @@ def hf2ds(files : list, raster : str, nf):
 
     """
     jcatchment_dict = {}
-    count = 0
+    weight_dfs = []
     for jgpkg in files:
-        pattern = r"(?i)vpu[-_](\d+)"
-        match = re.search(pattern, jgpkg)
-        if match: jname = "VPU_" + match.group(1)
-        else:
+        jname = vpu_name(jgpkg)
+        if jname is None:
             count +=1
             jname = str(count)    
-        weights_df = hydrofabric2datastream_weights(jgpkg,raster,nf)
-        jcatchment_dict[jname] = list(weights_df.index)
+        jweights_df = hydrofabric2datastream_weights(jgpkg,raster,nf)
+        add_group(jcatchment_dict, jname, list(jweights_df.index))
+        weight_dfs.append(jweights_df)
 
+    weights_df = pd.concat(weight_dfs)
     return weights_df, jcatchment_dict
 
 def hydrofabric2datastream_weights(weights_file : str, raster_template: str, nf : int) -> dict:
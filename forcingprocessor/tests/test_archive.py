@@ -0,0 +1,24 @@
+import gzip, os
+import pytest
+from forcingprocessor.archive import ShardWriter, compress_block
+
+@pytest.mark.parametrize("codec,threads", [("gzip", 1), ("gzip", 4), ("zstd", 4)])
+def test_shards_concatenate(tmp_path, codec, threads):
+    if codec == "zstd": zstandard = pytest.importorskip("zstandard")
+    chunks = [os.urandom(1000) + bytes(50000) for x in range(40)]
+    paths = []
+    for jshard in range(2):
+        path = tmp_path / f"shard{jshard}"
+        writer = ShardWriter(path, codec, 3, threads, block_MB=0.2)
+        for jchunk in chunks[20 * jshard:20 * jshard + 20]: writer.write(jchunk)
+        nbytes, ncompressed, secs = writer.close()
+        assert nbytes == sum([len(x) for x in chunks[20 * jshard:20 * jshard + 20]])
+        assert ncompressed == os.path.getsize(path)
+        paths.append(path)
+    archive = b"".join([x.read_bytes() for x in paths]) + compress_block(b"end", codec, 3)
+
+    if codec == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(archive, read_across_frames=True)
+        assert reader.read() == b"".join(chunks) + b"end"
+    else:
+        assert gzip.decompress(archive) == b"".join(chunks) + b"end"
@@ -0,0 +1,32 @@
+import os, time
+import fsspec
+from forcingprocessor import cache
+
+def test_fetch_cached_hits_and_evicts(tmp_path, monkeypatch):
+    fs = fsspec.filesystem('memory')
+    for j in range(3):
+        with fs.open(f'/nwm/file{j}.nc', 'wb') as fp:
+            fp.write(bytes(1024 * (j + 1)))
+
+    # restored after the test, whatever configure_cache sets
+    monkeypatch.setattr(cache, "cache_dir", cache.cache_dir)
+    monkeypatch.setattr(cache, "cache_size_GB", cache.cache_size_GB)
+    cache.configure_cache(str(tmp_path), size_GB=4500 / cache.B2GB)
+    monkeypatch.setattr(cache, "EVICT_GRACE_S", 0)
+    hits0, misses0 = cache.cache_stats()
+
+    path, hit = cache.fetch_cached('s3://nwm/file0.nc', fs, '/nwm/file0.nc')
+    assert not hit and os.path.getsize(path) == 1024
+    path, hit = cache.fetch_cached('s3://nwm/file0.nc', fs, '/nwm/file0.nc')
+    assert hit
+    path1, _ = cache.fetch_cached('s3://nwm/file1.nc', fs, '/nwm/file1.nc')
+    now = time.time()
+    os.utime(path1, (now - 100, now - 100))
+    os.utime(path, (now - 50, now - 50))
+    # file0 was used most recently, so file1 is evicted to fit file2
+    cache.fetch_cached('s3://nwm/file2.nc', fs, '/nwm/file2.nc')
+    sizes = sorted([os.path.getsize(os.path.join(tmp_path, x)) for x in os.listdir(tmp_path)])
+    assert sizes == [1024, 3072]
+
+    hits, misses = cache.cache_stats()
+    assert (hits - hits0, misses - misses0) == (1, 3)
@@ -0,0 +1,205 @@
+import time
+import numpy as np
+import pytest
+import pandas as pd
+import netCDF4 as nc
+import forcingprocessor.processor as processor
+from forcingprocessor.processor import forcing_grid2catchment, prefetch_nwm_files, multiprocess_data_extract, multiprocess_stream_netcdf, start_worker_pool, create_cube, attach_cube, release_cube, write_netcdf
+from forcingprocessor.utils import build_weights_matrix, get_window, read_plan, catchment_stats, NWM_NX
+
+NY, NX = 40, 50
+# U2D, RAINRATE fanned out to two forcings, and T2D
+NGEN_VARS = ["UGRD_10maboveground", "APCP_surface", "precip_rate", "TMP_2maboveground"]
+
+def make_nwm_files(path, nfiles, seed=0):
+    rng = np.random.default_rng(seed)
+    files = []
+    for j in range(nfiles):
+        jfile = str(path / f"nwm.t00z.short_range.forcing.f{j + 1:03d}.conus.nc")
+        with nc.Dataset(jfile, 'w') as ds:
+            ds.createDimension('time', 1)
+            ds.createDimension('y', NY)
+            ds.createDimension('x', NX)
+            ds.model_output_valid_time = f"2024-01-01_{j + 1:02d}:00:00"
+            for jvar in ["U2D", "RAINRATE", "T2D"]:
+                var = ds.createVariable(jvar, 'f4', ('time', 'y', 'x'), zlib=True, chunksizes=(1, 16, 16), fill_value=-999.0)
+                var[:] = rng.uniform(1., 2., size=(1, NY, NX)).astype(np.float32)
+        files.append(jfile)
+    return files
+
+def make_weights(ncatch=60, seed=0):
+    rng = np.random.default_rng(seed)
+    cell_ids, coverages = [], []
+    for j in range(ncatch):
+        x = 2 + rng.integers(0, 44, size=rng.integers(2, 12))
+        y = 2 + rng.integers(0, 34, size=len(x))
+        cell_ids.append(list(x + y * NWM_NX))
+        coverages.append(list(rng.uniform(0.01, 1.0, size=len(x))))
+    return pd.DataFrame({"cell_id": cell_ids, "coverage": coverages}, index=[f"cat-{j}" for j in range(ncatch)])
+
+def set_extract_globals(monkeypatch, weights_df, **values):
+    # the extraction options prep_ngen_data sets, restored after each test
+    windows = [get_window(weights_df)]
+    ngen_vars, sources, fan_out = read_plan(NGEN_VARS)
+    state = dict(weights_df=weights_df, weights_mat=build_weights_matrix(weights_df, windows[0]), windows=windows,
+                 ngen_variables=ngen_vars, nwm_sources=sources, fan_out=fan_out, ngen_vars_plot=[], ii_plot=False, nts_plot=0,
+                 ii_verbose=False, regrid_engine="sparse", regrid_threads=1, batch_size=1, batch_memory_MB=1024, fs_type=None,
+                 read_mode="download", nwm_references={}, chunk_sparse=True, cell_mask=None, prefetch_depth=0,
+                 prefetch_memory_MB=1024, io_threads=0, worker_pool=None)
+    state.update(values)
+    for name, value in state.items():
+        monkeypatch.setattr(processor, name, value, raising=False)
+
+def test_io_threads_match_synchronous_reads(tmp_path, monkeypatch):
+    files = make_nwm_files(tmp_path, 12)
+    set_extract_globals(monkeypatch, make_weights())
+    expected = forcing_grid2catchment(files)
+
+    # netCDF reads of several I/O threads are serialized, concurrent HDF5 calls crash the process
+    for read_mode in ["download", "range"]:
+        set_extract_globals(monkeypatch, make_weights(), read_mode=read_mode, io_threads=4, prefetch_depth=8)
+        data_list, t_list = forcing_grid2catchment(files)[:2]
+        assert t_list == expected[1]
+        np.testing.assert_array_equal(np.array(data_list), np.array(expected[0]))
+
+def test_batched_reduction_matches_single_files(tmp_path, monkeypatch):
+    files = make_nwm_files(tmp_path, 10)
+    weights_df = make_weights()
+    set_extract_globals(monkeypatch, weights_df)
+    expected = forcing_grid2catchment(files)
+
+    # batches of 4 files, then a memory bound of 3 files with a last batch of 1
+    x_min, x_max, y_min, y_max = get_window(weights_df)
+    file_MB = 3 * (x_max - x_min + 1) * (y_max - y_min + 1) * 4 / processor.B2MB
+    reduce = processor.catchment_values_sparse
+    batches = []
+    def spy(block, weights_mat):
+        batches.append(block.shape[0] // 3)
+        return reduce(block, weights_mat)
+    monkeypatch.setattr(processor, "catchment_values_sparse", spy)
+    for batch_size, batch_memory_MB, nfiles in [(4, 1024, [4, 4, 2]), (8, 3.5 * file_MB, [3, 3, 3, 1])]:
+        set_extract_globals(monkeypatch, weights_df, batch_size=batch_size, batch_memory_MB=batch_memory_MB)
+        batches.clear()
+        data_list, t_list = forcing_grid2catchment(files)[:2]
+        assert batches == nfiles
+        assert t_list == expected[1]
+        np.testing.assert_array_equal(np.array(data_list), np.array(expected[0]))
+
+def fake_reads(monkeypatch, delays=None, fail=None):
+    # read_nwm_file stand in that fills each window with the file index and counts the reads started
+    started = []
+    def read(nwm_file, fs, data_allvars):
+        j = int(nwm_file)
+        started.append(j)
+        if delays is not None: time.sleep(delays[j])
+        if j == fail: raise OSError(f"read of {j} failed")
+        data_allvars[:] = j
+        return str(j), 1., 1., 1., (0, 0, 0)
+    monkeypatch.setattr(processor, "read_nwm_file", read)
+    return started
+
+def test_prefetch_keeps_file_order(tmp_path, monkeypatch):
+    files = make_nwm_files(tmp_path, 8)
+    set_extract_globals(monkeypatch, make_weights())
+    expected = forcing_grid2catchment(files)
+    set_extract_globals(monkeypatch, make_weights(), prefetch_depth=3)
+    data_list, t_list = forcing_grid2catchment(files)[:2]
+    assert t_list == expected[1]
+    np.testing.assert_array_equal(np.array(data_list), np.array(expected[0]))
+
+    # reads never run more than depth files ahead of the consumer
+    started = fake_reads(monkeypatch)
+    for jconsumed, (data, results) in enumerate(prefetch_nwm_files([str(x) for x in range(10)], None, 3, (2, 5)), start=1):
+        assert results[0] == str(jconsumed - 1) and (data == jconsumed - 1).all()
+        assert len(started) <= jconsumed + 3
+
+def test_prefetch_memory_bounds_depth(tmp_path, monkeypatch):
+    files = make_nwm_files(tmp_path, 6)
+    weights_df = make_weights()
+    x_min, x_max, y_min, y_max = get_window(weights_df)
+    file_MB = 3 * (x_max - x_min + 1) * (y_max - y_min + 1) * 4 / processor.B2MB
+    depths = []
+    prefetch = processor.prefetch_nwm_files
+    def spy(nwm_files, fs, depth, shape, nthreads=1):
+        depths.append(depth)
+        return prefetch(nwm_files, fs, depth, shape, nthreads)
+    monkeypatch.setattr(processor, "prefetch_nwm_files", spy)
+    set_extract_globals(monkeypatch, weights_df, prefetch_depth=8, prefetch_memory_MB=2.5 * file_MB)
+    forcing_grid2catchment(files)
+    assert depths == [2]
+
+def test_prefetch_raises_read_errors(monkeypatch):
+    fake_reads(monkeypatch, fail=2)
+    items = prefetch_nwm_files([str(x) for x in range(6)], None, 3, (2, 5))
+    assert next(items)[1][0] == "0" and next(items)[1][0] == "1"
+    with pytest.raises(OSError, match="read of 2 failed"):
+        next(items)
+
+def test_io_threads_yield_in_file_order(monkeypatch):
+    # later files finish first, the consumer still receives them in file order
+    delays = [0.05 * (6 - x) for x in range(6)]
+    started = fake_reads(monkeypatch, delays=delays)
+    items = list(prefetch_nwm_files([str(x) for x in range(6)], None, 4, (2, 5), nthreads=4))
+    assert [x[1][0] for x in items] == [str(x) for x in range(6)]
+    assert [int(x[0][0, 0]) for x in items] == list(range(6))
+    assert sorted(started) == list(range(6))
+
+def test_extract_error_unlinks_the_cube(tmp_path, monkeypatch):
+    files = make_nwm_files(tmp_path, 4)
+    files[2] = str(tmp_path / "missing.nc")
+    weights_df = make_weights()
+    set_extract_globals(monkeypatch, weights_df, nprocs=2, task_files=1)
+    cubes = []
+    create = processor.create_cube
+    def spy(shape):
+        created = create(shape)
+        cubes.append(created[1])
+        return created
+    monkeypatch.setattr(processor, "create_cube", spy)
+    with pytest.raises(Exception):
+        multiprocess_data_extract(files, 2, weights_df, None)
+    assert processor.owned_cubes == {}
+    with pytest.raises(FileNotFoundError):
+        attach_cube(cubes[0])
+
+def test_stream_matches_batch_netcdf(tmp_path, monkeypatch):
+    files = make_nwm_files(tmp_path, 7)
+    weights_df = make_weights()
+    catchments = list(weights_df.index)
+    jcatchment_dict = {"VPU_01" : catchments[:35], "VPU_02" : catchments[35:]}
+    (tmp_path / "batch").mkdir()
+    (tmp_path / "stream").mkdir()
+    set_extract_globals(monkeypatch, weights_df, storage_type="local", forcing_path=tmp_path / "batch", FCST_CYCLE=None, nprocs=2,
+                        task_files=1, stream_slices=2, netcdf_time="2d", netcdf_ids="str", netcdf_chunks=None, netcdf_zlib=False,
+                        netcdf_complevel=4, netcdf_shuffle=False, LEAD_START=7, LEAD_END=1)
+
+    # batch netcdf of the cube in ascending time
+    data_list, t_ax = forcing_grid2catchment(files)[:2]
+    cube_shm, cube, data = create_cube((len(files), len(processor.ngen_variables), len(catchments)))
+    data[:] = np.array(data_list)
+    write_netcdf(cube, (0, 35), "VPU_01_forcings.nc", t_ax, jcatchment_dict["VPU_01"])
+    write_netcdf(cube, (35, len(catchments)), "VPU_02_forcings.nc", t_ax, jcatchment_dict["VPU_02"])
+    del data
+    release_cube(cube_shm, unlink=True)
+
+    # files in descending time are appended in that order, then flipped
+    monkeypatch.setattr(processor, "forcing_path", tmp_path / "stream")
+    monkeypatch.setattr(processor, "worker_pool", start_worker_pool(2))
+    try:
+        results = multiprocess_stream_netcdf(files[::-1], None, jcatchment_dict)
+    finally:
+        processor.worker_pool.shutdown()
+    assert results[0] == t_ax
+    assert (processor.LEAD_START, processor.LEAD_END) == (1, 7)
+    # running statistics of the stream, the median needs every slice at once
+    stats = catchment_stats(np.array(data_list))
+    np.testing.assert_allclose(results[-1][0], stats[0], rtol=1e-6)
+    assert results[-1][1] is None
+    for j in [2, 3, 4]: np.testing.assert_array_equal(results[-1][j], stats[j])
+
+    for jvpu in jcatchment_dict:
+        with nc.Dataset(tmp_path / "batch" / f"{jvpu}_forcings.nc") as batch, nc.Dataset(tmp_path / "stream" / f"{jvpu}_forcings.nc") as stream:
+            assert stream.dimensions["time"].isunlimited() and stream.dimensions["time"].size == len(files)
+            assert list(stream["ids"][:]) == list(batch["ids"][:])
+            for jvar in ["Time"] + processor.ngen_variables:
+                np.testing.assert_array_equal(stream[jvar][:], batch[jvar][:])
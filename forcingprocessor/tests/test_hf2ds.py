@@ -1,4 +1,4 @@
-from forcingprocessor.weights_hf2ds import hf2ds, multiprocess_hf2ds
+from forcingprocessor.weights_hf2ds import hf2ds, multiprocess_hf2ds, add_group
 from pathlib import Path
 import os
 
@@ -50,10 +50,19 @@ def test_multiple_multiprocess_parquet_v21():
 
 def test_multiple_multiprocess_gpkg_v21():
     os.system(f"curl -o {gpkg_path} -L -O https://ngen-datastream.s3.us-east-2.amazonaws.com/{geopackage_name}")
-    weights,_ = multiprocess_hf2ds([gpkg_path,gpkg_path],raster,2)
+    weights,jcatchment_dict = multiprocess_hf2ds([gpkg_path,gpkg_path],raster,2)
     assert len(weights) > 0
+    # each worker numbers its geopackages from the files before it, no group overwrites another
+    assert list(jcatchment_dict) == ["1", "2"]
+    assert [x for jgroup in jcatchment_dict for x in jcatchment_dict[jgroup]] == list(weights.index)
 
 def test_multiple_multiprocess_gpkg_v22():
     weights,_ = multiprocess_hf2ds(["https://communityhydrofabric.s3.us-east-1.amazonaws.com/hydrofabrics/community/VPU/vpu-09_subset.gpkg","https://communityhydrofabric.s3.us-east-1.amazonaws.com/hydrofabrics/community/VPU/vpu-09_subset.gpkg"],raster,2)
-    assert len(weights) > 0       
+    assert len(weights) > 0
 
+def test_add_group_keeps_repeated_names():
+    jcatchment_dict = {}
+    add_group(jcatchment_dict, "VPU_09", ["cat-1", "cat-2"])
+    add_group(jcatchment_dict, "VPU_09", ["cat-1", "cat-2"])
+    add_group(jcatchment_dict, "VPU_09", ["cat-3"])
+    assert jcatchment_dict == {"VPU_09" : ["cat-1", "cat-2"], "VPU_09_2" : ["cat-1", "cat-2"], "VPU_09_3" : ["cat-3"]}
@@ -0,0 +1,98 @@
+import numpy as np
+import netCDF4 as nc
+import xarray as xr
+from io import BytesIO
+from forcingprocessor.nwm_reader import read_nwm_window, read_nc_window, load_reference, chunks_touched, CellMask
+from forcingprocessor.utils import read_plan, variable_map, ngen_variables
+
+nwm_variables = ["U2D", "RAINRATE", "RAINRATE"]
+
+def make_nwm_file(path, ny=40, nx=50):
+    rng = np.random.default_rng(0)
+    with nc.Dataset(path, 'w') as ds:
+        ds.createDimension('time', 1)
+        ds.createDimension('y', ny)
+        ds.createDimension('x', nx)
+        ds.model_output_valid_time = "2024-01-01_01:00:00"
+        for jvar in ["U2D", "RAINRATE"]:
+            var = ds.createVariable(jvar, 'f4', ('time', 'y', 'x'), zlib=True, shuffle=True, chunksizes=(1, 16, 16), fill_value=-999.0)
+            data = rng.normal(size=(1, ny, nx)).astype(np.float32)
+            data[0, 5, 7] = -999.0
+            var[:] = data
+    return ny
+
+def xarray_window(path, window, ny):
+    x_min, x_max, y_min, y_max = window
+    with xr.open_dataset(path) as ds:
+        return np.stack([np.flip(np.squeeze(ds[jvar].isel(x=slice(x_min, x_max+1), y=slice(ny - (y_max+1), ny - y_min)).values), axis=0) for jvar in nwm_variables])
+
+def test_range_read_matches_xarray(tmp_path):
+    path = str(tmp_path / "nwm.t00z.short_range.forcing.f001.conus.nc")
+    ny = make_nwm_file(path)
+    window = (3, 30, 10, 38)
+    out = np.zeros((len(nwm_variables), window[3] - window[2] + 1, window[1] - window[0] + 1), dtype=np.float32)
+    attrs, file_size, nbytes, ndecoded = read_nwm_window(path, None, nwm_variables, window, out)
+    assert attrs["model_output_valid_time"] == "2024-01-01_01:00:00"
+    assert 0 < nbytes < file_size
+    # 2 x 2 chunks of 16 x 16 per variable
+    assert ndecoded == len(nwm_variables) * 4 * 16 * 16 * 4
+    np.testing.assert_array_equal(out, xarray_window(path, window, ny))
+
+def test_reference_read_matches_xarray(tmp_path):
+    path = str(tmp_path / "nwm.t00z.short_range.forcing.f001.conus.nc")
+    ny = make_nwm_file(path)
+    reference = load_reference(path, None, nwm_variables, str(tmp_path / "refs"))
+    assert load_reference(path, None, nwm_variables, str(tmp_path / "refs")) == reference
+    window = (0, 49, 0, 39)
+    out = np.zeros((len(nwm_variables), 40, 50), dtype=np.float32)
+    read_nwm_window(path, None, nwm_variables, window, out, reference)
+    np.testing.assert_array_equal(out, xarray_window(path, window, ny))
+
+def test_multi_window_read(tmp_path):
+    path = str(tmp_path / "nwm.t00z.short_range.forcing.f001.conus.nc")
+    ny = make_nwm_file(path)
+    windows = [(0, 10, 0, 12), (35, 49, 20, 39), (5, 12, 2, 9)]
+    outs = [np.zeros((len(nwm_variables), w[3] - w[2] + 1, w[1] - w[0] + 1), dtype=np.float32) for w in windows]
+    _, _, nbytes, ndecoded = read_nwm_window(path, None, nwm_variables, windows, outs)
+    for window, out in zip(windows, outs):
+        np.testing.assert_array_equal(out, xarray_window(path, window, ny))
+    # the third window lies within the chunks of the first, 2 + 4 chunks per variable
+    assert chunks_touched((1, ny, 50), (1, 16, 16), windows) == 6
+    assert ndecoded == len(nwm_variables) * 6 * 16 * 16 * 4
+
+def test_chunk_sparse_read(tmp_path):
+    path = str(tmp_path / "nwm.t00z.short_range.forcing.f001.conus.nc")
+    ny = make_nwm_file(path)
+    window = (3, 30, 10, 38)
+    x = np.array([4, 29])
+    y = np.array([11, 37])
+    out = np.zeros((len(nwm_variables), window[3] - window[2] + 1, window[1] - window[0] + 1), dtype=np.float32)
+    _, _, _, ndecoded = read_nwm_window(path, None, nwm_variables, window, out, mask=CellMask(x, y))
+    # 2 of the 4 chunks under the window hold a referenced cell
+    assert ndecoded == len(nwm_variables) * 2 * 16 * 16 * 4
+    expected = xarray_window(path, window, ny)
+    np.testing.assert_array_equal(out[:, y - window[2], x - window[0]], expected[:, y - window[2], x - window[0]])
+    assert np.isnan(out).any()
+
+def test_nc_read_matches_xarray(tmp_path):
+    path = str(tmp_path / "nwm.t00z.short_range.forcing.f001.conus.nc")
+    ny = make_nwm_file(path)
+    windows = [(3, 30, 10, 38), (35, 49, 20, 39)]
+    for file_obj in [path, BytesIO(open(path, 'rb').read())]:
+        outs = [np.zeros((len(nwm_variables), w[3] - w[2] + 1, w[1] - w[0] + 1), dtype=np.float32) for w in windows]
+        attrs, ndecoded = read_nc_window(file_obj, nwm_variables, windows, outs)
+        assert attrs["model_output_valid_time"] == "2024-01-01_01:00:00"
+        # 2 x 2 chunks under each window
+        assert ndecoded == len(nwm_variables) * 8 * 16 * 16 * 4
+        for window, out in zip(windows, outs):
+            np.testing.assert_array_equal(out, xarray_window(path, window, ny))
+
+def test_read_plan():
+    outputs, sources, fan_out = read_plan(ngen_variables)
+    assert outputs == ngen_variables
+    assert len(sources) == len(ngen_variables) - 1
+    assert [sources[x] for x in fan_out] == [variable_map[x] for x in ngen_variables]
+    outputs, sources, fan_out = read_plan(["precip_rate", "TMP_2maboveground", "APCP_surface"])
+    assert outputs == ["APCP_surface", "precip_rate", "TMP_2maboveground"]
+    assert sources == ["RAINRATE", "T2D"]
+    assert list(fan_out) == [0, 0, 1]
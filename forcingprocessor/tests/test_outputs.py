@@ -0,0 +1,253 @@
+import gzip, tarfile
+from datetime import datetime
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import pytest
+import netCDF4 as nc
+import forcingprocessor.processor as processor
+from forcingprocessor.processor import create_cube, attach_cube, release_cube, start_worker_pool, prep_ngen_data, write_consolidated_parquet, tar_member, write_tar, multiprocess_write, write_data, write_netcdf, multiprocess_write_netcdf, multiprocess_write_zarr
+from forcingprocessor.utils import ngen_variables, format_csv_block, catchment_stats
+
+def set_globals(monkeypatch, **values):
+    # processor options are module globals set by prep_ngen_data, restored after each test
+    for name, value in values.items():
+        monkeypatch.setattr(processor, name, value, raising=False)
+
+def set_netcdf_globals(monkeypatch, tmp_path, **values):
+    # the netcdf_* defaults of prep_ngen_data
+    options = dict(storage_type="local", forcing_path=tmp_path, FCST_CYCLE=None, nprocs=2, worker_pool=None, ii_verbose=False, netcdf_time="2d",
+                   netcdf_ids="str", netcdf_chunks=None, netcdf_zlib=False, netcdf_complevel=4, netcdf_shuffle=False)
+    options.update(values)
+    set_globals(monkeypatch, **options)
+
+def make_cube(nt, ncatch, seed=0):
+    cube_shm, cube, data = create_cube((nt, len(ngen_variables), ncatch))
+    data[:] = np.random.default_rng(seed).random(data.shape, dtype=np.float32)
+    t_ax = [f"2024-01-01 0{x}:00:00" for x in range(nt)]
+    return cube_shm, cube, data, t_ax
+
+def timestamps(t_ax):
+    return np.array([datetime.timestamp(datetime.strptime(x, '%Y-%m-%d %H:%M:%S')) for x in t_ax])
+
+def test_netcdf_default_layout(tmp_path, monkeypatch):
+    set_netcdf_globals(monkeypatch, tmp_path)
+    cube_shm, cube, data, t_ax = make_cube(5, 10)
+    jcatchment_dict = {"VPU_01" : [f"cat-{x}" for x in range(6)], "VPU_02" : [f"cat-{x}" for x in range(6, 10)]}
+
+    sizes, _, _ = multiprocess_write_netcdf(cube, jcatchment_dict, t_ax)
+    assert len(sizes) == 2
+    i = 0
+    for jvpu, catchments in jcatchment_dict.items():
+        k = i + len(catchments)
+        # the variables, dtypes and uncompressed layout of the original writer
+        with nc.Dataset(tmp_path / f"{jvpu}_forcings.nc") as ds:
+            assert {x : y.size for x, y in ds.dimensions.items()} == {"catchment-id" : len(catchments), "time" : 5}
+            assert list(ds.variables) == ["ids", "Time"] + ngen_variables
+            assert ds["ids"].dtype == str and list(ds["ids"][:]) == catchments
+            assert ds["Time"].dtype == np.float64 and ds["Time"].dimensions == ("catchment-id", "time")
+            np.testing.assert_array_equal(ds["Time"][:], np.tile(timestamps(t_ax), (len(catchments), 1)))
+            for j, jvar in enumerate(ngen_variables):
+                assert ds[jvar].dtype == np.float32 and ds[jvar].dimensions == ("catchment-id", "time")
+                assert ds[jvar].chunking() == "contiguous" and not ds[jvar].filters()["zlib"]
+                np.testing.assert_array_equal(ds[jvar][:], data[:, j, i:k].T)
+        i = k
+
+    del data
+    release_cube(cube_shm, unlink=True)
+
+@pytest.mark.parametrize("options", [
+    {"netcdf_time" : "1d"},
+    {"netcdf_ids" : "fixed"},
+    {"netcdf_ids" : "int"},
+    {"netcdf_chunks" : [4, 2]},
+    {"netcdf_zlib" : True, "netcdf_shuffle" : True, "netcdf_complevel" : 1},
+])
+def test_netcdf_options_are_readable(tmp_path, monkeypatch, options):
+    set_netcdf_globals(monkeypatch, tmp_path, **options)
+    cube_shm, cube, data, t_ax = make_cube(5, 10)
+    catchments = [f"cat-{x}" for x in range(100, 110)]
+
+    write_netcdf(cube, (0, 10), "VPU_01_forcings.nc", t_ax, catchments)
+    with nc.Dataset(tmp_path / "VPU_01_forcings.nc") as ds:
+        ids = list(ds["ids"][:])
+        if options.get("netcdf_ids") == "int":
+            assert ids == list(range(100, 110))
+        else:
+            assert ids == catchments
+        if options.get("netcdf_time") == "1d":
+            assert ds["Time"].dimensions == ("time",)
+            np.testing.assert_array_equal(ds["Time"][:], timestamps(t_ax))
+        else:
+            np.testing.assert_array_equal(ds["Time"][:], np.tile(timestamps(t_ax), (10, 1)))
+        for j, jvar in enumerate(ngen_variables):
+            np.testing.assert_array_equal(ds[jvar][:], data[:, j, :].T)
+            if "netcdf_chunks" in options: assert ds[jvar].chunking() == [4, 2]
+            if "netcdf_zlib" in options: assert ds[jvar].filters()["zlib"] and ds[jvar].filters()["shuffle"]
+
+    del data
+    release_cube(cube_shm, unlink=True)
+
+def test_zarr_roundtrip(tmp_path, monkeypatch):
+    zarr = pytest.importorskip("zarr")
+    set_netcdf_globals(monkeypatch, tmp_path, zarr_chunks=[4, 3])
+    tasks = []
+    schedule = processor.schedule_tasks
+    def spy(fn, task_args, nprocs, label):
+        tasks.extend(task_args)
+        return schedule(fn, task_args, nprocs, label)
+    monkeypatch.setattr(processor, "schedule_tasks", spy)
+
+    # 10 and 7 catchments in chunks of 4, the second store starts mid chunk of the cube
+    cube_shm, cube, data, t_ax = make_cube(5, 17)
+    jcatchment_dict = {"VPU_01" : [f"cat-{x}" for x in range(10)], "VPU_02" : [f"cat-{x}" for x in range(10, 17)]}
+    sizes, _, _ = multiprocess_write_zarr(cube, jcatchment_dict, t_ax)
+    assert len(sizes) == 2 and all([x > 0 for x in sizes])
+
+    # every task writes whole chunks of its store, so no two tasks share a chunk
+    assert sorted([(x[1], x[3]) for x in tasks]) == [((0, 4), 0), ((4, 8), 4), ((8, 10), 8), ((10, 14), 0), ((14, 17), 4)]
+    i = 0
+    for jvpu, catchments in jcatchment_dict.items():
+        k = i + len(catchments)
+        root = zarr.open_group(str(tmp_path / f"{jvpu}_forcings.zarr"), mode='r')
+        assert list(root["ids"][:]) == catchments
+        np.testing.assert_array_equal(root["Time"][:], timestamps(t_ax))
+        for j, jvar in enumerate(ngen_variables):
+            assert root[jvar].chunks == (4, 3)
+            np.testing.assert_array_equal(root[jvar][:], data[:, j, i:k].T)
+        i = k
+
+    del data
+    release_cube(cube_shm, unlink=True)
+
+def test_consolidated_parquet(tmp_path, monkeypatch):
+    set_globals(monkeypatch, storage_type="local", forcing_path=tmp_path, parquet_row_group_catchments=4, parquet_compression="zstd")
+
+    nt, ncatch = 5, 10
+    t_ax = [f"2024-01-01 0{x}:00:00" for x in range(nt)]
+    catchments = [f"cat-{x}" for x in np.random.default_rng(0).permutation(ncatch)]
+    cube_shm, cube, data = create_cube((nt, len(ngen_variables), ncatch))
+    data[:] = np.random.default_rng(1).random(data.shape, dtype=np.float32)
+
+    write_consolidated_parquet(cube, (0, ncatch), "vpu_forcings.parquet", t_ax, catchments)
+
+    index_df = pd.read_parquet(tmp_path / "vpu_forcings.index.parquet")
+    assert list(index_df.catchment_id) == sorted(catchments)
+    assert list(index_df.row_group) == [0, 0, 0, 0, 1, 1, 1, 1, 2, 2]
+    for j, jcatch in enumerate(catchments):
+        df = pd.read_parquet(tmp_path / "vpu_forcings.parquet", filters=[("catchment_id", "==", jcatch)])
+        assert list(df.time.astype(str)) == t_ax
+        assert np.allclose(df[ngen_variables].values, data[:, :, j])
+
+    del data
+    release_cube(cube_shm, unlink=True)
+
+def test_format_csv_block_matches_pandas():
+    nt, ncatch = 24, 7
+    t_ax = [str(x) for x in pd.date_range("2024-01-01", periods=nt, freq="h")]
+    data = np.random.default_rng(2).gamma(2., 50., size=(nt, len(ngen_variables), ncatch)).astype(np.float32)
+    data[3, 2, 1] = np.nan
+    data[:, 0, 4] = 0
+    data[5, 5, 5] = 1e-7
+
+    rendered = format_csv_block(data, t_ax, ngen_variables)
+    for j in range(ncatch):
+        df = pd.DataFrame(data[:, :, j], columns=ngen_variables)
+        df.insert(0, "time", t_ax)
+        assert rendered[j] == df.to_csv(index=False).encode()
+
+def test_tar_from_shards(tmp_path, monkeypatch):
+    set_globals(monkeypatch, storage_type="local", forcing_path=tmp_path, tar_compression="gzip", tar_complevel=9)
+
+    files = [(f"cat-{x}.csv", bytes(range(x % 256)) * (x + 1)) for x in range(12)]
+    shards = []
+    for jshard in range(3):
+        members = b"".join([tar_member(name, body) for name, body in files[4 * jshard:4 * jshard + 4]])
+        path = tmp_path / f"shard{jshard}.gz"
+        path.write_bytes(gzip.compress(members))
+        shards.append((str(path), len(members)))
+
+    write_tar("VPU_01", shards)
+
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as jtar:
+        for name, body in files:
+            info = tarfile.TarInfo(name=name)
+            info.size = len(body)
+            jtar.addfile(info, BytesIO(body))
+    assert gzip.decompress((tmp_path / "VPU_01_forcings.tar.gz").read_bytes()) == buffer.getvalue()
+    assert not any([(tmp_path / f"shard{x}.gz").exists() for x in range(3)])
+
+def test_catchment_stats_merge():
+    data = np.random.default_rng(3).random((30, len(ngen_variables), 11), dtype=np.float32)
+    data[4, 1, 2] = np.nan
+    blocks = [catchment_stats(data[:, :, i:k]) for i, k in [(0, 3), (3, 4), (4, 11)]]
+    merged = [np.concatenate([x[j] for x in blocks], axis=1) for j in range(5)]
+
+    # the NaN slice is skipped, the other 29 are reduced
+    assert np.array_equal(merged[0], np.nanmean(data, axis=0))
+    assert np.array_equal(merged[1], np.nanmedian(data, axis=0))
+    assert np.isclose(merged[0][1, 2], np.mean(np.delete(data[:, 1, 2], 4)), rtol=1e-6)
+    assert merged[2][1, 2] == np.min(np.delete(data[:, 1, 2], 4)) and merged[3][1, 2] == np.max(np.delete(data[:, 1, 2], 4))
+    assert merged[4][1, 2] == 1 and merged[4].sum() == 1
+
+    # a series that is NaN throughout
+    data[:, 0, 5] = np.nan
+    stats = catchment_stats(data)
+    assert all(np.isnan(x[0, 5]) for x in stats[:4]) and stats[4][0, 5] == 30
+
+def test_write_every_catchment_of_the_cube(tmp_path, monkeypatch):
+    set_globals(monkeypatch, storage_type="local", forcing_path=tmp_path, output_file_type=["csv", "tar"], task_catchments=3,
+                ii_collect_stats=False, ii_verbose=False, worker_pool=None, tar_compression="gzip", tar_complevel=9, tar_threads=1)
+
+    nt, ncatch = 4, 10
+    t_ax = [f"2024-01-01 0{x}:00:00" for x in range(nt)]
+    catchments = [f"cat-{x}" for x in range(ncatch)]
+    cube_shm, cube, data = create_cube((nt, len(ngen_variables), ncatch))
+    data[:] = np.random.default_rng(4).random(data.shape, dtype=np.float32)
+
+    # a process given no catchments, e.g. more processes than catchments
+    set_globals(monkeypatch, ii_collect_stats=True)
+    ids, sizes, zipped, stats, tar_shards, _ = write_data(cube, (ncatch, ncatch), t_ax, [], tmp_path)
+    assert ids == [] and sizes == [] and zipped == [] and tar_shards == []
+    assert [x.shape for x in stats] == [(len(ngen_variables), 0)] * len(stats)
+    set_globals(monkeypatch, ii_collect_stats=False)
+
+    # groups only name the tar archives, catchments outside them are still written
+    ids, *_, tar_shards, _, _, _ = multiprocess_write(cube, t_ax, catchments, {"VPU_01" : catchments[:6]}, 2, tmp_path)
+    assert ids == [str(x) for x in range(ncatch)]
+    assert all([(tmp_path / f"{x}.csv").exists() for x in catchments])
+    assert sum([len(tarfile.open(x).getnames()) for x, _ in tar_shards["VPU_01"]]) == 6
+
+    del data
+    release_cube(cube_shm, unlink=True)
+
+def test_cube_unlinked_after_success_and_error(monkeypatch):
+    cube_shm, cube, data = create_cube((3, len(ngen_variables), 4))
+    data[:] = 1
+    # writers attach by name and see the same memory
+    view_shm, view = attach_cube(cube)
+    assert view.sum() == data.size
+    del view
+    release_cube(view_shm)
+    del data
+    release_cube(cube_shm, unlink=True)
+    with pytest.raises(FileNotFoundError):
+        attach_cube(cube)
+    assert cube[0] not in processor.owned_cubes
+
+    # a stage that raises leaves the pool and the cube to prep_ngen_data
+    cubes = []
+    def failing_run(conf):
+        processor.worker_pool = start_worker_pool(1)
+        cube_shm, cube, data = create_cube((3, len(ngen_variables), 4))
+        cubes.append(cube)
+        raise RuntimeError("stage failed")
+    monkeypatch.setattr(processor, "run_ngen_data", failing_run)
+    monkeypatch.setattr(processor, "worker_pool", None)
+    with pytest.raises(RuntimeError, match="stage failed"):
+        prep_ngen_data({})
+    assert processor.worker_pool is None
+    assert processor.owned_cubes == {}
+    with pytest.raises(FileNotFoundError):
+        attach_cube(cubes[0])
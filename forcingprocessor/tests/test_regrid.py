@@ -0,0 +1,212 @@
+import numpy as np
+import pytest
+import pandas as pd
+import netCDF4 as nc
+import forcingprocessor.processor as processor
+from forcingprocessor.processor import catchment_values_loop, catchment_values_sparse, forcing_grid2catchment
+from forcingprocessor.utils import build_weights_matrix, get_window, get_windows, shard_weights, window_cells, window_offsets, window_views, calc_weights_key, write_compiled_weights, load_compiled_weights, map_weights_arrays, read_plan, NWM_NX, NWM_NY
+
+def make_weights(ncatch=200, seed=0, x0=1000, y0=2000):
+    rng = np.random.default_rng(seed)
+    cell_ids = []
+    coverages = []
+    for j in range(ncatch):
+        x = x0 + rng.integers(0, 200, size=rng.integers(1, 20))
+        y = y0 + rng.integers(0, 150, size=len(x))
+        cell_ids.append(list(x + y * NWM_NX))
+        coverages.append(list(rng.uniform(0.01, 1.0, size=len(x))))
+    ids = [f"cat-{j}" for j in range(ncatch)]
+    return pd.DataFrame({"cell_id": cell_ids, "coverage": coverages}, index=ids)
+
+def test_sparse_matches_loop():
+    weights_df = make_weights()
+    window = get_window(weights_df)
+    x_min, x_max, y_min, y_max = window
+    dx = x_max - x_min + 1
+    dy = y_max - y_min + 1
+    rng = np.random.default_rng(1)
+    data_allvars = rng.normal(size=(9, dy * dx)).astype(np.float32)
+
+    loop = catchment_values_loop(data_allvars, weights_df, window, (NWM_NX, NWM_NY))
+    weights_mat = build_weights_matrix(weights_df, window)
+    sparse = catchment_values_sparse(data_allvars, weights_mat)
+
+    assert sparse.shape == loop.shape
+    assert sparse.dtype == np.float32
+    np.testing.assert_allclose(sparse, loop, rtol=1e-5, atol=1e-6)
+
+    # both sum in float64 and round once to float32, so fields like temperature agree to the last place
+    data_allvars = (280. + 5. * data_allvars).astype(np.float32)
+    loop = catchment_values_loop(data_allvars, weights_df, window, (NWM_NX, NWM_NY))
+    sparse = catchment_values_sparse(data_allvars, weights_mat)
+    np.testing.assert_array_max_ulp(sparse, loop, maxulp=1)
+
+def test_numba_skips_nan_cells():
+    pytest.importorskip("numba")
+    from forcingprocessor.kernels import catchment_values_numba
+    weights_df = make_weights()
+    window = get_window(weights_df)
+    x_min, x_max, y_min, y_max = window
+    rng = np.random.default_rng(2)
+    data_allvars = rng.normal(size=(9, (y_max - y_min + 1) * (x_max - x_min + 1))).astype(np.float32)
+    weights_mat = build_weights_matrix(weights_df, window)
+    np.testing.assert_allclose(catchment_values_numba(data_allvars, weights_mat), catchment_values_sparse(data_allvars, weights_mat), rtol=1e-5, atol=1e-6)
+
+    # masked cells drop out and the coverage of the rest is renormalized
+    data_allvars[:, weights_mat.indices[::3]] = np.nan
+    numba_values = catchment_values_numba(data_allvars, weights_mat)
+    valid = ~np.isnan(data_allvars[0])
+    masked = weights_mat.multiply(valid[None, :]).tocsr()
+    with np.errstate(invalid='ignore'):
+        expected = (masked @ np.nan_to_num(data_allvars).T).T / np.asarray(masked.sum(axis=1)).T
+    np.testing.assert_allclose(numba_values, expected, rtol=1e-5, atol=1e-6)
+    assert np.isnan(catchment_values_sparse(data_allvars, weights_mat)).sum() > np.isnan(numba_values).sum()
+
+def test_numba_engine_on_fill_cells(tmp_path, monkeypatch):
+    pytest.importorskip("numba")
+    ny, nx = 40, 50
+    rng = np.random.default_rng(5)
+    path = str(tmp_path / "nwm.t00z.short_range.forcing.f001.conus.nc")
+    with nc.Dataset(path, 'w') as ds:
+        ds.createDimension('time', 1)
+        ds.createDimension('y', ny)
+        ds.createDimension('x', nx)
+        ds.model_output_valid_time = "2024-01-01_01:00:00"
+        for jvar in ["U2D", "RAINRATE"]:
+            var = ds.createVariable(jvar, 'f4', ('time', 'y', 'x'), zlib=True, chunksizes=(1, 16, 16), fill_value=-999.0)
+            data = rng.uniform(1., 2., size=(1, ny, nx)).astype(np.float32)
+            data[0, ::4, ::5] = -999.0
+            var[:] = data
+
+    cell_ids, coverages = [], []
+    for j in range(80):
+        x = 2 + rng.integers(0, 44, size=rng.integers(2, 12))
+        y = 2 + rng.integers(0, 34, size=len(x))
+        cell_ids.append(list(x + y * NWM_NX))
+        coverages.append(list(rng.uniform(0.01, 1.0, size=len(x))))
+    weights_df = pd.DataFrame({"cell_id": cell_ids, "coverage": coverages}, index=[f"cat-{j}" for j in range(80)])
+    windows = [get_window(weights_df)]
+    ngen_vars, sources, fan_out = read_plan(["UGRD_10maboveground", "APCP_surface", "precip_rate"])
+    for name, value in [("weights_df", weights_df), ("weights_mat", build_weights_matrix(weights_df, windows[0])), ("windows", windows),
+                        ("ngen_variables", ngen_vars), ("nwm_sources", sources), ("fan_out", fan_out), ("ngen_vars_plot", []),
+                        ("ii_plot", False), ("nts_plot", 0), ("ii_verbose", False), ("batch_size", 1), ("batch_memory_MB", 1024),
+                        ("regrid_threads", 1), ("fs_type", None), ("prefetch_depth", 0), ("io_threads", 0), ("read_mode", "range"),
+                        ("nwm_references", {}), ("chunk_sparse", True), ("cell_mask", None)]:
+        monkeypatch.setattr(processor, name, value, raising=False)
+
+    values = {}
+    for engine in ["sparse", "numba"]:
+        monkeypatch.setattr(processor, "regrid_engine", engine, raising=False)
+        values[engine] = forcing_grid2catchment([path])[0][0]
+    sparse_nan = np.isnan(values["sparse"])
+    # catchments over a fill cell are nan with the sparse engine, the numba engine renormalizes over the valid cells
+    assert sparse_nan.any()
+    assert not np.isnan(values["numba"]).any()
+    np.testing.assert_allclose(values["numba"][~sparse_nan], values["sparse"][~sparse_nan], rtol=1e-5)
+    assert ((values["numba"] >= 1.) & (values["numba"] <= 2.)).all()
+
+def test_compiled_weights_roundtrip(tmp_path):
+    weights_df = make_weights()
+    window = get_window(weights_df)
+    weights_mat = build_weights_matrix(weights_df, window)
+    jcatchment_dict = {"VPU_01": list(weights_df.index[:120]), "VPU_02": list(weights_df.index[120:])}
+    key = calc_weights_key(["vpu-01.gpkg", "vpu-02.gpkg"])
+    write_compiled_weights(tmp_path, key, weights_mat, [window], list(weights_df.index), jcatchment_dict)
+
+    assert load_compiled_weights(tmp_path, calc_weights_key(["vpu-01.gpkg"])) is None
+    compiled_mat, compiled_windows, catchment_ids, compiled_dict, array_dir = load_compiled_weights(tmp_path, key)
+    assert compiled_windows == [window]
+    assert catchment_ids == list(weights_df.index)
+    assert compiled_dict == jcatchment_dict
+    assert (compiled_mat != weights_mat).nnz == 0
+
+    # a recompile swaps the whole artifact, the arrays mapped above stay readable
+    other_ids = [f"cat-x{j}" for j in range(len(weights_df))]
+    write_compiled_weights(tmp_path, calc_weights_key(["vpu-03.gpkg"]), weights_mat[::-1], [window], other_ids, {"VPU_03": other_ids})
+    assert load_compiled_weights(tmp_path, key) is None
+    assert load_compiled_weights(tmp_path, calc_weights_key(["vpu-03.gpkg"]))[2] == other_ids
+    assert (compiled_mat != weights_mat).nnz == 0
+    assert len([x for x in tmp_path.iterdir() if x.is_dir()]) == 1
+
+def worker_weights_nnz():
+    return processor.weights_mat.nnz
+
+def test_workers_map_the_loaded_artifact(tmp_path, monkeypatch):
+    weights_df = make_weights()
+    window = get_window(weights_df)
+    weights_mat = build_weights_matrix(weights_df, window)
+    jcatchment_dict = {"VPU_01": list(weights_df.index)}
+    array_dir = write_compiled_weights(tmp_path, calc_weights_key(["vpu-01.gpkg"]), weights_mat, [window], list(weights_df.index), jcatchment_dict)
+    assert (map_weights_arrays(array_dir, weights_mat.shape)[0] != weights_mat).nnz == 0
+
+    monkeypatch.setattr(processor, "weights_mat", None, raising=False)
+    pool = processor.start_worker_pool(2, (array_dir, weights_mat.shape))
+    try:
+        assert pool.submit(worker_weights_nnz).result() == weights_mat.nnz
+    finally:
+        pool.shutdown()
+
+    # a recompile by another run removed the loaded arrays, the pool is not started
+    write_compiled_weights(tmp_path, calc_weights_key(["vpu-02.gpkg"]), weights_mat, [window], list(weights_df.index), jcatchment_dict)
+    with pytest.raises(FileNotFoundError, match="replaced by another run"):
+        processor.start_worker_pool(2, (array_dir, weights_mat.shape))
+
+def test_group_windows_match_single_window():
+    a = make_weights(100, seed=0, x0=1000, y0=2000)
+    b = make_weights(80, seed=1, x0=3000, y0=500)
+    c = make_weights(50, seed=2, x0=1050, y0=2020)
+    c.index = [f"cat-c{j}" for j in range(len(c))]
+    b.index = [f"cat-b{j}" for j in range(len(b))]
+    weights_df = pd.concat([a, b, c])
+    jcatchment_dict = {"VPU_01": list(a.index), "VPU_02": list(b.index), "VPU_03": list(c.index)}
+
+    windows, catchment_window = get_windows(weights_df, jcatchment_dict)
+    # VPU_03 lies within VPU_01 and is merged into its window
+    assert len(windows) == 2
+    assert windows[0] == get_window(pd.concat([a, c]))
+    assert windows[1] == get_window(b)
+    assert list(catchment_window) == [0] * 100 + [1] * 80 + [0] * 50
+    assert window_offsets(windows)[1] < (get_window(weights_df)[1] - get_window(weights_df)[0] + 1) * (get_window(weights_df)[3] - get_window(weights_df)[2] + 1)
+
+    # the same field read through the single bounding window and through the group windows
+    window = get_window(weights_df)
+    x_min, x_max, y_min, y_max = window
+    field = np.random.default_rng(3).normal(size=(9, y_max - y_min + 1, x_max - x_min + 1)).astype(np.float32)
+    single = catchment_values_sparse(field.reshape(9, -1), build_weights_matrix(weights_df, window))
+    data_allvars = np.zeros((9, window_offsets(windows)[1]), dtype=np.float32)
+    for view, (wx0, wx1, wy0, wy1) in zip(window_views(data_allvars, windows), windows):
+        view[:] = field[:, wy0 - y_min:wy1 - y_min + 1, wx0 - x_min:wx1 - x_min + 1]
+    grouped = catchment_values_sparse(data_allvars, build_weights_matrix(weights_df, windows, catchment_window))
+    np.testing.assert_array_equal(grouped, single)
+
+    # groups that do not follow the weights rows, e.g. a name repeated and overwritten, fall back to one window
+    windows, catchment_window = get_windows(weights_df, {"VPU_01": list(c.index), "VPU_02": list(b.index)})
+    assert windows == [window]
+    assert (catchment_window == 0).all() and len(catchment_window) == len(weights_df)
+
+    # the window cell axis maps back to the weights cells
+    cells = np.unique(np.concatenate([np.asarray(x) for x in weights_df['cell_id']]))
+    x, y = window_cells(windows, np.unique(build_weights_matrix(weights_df, windows, catchment_window).indices))
+    np.testing.assert_array_equal(np.sort(y * NWM_NX + x), cells % (NWM_NX * NWM_NY))
+
+def test_shard_weights_match_full_run():
+    a = make_weights(100, seed=0, x0=1000, y0=2000)
+    b = make_weights(80, seed=1, x0=3000, y0=500)
+    b.index = [f"cat-b{j}" for j in range(len(b))]
+    weights_df = pd.concat([a, b])
+    windows, catchment_window = get_windows(weights_df, {"VPU_01": list(a.index), "VPU_02": list(b.index)})
+    weights_mat = build_weights_matrix(weights_df, windows, catchment_window)
+    window = get_window(weights_df)
+    x_min, x_max, y_min, y_max = window
+    field = np.random.default_rng(4).normal(size=(9, y_max - y_min + 1, x_max - x_min + 1)).astype(np.float32)
+    full = catchment_values_sparse(field.reshape(9, -1), build_weights_matrix(weights_df, window))
+
+    # a shard cutting across both VPUs reads only the cells its catchments cover
+    rows = np.arange(60, 130)
+    shard_mat, shard_windows = shard_weights(weights_mat, windows, rows)
+    assert len(shard_windows) == 2
+    assert window_offsets(shard_windows)[1] < window_offsets(windows)[1]
+    data_allvars = np.zeros((9, window_offsets(shard_windows)[1]), dtype=np.float32)
+    for view, (wx0, wx1, wy0, wy1) in zip(window_views(data_allvars, shard_windows), shard_windows):
+        view[:] = field[:, wy0 - y_min:wy1 - y_min + 1, wx0 - x_min:wx1 - x_min + 1]
+    np.testing.assert_allclose(catchment_values_sparse(data_allvars, shard_mat), full[:, rows], rtol=1e-6)
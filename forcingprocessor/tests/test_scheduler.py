@@ -0,0 +1,21 @@
+import numpy as np
+import forcingprocessor.processor as processor
+from forcingprocessor.processor import make_tasks, schedule_tasks, task_stats
+
+def square(x):
+    return x * x
+
+def test_schedule_tasks_ordered(monkeypatch):
+    monkeypatch.setattr(processor, "ii_verbose", False, raising=False)
+    monkeypatch.setattr(processor, "worker_pool", None)
+    tasks = make_tasks(10, 3)
+    assert tasks == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    results, durations, pids, startup = schedule_tasks(square, [(x,) for x in range(20)], 4)
+    assert results == [x * x for x in range(20)]
+    assert len(durations) == 20 and len(pids) == 20 and startup >= 0
+
+def test_task_stats():
+    avg, max_time, imbalance = task_stats([1., 1., 2.], [10, 11, 11])
+    assert np.isclose(avg, 4 / 3)
+    assert max_time == 2.
+    assert np.isclose(imbalance, 3 / 2)
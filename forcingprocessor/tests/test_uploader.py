@@ -0,0 +1,44 @@
+import os
+import boto3
+import pytest
+from forcingprocessor.uploader import S3Uploader
+
+moto_server = pytest.importorskip("moto.server")
+
+@pytest.fixture
+def s3_endpoint(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    server = moto_server.ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+def test_uploader_small_and_multipart(s3_endpoint):
+    s3 = boto3.client("s3", endpoint_url=s3_endpoint)
+    s3.create_bucket(Bucket="forcings")
+
+    small = [os.urandom(1000) for x in range(50)]
+    large = os.urandom(6 * 1048576)
+    with S3Uploader(max_workers=4, max_pending=8, multipart_threshold_MB=5, endpoint_url=s3_endpoint) as uploader:
+        for j, body in enumerate(small):
+            uploader.put("forcings", f"out/cat-{j}.csv", body)
+        uploader.put("forcings", "out/large.bin", large)
+        uploader.flush()
+        nbytes, nrequests, nretries, tupload = uploader.stats()
+
+    assert nrequests == 51
+    assert nbytes == sum([len(x) for x in small]) + len(large)
+    assert nretries == 0
+    for j, body in enumerate(small):
+        assert s3.get_object(Bucket="forcings", Key=f"out/cat-{j}.csv")["Body"].read() == body
+    assert s3.get_object(Bucket="forcings", Key="out/large.bin")["Body"].read() == large
+
+def test_uploader_raises_after_retries(s3_endpoint):
+    with S3Uploader(max_workers=2, retries=2, endpoint_url=s3_endpoint) as uploader:
+        uploader.put("missing-bucket", "out/cat-1.csv", b"x")
+        with pytest.raises(Exception):
+            uploader.flush()
+        assert uploader.stats()[2] == 1